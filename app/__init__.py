@@ -11,19 +11,18 @@ routes in the blueprint separated from other routes in the application  "namespa
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from flask import Flask, request, current_app
+from flask import Flask
 from config import Config
+from app import assets, avatars, i18n, lazy, routing, sessions, sqlite_tuning, \
+    streaming, template_cache
 
 # create extension instances, will be initialized later in the Factory method
-db = SQLAlchemy()
-migrate = Migrate()
+db = routing.RoutingSQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
@@ -39,12 +38,35 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    sqlite_tuning.init_app(app, db)
     login.init_app(app)
-    mail.init_app(app)
+    # Flask-Migrate is only needed by the `flask db` commands and Flask-Mail only
+    # when an email is sent, so in lazy mode both are set up on first use
+    if app.config['LAZY_EXTENSIONS']:
+        lazy.defer(app, 'migrate', init_migrate)
+        lazy.defer(app, 'mail', mail.init_app)
+    else:
+        init_migrate(app)
+        mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
+    assets.init_app(app)
+    avatars.init_app(app)
+    template_cache.init_app(app)
+    i18n.init_app(app)
+    sessions.init_app(app)
+    routing.init_app(app)
+    streaming.init_app(app)
+    if app.config['PROXY_COUNT']:
+        init_proxy_fix(app)
+    if app.config['COMPRESS_RESPONSES']:
+        from app.compression import CompressionMiddleware
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config['COMPRESS_LEVEL'],
+                                             app.config['COMPRESS_MIN_SIZE'])
+    # outermost, so shed requests cost as little as possible
+    from app import admission
+    admission.init_app(app)
     # register error blueprint
     # put the import of the blueprint right above the app.register_blueprint()
     # to avoid circular dependencies.
@@ -56,6 +78,9 @@ def create_app(config_class=Config):
     # register main blueprint
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
+    # register the JSON API, versioned by its URL prefix
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
     # add SMTPHandler instance to the Flask logger object, which is app.logger
     # all this logging is skipped during unit tests.
     if not app.debug and not app.testing:
@@ -87,8 +112,34 @@ def create_app(config_class=Config):
 
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
+    if app.config['PREWARM_CACHES']:
+        lazy.prewarm(app)
     return app
 
+def init_migrate(app):
+    """
+    bind Flask-Migrate to the app. The import lives here because flask_migrate
+    pulls in alembic, which is the slowest import of all extensions.
+    """
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+def init_proxy_fix(app):
+    """
+    behind PROXY_COUNT reverse proxies, take the client address and scheme from
+    the X-Forwarded-For and X-Forwarded-Proto headers they add, so that rate
+    limits (app/ratelimit.py) count clients and not the proxy. Only the
+    addresses added by that many proxies are trusted.
+    """
+    count = app.config['PROXY_COUNT']
+    try:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count)
+    except ImportError:
+        # Werkzeug before 0.15
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=count)
+
 # localeselector decorator is invoked for each request to get language
 @babel.localeselector
 def get_locale():
@@ -99,8 +150,9 @@ def get_locale():
     the default being usually imported from the language settings in the computer's operating
     system. best_match ompare the list of languages requested by the client against the
     languages the application supports, and using the client provided weights.
+    The result is memoized per header value, see app/i18n.py.
     """
-    return request.accept_languages.best_match(current_app.config['LANGUAGES'])
+    return i18n.request_locale()
 
 # avoid circular import
 # pylint: disable=C0413
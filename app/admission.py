@@ -0,0 +1,144 @@
+"""
+Admission control: load shedding before the application runs.
+
+When a worker is overloaded, every extra request it accepts still loads the
+user, updates last_seen and queries the timeline, and only makes all of them
+slower. AdmissionMiddleware counts the requests a worker is handling (until
+their response has been sent, streams included) and answers 503 Service
+Unavailable with a Retry-After header at once when a limit is reached, without
+entering Flask or the database. The 503 page is pre-rendered, see
+app/errors/pages.py; API requests get a JSON error instead.
+
+The limits are per worker process, ADMISSION_LIMITS is a list of
+"<class>=<count>":
+* total: all requests
+* main, auth, api: requests by blueprint
+* stream: the new posts polls and event streams (main.new_posts), which hold
+  a thread for up to TIMELINE_STREAM_SECONDS
+Static files are never limited. Requests to unknown URLs count as main.
+e.g. ADMISSION_LIMITS="total=32,stream=8" with gevent workers, or "stream=2" to
+keep two of four gthread threads free of long polls.
+"""
+from functools import partial
+import json
+import threading
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+from app.errors import pages
+
+TOTAL = 'total'
+STREAM = 'stream'
+DEFAULT = 'main'
+STREAM_ENDPOINTS = ('main.new_posts',)
+
+
+def parse_limits(spec):
+    """'total=32,stream=8' -> {'total': 32, 'stream': 8}"""
+    limits = {}
+    for item in spec.split(','):
+        if item.strip():
+            name, count = item.split('=')
+            limits[name.strip()] = int(count)
+    return limits
+
+
+def endpoint_class(app, environ):
+    """class of the endpoint environ is routed to, None for static files"""
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(
+            environ, server_name=app.config['SERVER_NAME']).match()
+    except HTTPException:
+        return DEFAULT
+    if endpoint == 'static' or endpoint.endswith('.static'):
+        return None
+    if endpoint in STREAM_ENDPOINTS:
+        return STREAM
+    return endpoint.split('.')[0] if '.' in endpoint else DEFAULT
+
+
+class Admission(object):
+    """in-flight request counters of a process, in total and per class"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.in_flight = {}
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def enter(self, name):
+        """
+        admit a request of class name unless a limit is reached
+        Returns
+        -------
+        bool
+            True if admitted, leave(name) has to follow
+        """
+        with self._lock:
+            for key in (TOTAL, name):
+                if self.limits.get(key) and self.in_flight.get(key, 0) >= self.limits[key]:
+                    self.rejected += 1
+                    return False
+            for key in (TOTAL, name):
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        return True
+
+    def leave(self, name):
+        """a request admitted by enter(name) is done"""
+        with self._lock:
+            for key in (TOTAL, name):
+                self.in_flight[key] -= 1
+
+
+class AdmissionMiddleware(object):
+    """
+    WSGI middleware in front of app.wsgi_app, see the module docstring
+    Parameters
+    ----------
+    app : Flask
+        the application, for its URL map and error pages
+    limits : dict
+        in-flight requests per class, parse_limits()
+    retry_after : int
+        seconds sent in the Retry-After header
+    """
+
+    def __init__(self, app, limits, retry_after):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.admission = Admission(limits)
+        self.retry_after = retry_after
+
+    def __call__(self, environ, start_response):
+        name = endpoint_class(self.app, environ)
+        if name is None:
+            return self.wsgi_app(environ, start_response)
+        if not self.admission.enter(name):
+            return self.reject(name, environ, start_response)
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.admission.leave(name)
+            raise
+        # counted until the server closes the response, after the last chunk
+        return ClosingIterator(iterable, partial(self.admission.leave, name))
+
+    def reject(self, name, environ, start_response):
+        """503 with the pre-rendered page, JSON for the API"""
+        if name == 'api':
+            body = json.dumps({'error': 'Service Unavailable'}).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            body = pages.page(self.app, 503, pages.locale_for(
+                self.app, environ.get('HTTP_ACCEPT_LANGUAGE')))
+            content_type = 'text/html; charset=utf-8'
+        start_response('503 SERVICE UNAVAILABLE', [
+            ('Content-Type', content_type), ('Content-Length', str(len(body))),
+            ('Retry-After', str(self.retry_after)), ('Cache-Control', 'no-store')])
+        return [body]
+
+
+def init_app(app):
+    """put AdmissionMiddleware in front of the application if ADMISSION_LIMITS are set"""
+    limits = parse_limits(app.config['ADMISSION_LIMITS'])
+    if limits:
+        app.wsgi_app = AdmissionMiddleware(app, limits, app.config['ADMISSION_RETRY_AFTER'])
@@ -0,0 +1,9 @@
+"""
+Blueprint of the JSON API, registered under /api/v1.
+Views answer with JSON only, errors included, see errors.py.
+"""
+from flask import Blueprint
+
+bp = Blueprint('api', __name__)
+
+from app.api import routes
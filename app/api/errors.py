@@ -0,0 +1,18 @@
+"""JSON error responses of the API"""
+from flask import jsonify
+from werkzeug.http import HTTP_STATUS_CODES
+
+
+def error_response(status_code, message=None):
+    """JSON body with the status name and an optional message"""
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    response = jsonify(payload)
+    response.status_code = status_code
+    return response
+
+
+def bad_request(message):
+    """400 with an explanation of what is wrong with the request"""
+    return error_response(400, message)
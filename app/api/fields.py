@@ -0,0 +1,103 @@
+"""
+Sparse fieldsets and serialization of Core rows.
+
+Every resource declares its fields as the columns they are read from and a
+function turning those column values into the JSON value. A request asks for
+a subset with ?fields=a,b and only the columns of those fields are selected.
+Rows come back as plain tuples from a Core select, no ORM objects are built.
+"""
+from collections import OrderedDict, namedtuple
+from app import avatars
+from app.models import Post, User
+from app.timeline import encode_cursor
+
+Field = namedtuple('Field', ['columns', 'convert'])
+
+
+def _same(value):
+    return value
+
+
+def _isoformat(value):
+    return value.isoformat() + 'Z' if value is not None else None
+
+
+def _avatar(email):
+    # same URL as User.avatar(), without loading the user
+    return avatars.url(email, 128)
+
+
+POST_FIELDS = OrderedDict([
+    ('id', Field((Post.id,), _same)),
+    ('body', Field((Post.body,), _same)),
+    ('timestamp', Field((Post.timestamp,), _isoformat)),
+    ('language', Field((Post.language,), lambda language: language or None)),
+    ('author', Field((User.username,), _same)),
+    ('cursor', Field((Post.timestamp, Post.id), encode_cursor)),
+])
+
+USER_FIELDS = OrderedDict([
+    ('id', Field((User.id,), _same)),
+    ('username', Field((User.username,), _same)),
+    ('about_me', Field((User.about_me,), _same)),
+    ('last_seen', Field((User.last_seen,), _isoformat)),
+    ('post_count', Field((User.post_count,), _same)),
+    ('follower_count', Field((User.follower_count,), _same)),
+    ('followed_count', Field((User.followed_count,), _same)),
+    ('avatar', Field((User.email,), _avatar)),
+])
+
+
+def parse_fields(value, available):
+    """
+    the requested field names, all fields for an empty value
+    Raises
+    ------
+    ValueError
+        for names that are not in available
+    """
+    if not value:
+        return list(available)
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError('unknown fields: {}'.format(', '.join(unknown)))
+    return names
+
+
+class Serializer(object):
+    """
+    the columns to select for some fields, and the conversion of result rows
+    Parameters
+    ----------
+    available : OrderedDict
+        POST_FIELDS or USER_FIELDS
+    names : list
+        requested field names
+    extra : tuple
+        columns needed by the caller, e.g. for the keyset, they come first
+    """
+
+    def __init__(self, available, names, extra=()):
+        self.columns = list(extra)
+        self.fields = []
+        for name in names:
+            field = available[name]
+            positions = []
+            for column in field.columns:
+                # by identity, == on a column builds a SQL expression
+                position = next((pos for pos, selected in enumerate(self.columns)
+                                 if selected is column), None)
+                if position is None:
+                    position = len(self.columns)
+                    self.columns.append(column)
+                positions.append(position)
+            self.fields.append((name, positions, field.convert))
+
+    def uses(self, model):
+        """True if a selected column belongs to model"""
+        return any(column.class_ is model for column in self.columns)
+
+    def __call__(self, row):
+        return {name: convert(*[row[pos] for pos in positions])
+                for name, positions, convert in self.fields}
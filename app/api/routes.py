@@ -0,0 +1,231 @@
+"""
+API routes, all under /api/v1.
+
+Lists are paginated with keysets instead of page numbers: posts are returned
+newest first and the next page starts before the cursor of the last post
+(?before=<cursor>), users are returned by id (?after=<id>). The link to the
+next page is part of the response. ?fields=a,b limits the fields of each item,
+?limit= the number of items. Responses carry an ETag and answer If-None-Match
+with 304 Not Modified.
+
+Single posts are looked up in the archive (app/archive.py) if the post table
+has no match. Post lists continue with archived posts past the last post of
+the post table, unless the archive is in a database of its own: their criteria
+refer to the followers and user tables of the primary database.
+"""
+from functools import wraps
+from flask import current_app, json, request, url_for
+from flask_login import current_user
+from app import archive, db, timeline
+from app.api import bp
+from app.api.errors import bad_request, error_response
+from app.api.fields import POST_FIELDS, USER_FIELDS, Serializer, parse_fields
+from app.models import Post, User, followers
+from app.routing import read_only
+
+
+def login_required(view):
+    """like flask_login.login_required, but answers 401 instead of redirecting"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return error_response(401)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def json_response(payload):
+    """compact JSON with an ETag of the body, 304 if the client has it already"""
+    response = current_app.response_class(
+        json.dumps(payload, separators=(',', ':')), mimetype='application/json')
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def page_arguments(available):
+    """(field names, limit) from the query string, ValueError if they are invalid"""
+    names = parse_fields(request.args.get('fields'), available)
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    if not 0 < limit <= current_app.config['API_MAX_PAGE_SIZE']:
+        raise ValueError('limit must be between 1 and {}'.format(
+            current_app.config['API_MAX_PAGE_SIZE']))
+    return names, limit
+
+
+def next_url(**position):
+    """URL of the same list continuing at position"""
+    args = dict(request.view_args)
+    args.update(request.args.to_dict())
+    args.update(position)
+    return url_for(request.endpoint, _external=True, **args)
+
+
+def find_user_id(username):
+    """id of a user without loading the row into the session"""
+    return db.session.query(User.id).filter(User.username == username).scalar()
+
+
+def post_list(criterion):
+    """a page of posts matching criterion, newest first"""
+    try:
+        names, limit = page_arguments(POST_FIELDS)
+    except ValueError as exc:
+        return bad_request(str(exc))
+    before = request.args.get('before')
+    cursor = timeline.decode_cursor(before)
+    if before and cursor is None:
+        return bad_request('invalid cursor')
+    serializer = Serializer(POST_FIELDS, names, extra=(Post.timestamp, Post.id))
+    query = db.select(serializer.columns).where(criterion)
+    if serializer.uses(User):
+        query = query.select_from(Post.__table__.join(User.__table__, Post.user_id == User.id))
+    if cursor is not None:
+        query = query.where(timeline.older_than(cursor))
+    # one more row than needed tells if there is a next page
+    query = query.order_by(Post.timestamp.desc(), Post.id.desc())
+    rows = db.session.execute(query.limit(limit + 1)).fetchall()
+    if len(rows) <= limit and not archive.separate():
+        # archived posts are older than all others, they come next
+        rows += db.session.execute(archive.adapt(query).limit(limit + 1 - len(rows))).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'items': [serializer(row) for row in rows],
+        'next': next_url(before=timeline.encode_cursor(*rows[-1][:2])) if more else None,
+    })
+
+
+def user_list(criterion, join=None):
+    """a page of users matching criterion, by id"""
+    try:
+        names, limit = page_arguments(USER_FIELDS)
+    except ValueError as exc:
+        return bad_request(str(exc))
+    after = request.args.get('after', 0, type=int)
+    serializer = Serializer(USER_FIELDS, names, extra=(User.id,))
+    query = db.select(serializer.columns).where(db.and_(criterion, User.id > after))
+    if join is not None:
+        query = query.select_from(join)
+    rows = db.session.execute(query.order_by(User.id).limit(limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'items': [serializer(row) for row in rows],
+        'next': next_url(after=rows[-1][0]) if more else None,
+    })
+
+
+@bp.route('/users/<username>')
+@login_required
+@read_only
+def get_user(username):
+    """a user"""
+    try:
+        names = parse_fields(request.args.get('fields'), USER_FIELDS)
+    except ValueError as exc:
+        return bad_request(str(exc))
+    serializer = Serializer(USER_FIELDS, names)
+    row = db.session.execute(db.select(serializer.columns).where(
+        User.username == username)).first()
+    if row is None:
+        return error_response(404, 'no user {}'.format(username))
+    return json_response(serializer(row))
+
+
+@bp.route('/users/<username>/posts')
+@login_required
+@read_only
+def get_user_posts(username):
+    """posts written by a user"""
+    user_id = find_user_id(username)
+    if user_id is None:
+        return error_response(404, 'no user {}'.format(username))
+    return post_list(Post.user_id == user_id)
+
+
+@bp.route('/users/<username>/followers')
+@login_required
+@read_only
+def get_followers(username):
+    """users following a user"""
+    user_id = find_user_id(username)
+    if user_id is None:
+        return error_response(404, 'no user {}'.format(username))
+    return user_list(followers.c.followed_id == user_id, User.__table__.join(
+        followers, followers.c.follower_id == User.id))
+
+
+@bp.route('/users/<username>/followed')
+@login_required
+@read_only
+def get_followed(username):
+    """users a user follows"""
+    user_id = find_user_id(username)
+    if user_id is None:
+        return error_response(404, 'no user {}'.format(username))
+    return user_list(followers.c.follower_id == user_id, User.__table__.join(
+        followers, followers.c.followed_id == User.id))
+
+
+@bp.route('/posts/<int:id_>')
+@login_required
+@read_only
+def get_post(id_):
+    """a post"""
+    try:
+        names = parse_fields(request.args.get('fields'), POST_FIELDS)
+    except ValueError as exc:
+        return bad_request(str(exc))
+    serializer = Serializer(POST_FIELDS, names)
+    query = db.select(serializer.columns).where(Post.id == id_)
+    if serializer.uses(User):
+        query = query.select_from(Post.__table__.join(User.__table__, Post.user_id == User.id))
+    row = db.session.execute(query).first()
+    if row is None:
+        row = archived_post(serializer, query, id_)
+    if row is None:
+        return error_response(404, 'no post {}'.format(id_))
+    return json_response(serializer(row))
+
+
+def archived_post(serializer, query, id_):
+    """the row of get_post() from the archive, None if the post is not archived either"""
+    if not archive.separate():
+        return db.session.execute(archive.adapt(query)).first()
+    # the archive database has no user table: the post columns come from the
+    # archive, the author's columns from the primary database
+    hot = [pos for pos, column in enumerate(serializer.columns) if column.class_ is Post]
+    with archive.engine().connect() as connection:
+        post = connection.execute(archive.adapt(db.select(
+            [serializer.columns[pos] for pos in hot] + [Post.user_id]).where(
+                Post.id == id_))).first()
+    if post is None:
+        return None
+    row = [None] * len(serializer.columns)
+    for pos, value in zip(hot, post):
+        row[pos] = value
+    author = [pos for pos in range(len(row)) if pos not in hot]
+    if author:
+        values = db.session.execute(db.select(
+            [serializer.columns[pos] for pos in author]).where(User.id == post[-1])).first()
+        for pos, value in zip(author, values or ()):
+            row[pos] = value
+    return row
+
+
+@bp.route('/timeline')
+@login_required
+@read_only
+def get_timeline():
+    """the home timeline of the logged in user: own posts and followed users' posts"""
+    return post_list(timeline.timeline_filter(timeline.HOME, current_user.id))
+
+
+@bp.route('/explore')
+@login_required
+@read_only
+def get_explore():
+    """all posts"""
+    return post_list(timeline.timeline_filter(timeline.EXPLORE, current_user.id))
@@ -0,0 +1,128 @@
+"""
+Hot and archived posts.
+
+The timelines almost always show the newest pages, but the post table and
+its indexes keep growing. `flask posts archive --older-than <days>` moves old
+posts in bulk to the post_archive table (PostArchive), which lives in the
+database of ARCHIVE_DATABASE_URL if it is set (e.g. a separate SQLite file)
+and in the primary database otherwise.
+
+The timelines read the post table only. Since archived posts are older than
+all remaining ones, a page that runs past the last post of the post table
+continues with the archive (see BatchedItems in app/pagination.py), and so do
+the API lists. The post counters on User include archived posts, so the page
+numbers do not change when posts are archived.
+"""
+from datetime import datetime, timedelta
+from time import sleep
+from flask import current_app
+from app import db
+from app.routing import ARCHIVE
+
+
+def separate():
+    """True if archived posts are in their own database"""
+    return ARCHIVE in (current_app.config['SQLALCHEMY_BINDS'] or {})
+
+
+def engine():
+    """engine of the archive database, the primary one if there is none"""
+    return db.get_engine(current_app, bind=ARCHIVE)
+
+
+def create_table():
+    """create the archive table in a separate archive database"""
+    from app.models import PostArchive
+    PostArchive.__table__.create(engine(), checkfirst=True)
+
+
+def archive_posts(before, batch_size=1000, pause=0.0, progress=None):
+    """
+    move the posts older than before to the archive, batch_size posts per
+    transaction, oldest ids first. A batch interrupted between the two databases
+    is repeated by the next run, copies in the archive are replaced.
+    Parameters
+    ----------
+    progress : callable
+        called with the number of posts moved so far after each batch
+    Returns
+    -------
+    int
+        number of posts moved
+    """
+    from app.models import Post, PostArchive
+    hot, cold = Post.__table__, PostArchive.__table__
+    columns = [hot.c[column.name] for column in cold.columns]
+    moved = 0
+    if separate():
+        create_table()
+    while True:
+        ids = [id_ for id_, in db.session.execute(
+            db.select([hot.c.id]).where(hot.c.timestamp < before).order_by(
+                hot.c.id).limit(batch_size))]
+        if not ids:
+            return moved
+        if separate():
+            rows = [dict(row) for row in db.session.execute(
+                db.select(columns).where(hot.c.id.in_(ids)))]
+            with engine().begin() as connection:
+                connection.execute(cold.delete().where(cold.c.id.in_(ids)))
+                connection.execute(cold.insert(), rows)
+        else:
+            db.session.execute(cold.insert().from_select(
+                [column.name for column in columns],
+                db.select(columns).where(hot.c.id.in_(ids))))
+        db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+        if progress is not None:
+            progress(moved)
+        sleep(pause)
+
+
+def archive_older_than(days, batch_size=1000, pause=0.0, progress=None):
+    """archive_posts() for posts older than days days"""
+    return archive_posts(datetime.utcnow() - timedelta(days=days), batch_size, pause,
+                         progress)
+
+
+def archived_counts():
+    """
+    correlated subquery counting the archived posts of User, for the counters.
+    With a separate archive database the counts are copied into a temporary
+    table of the primary database first.
+    """
+    from app.models import PostArchive, User
+    if not separate():
+        return db.select([db.func.count(PostArchive.id)]).where(
+            PostArchive.user_id == User.id).as_scalar()
+    counts = db.Table('archived_post_count', db.MetaData(),
+                      db.Column('user_id', db.Integer, primary_key=True),
+                      db.Column('count', db.Integer, nullable=False),
+                      prefixes=['TEMPORARY'])
+    connection = db.session.connection()
+    counts.create(connection, checkfirst=True)
+    connection.execute(counts.delete())
+    with engine().connect() as archive_connection:
+        rows = [{'user_id': user_id, 'count': count} for user_id, count in
+                archive_connection.execute(db.select([
+                    PostArchive.user_id, db.func.count()]).group_by(PostArchive.user_id))]
+    if rows:
+        connection.execute(counts.insert(), rows)
+    return db.func.coalesce(db.select([counts.c.count]).where(
+        counts.c.user_id == User.id).as_scalar(), 0)
+
+
+def adapt(clause):
+    """clause with the columns of the post table replaced by those of the archive"""
+    from sqlalchemy.sql.visitors import replacement_traverse
+    from app.models import Post, PostArchive
+    hot, cold = Post.__table__, PostArchive.__table__
+
+    def replace(element):
+        if element is hot:
+            return cold
+        if getattr(element, 'table', None) is hot:
+            return cold.c[element.name]
+        return None
+    return replacement_traverse(clause, {}, replace)
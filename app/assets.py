@@ -0,0 +1,209 @@
+"""
+Self-hosted static assets.
+
+`flask assets build` prepares everything the pages load for serving without
+any CDN:
+* Bootstrap and jQuery are copied from the Flask-Bootstrap package and
+  moment.js is downloaded (or copied, see ASSETS_MOMENT_SOURCE) into
+  app/static/vendor
+* every file in app/static is copied to app/static/dist under a name that
+  contains a hash of its content, url() references in CSS files are rewritten
+  to the hashed names
+* text files get precompressed .gz (and .br if the brotli package is
+  installed) variants next to them
+* app/static/dist/manifest.json maps the original names to the hashed ones
+
+asset_url() (also a template global) resolves a name through the manifest.
+A hashed file never changes, so it is served with a one year, immutable cache
+lifetime, and with the precompressed variant the client accepts. With
+ASSETS_LOCAL set the pages use the vendored Bootstrap, jQuery and moment.js.
+"""
+from hashlib import sha256
+import gzip
+from io import BytesIO
+import json
+import mimetypes
+import os
+import re
+import shutil
+from flask import current_app, request, send_file, url_for
+from werkzeug.security import safe_join
+
+DIST = 'dist'
+VENDOR = 'vendor'
+MANIFEST = 'manifest.json'
+MOMENT = 'vendor/moment/moment-with-locales.min.js'
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html', '.eot', '.ttf')
+# url(...) in CSS, without data: URIs and absolute URLs
+CSS_URL = re.compile(r'''url\(\s*(['"]?)(?!data:|https?:|//|/)([^'")?#]+)([^'")]*)\1\s*\)''')
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, .gz variants only
+    brotli = None
+
+
+def vendor(static_folder, moment_source):
+    """copy Bootstrap, jQuery and moment.js into static_folder/vendor"""
+    import flask_bootstrap
+    target = os.path.join(static_folder, VENDOR)
+    bootstrap_static = os.path.join(os.path.dirname(flask_bootstrap.__file__), 'static')
+    for folder in ('css', 'fonts', 'js'):
+        destination = os.path.join(target, 'bootstrap', folder)
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.copytree(os.path.join(bootstrap_static, folder), destination)
+    os.makedirs(os.path.join(target, 'jquery'), exist_ok=True)
+    shutil.copy(os.path.join(bootstrap_static, 'jquery.min.js'),
+                os.path.join(target, 'jquery', 'jquery.min.js'))
+    moment_path = os.path.join(static_folder, MOMENT)
+    os.makedirs(os.path.dirname(moment_path), exist_ok=True)
+    if moment_source.startswith(('http://', 'https://')):
+        import requests
+        response = requests.get(moment_source, timeout=30)
+        response.raise_for_status()
+        with open(moment_path, 'wb') as moment_file:
+            moment_file.write(response.content)
+    else:
+        shutil.copy(moment_source, moment_path)
+
+
+def hashed_name(name, content):
+    """css/site.css -> css/site.<first 12 hex digits of the sha256>.css"""
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, sha256(content).hexdigest()[:12], ext)
+
+
+def rewrite_css(name, content, manifest):
+    """point relative url() references of the CSS file name at hashed files"""
+    folder = os.path.dirname(name)
+
+    def replace(match):
+        quote, path, suffix = match.groups()
+        target = os.path.normpath(os.path.join(folder, path)).replace(os.sep, '/')
+        if target not in manifest:
+            return match.group(0)
+        # relative to where the rewritten CSS file ends up, below dist/
+        new = os.path.relpath(manifest[target], os.path.join(DIST, folder)).replace(
+            os.sep, '/')
+        return 'url({0}{1}{2}{0})'.format(quote, new, suffix)
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def compress(path, content):
+    """write .gz and .br variants of path if they are worth it"""
+    if not path.endswith(COMPRESSIBLE):
+        return
+    buffer = BytesIO()
+    # mtime=0 keeps the output identical between builds
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gz_file:
+        gz_file.write(content)
+    variants = [('.gz', buffer.getvalue())]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(content) * 0.9:
+            with open(path + suffix, 'wb') as compressed_file:
+                compressed_file.write(compressed)
+
+
+def fingerprint(static_folder):
+    """
+    copy all files of static_folder to static_folder/dist under hashed names
+    Returns
+    -------
+    dict
+        manifest: original name -> hashed name, both relative to static_folder
+    """
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    names = []
+    for folder, _, files in os.walk(static_folder):
+        for filename in files:
+            name = os.path.relpath(os.path.join(folder, filename), static_folder)
+            name = name.replace(os.sep, '/')
+            if not name.startswith(DIST + '/'):
+                names.append(name)
+    manifest = {}
+    # CSS last, its url() references need the hashed names of the other files
+    for name in sorted(names, key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(static_folder, name), 'rb') as source:
+            content = source.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, manifest)
+        manifest[name] = DIST + '/' + hashed_name(name, content)
+        path = os.path.join(static_folder, manifest[name])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as target:
+            target.write(content)
+        compress(path, content)
+    with open(os.path.join(dist, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return manifest
+
+
+def build(app, moment_source=None):
+    """vendor the libraries and fingerprint app/static, returns the manifest"""
+    vendor(app.static_folder, moment_source or app.config['ASSETS_MOMENT_SOURCE'])
+    manifest = fingerprint(app.static_folder)
+    app.extensions['assets'] = manifest
+    return manifest
+
+
+def load_manifest(static_folder):
+    """the manifest written by fingerprint(), empty if assets were not built"""
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def asset_url(filename, **kwargs):
+    """url_for('static', ...) for the fingerprinted version of filename, if there is one"""
+    manifest = current_app.extensions.get('assets', {})
+    return url_for('static', filename=manifest.get(filename, filename), **kwargs)
+
+
+class AssetCDN(object):
+    """Flask-Bootstrap CDN serving the vendored files through asset_url()"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def get_resource_url(self, filename):
+        """URL of a file below prefix"""
+        return asset_url(self.prefix + filename)
+
+
+def init_app(app):
+    """load the manifest, serve fingerprinted files, use vendored libraries with ASSETS_LOCAL"""
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    max_age = app.config['ASSETS_MAX_AGE']
+    send_static_file = app.view_functions['static']
+
+    def static(filename):
+        # everything in dist/ has a hashed name, except the manifest
+        path = safe_join(app.static_folder, filename)
+        if not filename.startswith(DIST + '/') or filename.endswith(MANIFEST) or \
+                path is None or not os.path.isfile(path):
+            return send_static_file(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+            if request.accept_encodings[name] and os.path.exists(path + suffix):
+                path, encoding = path + suffix, name
+                break
+        response = send_file(path, mimetype=mimetype, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        # the name changes with the content, so the file can be cached forever
+        response.headers['Cache-Control'] = 'public, max-age={:d}, immutable'.format(max_age)
+        response.expires = None
+        return response
+    app.view_functions['static'] = static
+    app.add_template_global(asset_url)
+    if app.config['ASSETS_LOCAL']:
+        cdns = app.extensions['bootstrap']['cdns']
+        cdns['bootstrap'] = AssetCDN(VENDOR + '/bootstrap/')
+        cdns['jquery'] = AssetCDN(VENDOR + '/jquery/')
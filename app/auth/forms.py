@@ -5,9 +5,11 @@ Widget instance. The widget’s job is rendering an HTML representation of that
 """
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import ValidationError, DataRequired, Email, EqualTo
+from wtforms.validators import DataRequired, Email, EqualTo
+from flask import current_app
 from flask_babel import _, lazy_gettext as _l
 from app.models import User
+from app import user_index
 
 
 class LoginForm(FlaskForm):
@@ -36,21 +38,27 @@ class RegistrationForm(FlaskForm):
         _l('Repeat Password'), validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField(_l('Register'))
 
-    def __init__(self, *args, **kwargs):
-        FlaskForm.__init__(self, *args, **kwargs)
-        self.user = None
+    def validate(self):
+        """
+        run the stock validators, then check username and email with one lookup.
+        The user index answers for names that are certainly free, otherwise a
+        single query checks both fields.
+        """
+        if not FlaskForm.validate(self):
+            return False
+        index = user_index.get_index(current_app)
+        if not index.maybe_taken(self.username.data, self.email.data):
+            return True
+        taken = User.taken(self.username.data, self.email.data)
+        self.add_taken_errors(taken)
+        return not taken
 
-    def validate_username(self, username):
-        """validate if user is not already in db"""
-        self.user = User.query.filter_by(username=username.data).first()
-        if self.user is not None:
-            raise ValidationError(_('Please use a different username.'))
-
-    def validate_email(self, email):
-        """validate if email is not already in db"""
-        self.user = User.query.filter_by(email=email.data).first()
-        if self.user is not None:
-            raise ValidationError(_('Please use a different email address.'))
+    def add_taken_errors(self, taken):
+        """report fields whose value is already in use"""
+        if 'username' in taken:
+            self.username.errors.append(_('Please use a different username.'))
+        if 'email' in taken:
+            self.email.errors.append(_('Please use a different email address.'))
 
 class ResetPasswordRequestForm(FlaskForm):
     """Password reset form via Email"""
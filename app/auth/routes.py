@@ -2,8 +2,9 @@
 from flask_babel import _
 from werkzeug.urls import url_parse
 from flask_login import login_user, logout_user, current_user
-from flask import render_template, redirect, url_for, flash, request
-from app import db
+from flask import render_template, redirect, url_for, flash, request, current_app
+from sqlalchemy.exc import IntegrityError
+from app import db, ratelimit, user_index
 from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
@@ -15,10 +16,11 @@ from app.auth.email import send_password_reset_email
 def logout():
     """logout user and redirect to index"""
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@ratelimit.limit('login', field='username')
 def login():
     """
     Redirect to login form and check authentication status.
@@ -31,6 +33,7 @@ def login():
     name, then the user is redirected to the index page. The application only redirects when the
     URL is relative in oder to ensure that the redirect stays within the same site as the
     application.
+    Attempts are rate limited per client IP and per username (see app/ratelimit.py).
 
     Returns
     -------
@@ -39,17 +42,17 @@ def login():
 
     """
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
         usern = User.query.filter_by(username=form.username.data).first()
         if usern is None or not usern.check_password(form.password.data):
             flash(_('Invalid username or password'))
-            return redirect(url_for('login'))
+            return redirect(url_for('auth.login'))
         login_user(usern, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
-            next_page = url_for('index')
+            next_page = url_for('main.index')
         return redirect(next_page)
     return render_template('login.html', title=_('Sign In'), form=form)
 
@@ -62,6 +65,8 @@ def register():
     validate_on_submit() conditional creates a new user with the username, email and password
     provided, writes it to the database, and then redirects to the login prompt so that the
     user can log in.
+    The INSERT is optimistic: the form only rules out names that are known to be taken and
+    the unique indexes decide races, an IntegrityError is reported as form error.
 
     Returns
     -------
@@ -70,30 +75,37 @@ def register():
 
     """
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = RegistrationForm()
     if form.validate_on_submit():
         usern = User(username=form.username.data, email=form.email.data)
         usern.set_password(form.password.data)
         db.session.add(usern)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            form.add_taken_errors(User.taken(form.username.data, form.email.data))
+            return render_template('register.html', title=_('Register'), form=form)
+        user_index.get_index(current_app).add(usern.username, usern.email)
         flash(_('Congratulations, you are now a registered user!'))
-        return redirect(url_for('login'))
+        return redirect(url_for('auth.login'))
     return render_template('register.html', title=_('Register'), form=form)
 
 
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
+@ratelimit.limit('reset_password_request', field='email')
 def reset_password_request():
     """View function for PasswordResteForm"""
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = ResetPasswordRequestForm()
     if form.validate_on_submit():
         userm = User.query.filter_by(email=form.email.data).first()
         if userm:
             send_password_reset_email(userm)
         flash(_('Check your email for the instructions to reset your password'))
-        return redirect(url_for('login'))
+        return redirect(url_for('auth.login'))
     return render_template('reset_password_request.html',
                            title=_('Reset Password'), form=form)
 
@@ -102,18 +114,21 @@ def reset_password_request():
 def reset_password(token):
     """
     When the user clicks on the email link password request view function
-    is triggered
+    is triggered. Expired, forged or garbled tokens are turned away before
+    anything, including the session user, is loaded from the database.
     """
+    if User.decode_reset_password_token(token) is None:
+        return redirect(url_for('main.index'))
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
-    # returns the user if the token is valid, or None
+        return redirect(url_for('main.index'))
+    # returns the user if the token is valid and unused, or None
     userv = User.verify_reset_password_token(token)
     if not userv:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
         userv.set_password(form.password.data)
         db.session.commit()
         flash(_('Your password has been reset.'))
-        return redirect(url_for('login'))
+        return redirect(url_for('auth.login'))
     return render_template('reset_password.html', form=form)
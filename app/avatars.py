@@ -0,0 +1,246 @@
+"""
+Avatars served by the application itself.
+
+Every post and profile shows an avatar, which used to be a Gravatar URL: each
+page made the browser contact www.gravatar.com, which is not reachable from
+isolated networks and leaks the visitors to a third party. User.avatar() now
+points to /avatar/<md5 of the email>/<size>, answered here:
+* with AVATAR_UPSTREAM set, the image is fetched from there (a Gravatar style
+  URL template), falling back to the identicon if the upstream has none
+* otherwise an identicon is generated from the digest: a mirrored 5x5 grid in
+  a color taken from the digest, drawn at the requested size as a PNG
+Images are kept in AVATAR_CACHE_DIR, at most AVATAR_CACHE_SIZE bytes; when the
+cache grows past that, the least recently used files are deleted. Responses
+carry a strong ETag and may be cached by browsers for AVATAR_MAX_AGE seconds.
+"""
+import colorsys
+from hashlib import md5
+import os
+import re
+import struct
+import threading
+import zlib
+from flask import abort, current_app, request, url_for
+
+DIGEST = re.compile(r'^[0-9a-f]{32}$')
+GRID = 5
+BACKGROUND = (240, 240, 240)
+# version of the drawing, part of the cached file names
+IDENTICON = 'i1'
+MIMETYPES = ((b'\x89PNG', 'image/png'), (b'\xff\xd8', 'image/jpeg'), (b'GIF8', 'image/gif'))
+
+
+def email_digest(email):
+    """the Gravatar hash of an email address"""
+    return md5((email or '').strip().lower().encode('utf-8')).hexdigest()
+
+
+def url(email, size):
+    """URL of the avatar of email, size pixels wide and high"""
+    return digest_url(email_digest(email), size)
+
+
+def digest_url(digest, size):
+    """url() by the digest of the email"""
+    return url_for('avatar', digest=digest, size=size)
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png(rows, width, palette):
+    """
+    encode a paletted PNG
+    Parameters
+    ----------
+    rows : list
+        one bytes object per pixel row with a palette index per pixel
+    palette : list
+        (r, g, b) tuples
+    """
+    header = struct.pack('>IIBBBBB', width, len(rows), 8, 3, 0, 0, 0)
+    data = b''.join(b'\x00' + row for row in rows)
+    return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', header) + \
+        _chunk(b'PLTE', b''.join(bytes(color) for color in palette)) + \
+        _chunk(b'IDAT', zlib.compress(data, 9)) + _chunk(b'IEND', b'')
+
+
+def identicon(digest, size):
+    """
+    the identicon of a hex digest as a size x size PNG: the first 15 bits choose
+    the filled cells of the left three columns, mirrored to the right, the last
+    bytes the hue. Half a cell of background surrounds the grid.
+    """
+    bits = int(digest[:8], 16)
+    cells = [[bits >> (row * 3 + min(column, GRID - 1 - column)) & 1
+              for column in range(GRID)] for row in range(GRID)]
+    hue = int(digest[-6:-3], 16) / 4096.0
+    color = tuple(int(value * 255) for value in colorsys.hls_to_rgb(hue, 0.55, 0.55))
+    margin = size / (GRID + 1) / 2
+    cell = (size - 2 * margin) / GRID
+
+    def index(position):
+        """grid cell of a pixel position, None in the margin"""
+        found = int((position - margin) // cell) if position >= margin else None
+        return found if found is not None and found < GRID else None
+    columns = [index(x) for x in range(size)]
+    row_bytes = [bytes(cells[row][column] if column is not None else 0
+                       for column in columns) for row in range(GRID)]
+    blank = bytes(size)
+    rows = [row_bytes[row] if row is not None else blank
+            for row in (index(y) for y in range(size))]
+    return png(rows, size, [BACKGROUND, color])
+
+
+def mimetype(content):
+    """image type of content, from its first bytes"""
+    for magic, name in MIMETYPES:
+        if content.startswith(magic):
+            return name
+    return None
+
+
+class DiskCache(object):
+    """
+    files below directory, least recently used ones deleted beyond max_bytes.
+    Reads touch the modification time, which is what eviction sorts by, so the
+    workers sharing the directory share the recency as well.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # bytes in the directory as far as this process knows, counted on first put()
+        self.size = None
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        """file of name, in a subdirectory by its first two characters"""
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, name):
+        """content stored under name, None if there is none"""
+        path = self.path(name)
+        try:
+            with open(path, 'rb') as cached:
+                content = cached.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # missing, or evicted by another worker meanwhile
+            return None
+        return content
+
+    def put(self, name, content):
+        """store content under name, then evict if the cache is too big"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'wb') as cached:
+            cached.write(content)
+        os.replace(temporary, path)
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.files())
+            else:
+                self.size += len(content)
+            if self.size > self.max_bytes:
+                self.size = self.evict(self.max_bytes * 9 // 10)
+
+    def files(self):
+        """(modification time, size, path) of every cached file"""
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def evict(self, target):
+        """delete the least recently used files until at most target bytes are left"""
+        found = sorted(self.files())
+        total = sum(size for _, size, _ in found)
+        for _, size, path in found:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        return total
+
+
+def cache(app):
+    """the DiskCache of app"""
+    disk_cache = app.extensions.get('avatar_cache')
+    if disk_cache is None:
+        disk_cache = app.extensions['avatar_cache'] = DiskCache(
+            app.config['AVATAR_CACHE_DIR'], app.config['AVATAR_CACHE_SIZE'])
+    return disk_cache
+
+
+def fetch(template, digest, size, timeout):
+    """
+    the image of the upstream URL template, None if the upstream has none
+    Raises
+    ------
+    requests.RequestException
+        the upstream could not be reached
+    """
+    import requests
+    response = requests.get(template.format(digest=digest, size=size), timeout=timeout)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.content if mimetype(response.content) else None
+
+
+def load(app, digest, size):
+    """
+    the avatar image of digest at size, from the cache, the upstream or drawn
+    Returns
+    -------
+    tuple
+        (content, cacheable): content is not cacheable if the upstream failed
+    """
+    config = app.config
+    name = '{}-{}-{}'.format(digest, size, IDENTICON if not config['AVATAR_UPSTREAM'] else 'u')
+    content = cache(app).get(name)
+    if content is not None:
+        return content, True
+    if config['AVATAR_UPSTREAM']:
+        import requests
+        try:
+            content = fetch(config['AVATAR_UPSTREAM'], digest, size,
+                            config['AVATAR_UPSTREAM_TIMEOUT'])
+        except requests.RequestException as exc:
+            app.logger.warning('avatar upstream failed: %s', exc)
+            return identicon(digest, size), False
+    if content is None:
+        content = identicon(digest, size)
+    cache(app).put(name, content)
+    return content, True
+
+
+def avatar(digest, size):
+    """view of /avatar/<digest>/<size>"""
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    if not DIGEST.match(digest) or not 1 <= size <= app.config['AVATAR_MAX_SIZE']:
+        abort(404)
+    content, cacheable = load(app, digest, size)
+    response = app.response_class(content, mimetype=mimetype(content))
+    response.set_etag(md5(content).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['AVATAR_MAX_AGE'] if cacheable else 60
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    """serve /avatar/<digest>/<size>"""
+    app.add_url_rule('/avatar/<digest>/<int:size>', 'avatar', avatar)
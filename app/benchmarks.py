@@ -0,0 +1,556 @@
+"""
+Micro benchmarks behind the `flask bench` commands (see app/cli.py).
+They are meant to compare configurations of the same code on the same box,
+absolute numbers are not comparable between machines.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+# executed in a fresh interpreter so import costs are part of the measurement
+STARTUP_SNIPPET = '''
+import time
+start = time.perf_counter()
+from app import create_app
+create_app()
+print(time.perf_counter() - start)
+'''
+
+STARTUP_MODES = {
+    'eager': {},
+    'lazy': {'LAZY_EXTENSIONS': '1'},
+    'lazy+prewarm': {'LAZY_EXTENSIONS': '1', 'PREWARM_CACHES': '1'},
+}
+
+
+def startup(repeat=5):
+    """
+    Time import + create_app() in a new process for every startup mode.
+
+    Returns
+    -------
+    dict
+        mode name -> list of timings in seconds
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for mode, env_vars in STARTUP_MODES.items():
+        env = dict(os.environ)
+        for name in ('LAZY_EXTENSIONS', 'PREWARM_CACHES'):
+            env.pop(name, None)
+        env.update(env_vars)
+        timings = []
+        for _ in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', STARTUP_SNIPPET],
+                                          cwd=root, env=env)
+            timings.append(float(out.decode().strip().splitlines()[-1]))
+        results[mode] = timings
+    return results
+
+
+# the strings every page renders through base.html plus one post
+I18N_SNIPPET = ("{{ _('Home') }} {{ _('Explore') }} {{ _('Profile') }} {{ _('Logout') }}"
+                "{{ _('Translate') }} {{ _('Newer posts') }} {{ _('Older posts') }}"
+                "{{ _('%(username)s said %(when)s', username='susan', when='now') }}")
+
+
+def i18n(app, iterations=2000):
+    """
+    Per-request cost of locale resolution plus the translated strings of a page,
+    for every language in LANGUAGES. 'per-request' is stock Flask-Babel, which
+    loads the catalog of the request locale from disk, 'shared' uses the process
+    wide catalogs installed by app.i18n.activate().
+
+    Returns
+    -------
+    dict
+        (language, mode) -> seconds per request
+    """
+    from app import i18n as fast_path
+    template = app.jinja_env.from_string(I18N_SNIPPET)
+    results = {}
+    for lang in app.config['LANGUAGES']:
+        headers = {'Accept-Language': '{},en;q=0.5'.format(lang)}
+        for mode in ('per-request', 'shared'):
+            start = perf_counter()
+            for _ in range(iterations):
+                with app.test_request_context(headers=headers):
+                    if mode == 'shared':
+                        fast_path.activate()
+                    template.render()
+            results[(lang, mode)] = (perf_counter() - start) / iterations
+    return results
+
+
+def translate(app, texts=200, batch=20):
+    """
+    Translate `texts` distinct sentences in batches twice, the second pass is
+    served from the cache. Reports texts per second of both passes and the
+    metrics of the backend.
+    """
+    from app.translate import get_translator
+    translator = get_translator(app)
+    sentences = ['Guten Morgen Welt Nummer {}'.format(i) for i in range(texts)]
+    result = {}
+    for label in ('cold', 'cached'):
+        start = perf_counter()
+        for i in range(0, texts, batch):
+            translator.translate_batch(sentences[i:i + batch], 'de', 'en')
+        result['{} texts/s'.format(label)] = round(texts / (perf_counter() - start))
+    result.update(translator.metrics)
+    result['backend'] = translator.name
+    return result
+
+
+def tokens(app, iterations=5000):
+    """
+    Password reset token throughput: encoding, stateless decoding of valid
+    tokens and rejection of forged ones (neither of the latter touch the database).
+
+    Returns
+    -------
+    dict
+        operation -> operations per second
+    """
+    from app.models import User
+    user = User(id=1, username='bench', email='bench@example.com')
+    user.set_password('bench')
+    result = {}
+    with app.app_context():
+        start = perf_counter()
+        for _ in range(iterations):
+            token = user.get_reset_password_token()
+        result['encode'] = iterations / (perf_counter() - start)
+        start = perf_counter()
+        for _ in range(iterations):
+            User.decode_reset_password_token(token)
+        result['decode'] = iterations / (perf_counter() - start)
+        forged = token[:-4] + ('AAAA' if not token.endswith('AAAA') else 'BBBB')
+        start = perf_counter()
+        for _ in range(iterations):
+            User.decode_reset_password_token(forged)
+        result['reject forged'] = iterations / (perf_counter() - start)
+    return result
+
+
+def sessions(app, iterations=2000):
+    """
+    Cost of opening a session, reading the user id and saving it, for the
+    signed cookie session and the server side session, with and without a
+    modification (a flashed message).
+
+    Returns
+    -------
+    dict
+        (backend, 'read'/'modified') -> seconds per request, including the
+        constant cost of a test request context
+    """
+    from flask import request
+    from flask.sessions import SecureCookieSessionInterface
+    from app.sessions import ServerSideSessionInterface, SQLiteSessionStore
+    data = {'user_id': '42', '_fresh': True, '_id': 'f' * 128, 'csrf_token': 'c' * 40}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        interfaces = {
+            'cookie': SecureCookieSessionInterface(),
+            'sqlite': ServerSideSessionInterface(
+                SQLiteSessionStore(os.path.join(tmp, 'sessions.db')), gc_every=0),
+        }
+        for backend, interface in interfaces.items():
+            with app.test_request_context():
+                session = interface.open_session(app, request)
+                session.update(data)
+                response = app.response_class()
+                interface.save_session(app, session, response)
+                cookie = response.headers['Set-Cookie'].split(';')[0]
+            for mode in ('read', 'modified'):
+                start = perf_counter()
+                for _ in range(iterations):
+                    with app.test_request_context(headers={'Cookie': cookie}):
+                        session = interface.open_session(app, request)
+                        session.get('user_id')
+                        if mode == 'modified':
+                            session['_flashes'] = [('message', 'Your post is now live!')]
+                        interface.save_session(app, session, app.response_class())
+                results[(backend, mode)] = (perf_counter() - start) / iterations
+    return results
+
+
+def sqlite(seconds=3.0, readers=4, writers=4):
+    """
+    Concurrent reads and small writes on a SQLite file, with the default
+    rollback journal and one commit per write, and with the SQLITE_TUNING
+    pragmas and the writes going through a group committing WriterQueue.
+
+    Returns
+    -------
+    dict
+        (mode, 'reads/s'/'writes/s') -> operations per second
+    """
+    import sqlite3
+    import threading
+    from app.sqlite_tuning import WriterQueue, apply_pragmas, pragmas
+    statements = pragmas({'SQLITE_MMAP_SIZE': 256 * 1024 * 1024, 'SQLITE_BUSY_TIMEOUT': 5000})
+    results = {}
+    for mode in ('default', 'wal+queue'):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            conn = sqlite3.connect(path, isolation_level=None)
+            conn.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, last_seen TEXT)')
+            conn.executemany('INSERT INTO user VALUES (?, ?)',
+                             ((i, '') for i in range(1000)))
+            conn.close()
+            writer = WriterQueue(path, statements) if mode == 'wal+queue' else None
+            counts = {'reads/s': 0, 'writes/s': 0}
+            lock = threading.Lock()
+            stop = threading.Event()
+
+            def connect():
+                conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                       check_same_thread=False)
+                if writer is not None:
+                    apply_pragmas(conn, statements)
+                return conn
+
+            def read():
+                conn, done = connect(), 0
+                while not stop.is_set():
+                    conn.execute('SELECT * FROM user WHERE id = ?', (done % 1000,)).fetchone()
+                    done += 1
+                with lock:
+                    counts['reads/s'] += done
+                conn.close()
+
+            def write():
+                conn, done = connect(), 0
+                while not stop.is_set():
+                    sql, params = 'UPDATE user SET last_seen = ? WHERE id = ?', \
+                        (str(perf_counter()), done % 1000)
+                    if writer is None:
+                        conn.execute(sql, params)
+                    else:
+                        # waits for the commit, like a request that needs its write
+                        writer.submit(sql, params).result()
+                    done += 1
+                with lock:
+                    counts['writes/s'] += done
+                conn.close()
+
+            threads = [threading.Thread(target=read) for _ in range(readers)] + \
+                [threading.Thread(target=write) for _ in range(writers)]
+            for thread in threads:
+                thread.start()
+            stop.wait(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if writer is not None:
+                writer.close()
+            for name, count in counts.items():
+                results[(mode, name)] = count / seconds
+    return results
+
+
+def graph(edges=1000000, users=100000, queries=1000, seed=42):
+    """
+    Build time and query latency of the follower graph index on a synthetic graph:
+    followers pick whom to follow with a skewed popularity (low ids are popular).
+
+    Returns
+    -------
+    dict
+        measurement -> value; times in milliseconds
+    """
+    import random
+    from app.graph import FollowerGraph
+    rng = random.Random(seed)
+    pairs = [(rng.randrange(users), int(users * rng.random() ** 3)) for _ in range(edges)]
+    start = perf_counter()
+    follower_graph = FollowerGraph.from_edges(pair for pair in pairs if pair[0] != pair[1])
+    result = {'build ms': (perf_counter() - start) * 1000,
+              'edges': follower_graph.edge_count,
+              'array MB': sum(len(values) * values.itemsize for values in (
+                  follower_graph.out_offsets, follower_graph.out_targets,
+                  follower_graph.in_offsets, follower_graph.in_sources)) / 2 ** 20}
+    sample = [rng.randrange(users) for _ in range(queries)]
+    measurements = (
+        ('is_following ms', lambda user_id: follower_graph.is_following(user_id, 1)),
+        ('follower_count ms', follower_graph.follower_count),
+        ('who_to_follow ms', follower_graph.who_to_follow),
+        ('reach ms', follower_graph.reach),
+    )
+    for name, query in measurements:
+        start = perf_counter()
+        for user_id in sample:
+            query(user_id)
+        result[name] = (perf_counter() - start) * 1000 / queries
+    start = perf_counter()
+    for user_id in sample:
+        follower_graph.follow(user_id, (user_id + 1) % users)
+    result['follow ms'] = (perf_counter() - start) * 1000 / queries
+    return result
+
+
+def pages(app, username, path='/index', repeat=20):
+    """
+    Time to first byte, total time and transferred bytes of a page for a logged in
+    user, rendered at once or streamed (STREAM_TEMPLATES), sent uncompressed or
+    compressed by CompressionMiddleware.
+
+    Returns
+    -------
+    dict
+        (rendering, encoding) -> (first byte ms, total ms, bytes), medians
+    """
+    from statistics import median
+    from app.compression import CompressionMiddleware, brotli
+    from app.models import User
+    with app.app_context():
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise ValueError('no user {}'.format(username))
+        user_id = str(user.id)
+    wsgi_app = app.wsgi_app
+    streaming = app.config['STREAM_TEMPLATES']
+    encodings = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+    results = {}
+    try:
+        app.wsgi_app = CompressionMiddleware(wsgi_app, app.config['COMPRESS_LEVEL'],
+                                             app.config['COMPRESS_MIN_SIZE'])
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['_fresh'] = True
+        for rendering in ('render', 'stream'):
+            app.config['STREAM_TEMPLATES'] = rendering == 'stream'
+            # an error page or a redirect to the login would be timed instead
+            response = client.get(path)
+            response.close()
+            if response.status_code != 200:
+                raise ValueError('{} {}: {}'.format(rendering, path, response.status))
+            for encoding in encodings:
+                timings = []
+                for _ in range(repeat):
+                    start = perf_counter()
+                    response = client.get(path, headers={'Accept-Encoding': encoding})
+                    size, first = 0, None
+                    for chunk in response.response:
+                        if first is None:
+                            first = perf_counter() - start
+                        size += len(chunk)
+                    response.close()
+                    timings.append((first or 0, perf_counter() - start, size))
+                results[(rendering, encoding)] = (median(t[0] for t in timings) * 1000,
+                                                  median(t[1] for t in timings) * 1000,
+                                                  median(t[2] for t in timings))
+    finally:
+        app.wsgi_app = wsgi_app
+        app.config['STREAM_TEMPLATES'] = streaming
+    return results
+
+
+# worker models compared by servers(), the environment of each boot.py run
+SERVER_MODELS = {
+    'sync': {'SERVER_WORKER_CLASS': 'sync'},
+    'gthread': {'SERVER_WORKER_CLASS': 'gthread'},
+    'gevent': {'SERVER_WORKER_CLASS': 'gevent'},
+}
+
+
+def seed(app, users=100, posts=20, follows=10, seed_value=42):
+    """fill the database of app with users following each other and their posts"""
+    import random
+    from app import db
+    from app.models import User
+    rng = random.Random(seed_value)
+    with app.app_context():
+        db.create_all()
+        accounts = [User(username='user{}'.format(n), email='user{}@example.com'.format(n))
+                    for n in range(users)]
+        db.session.add_all(accounts)
+        db.session.flush()
+        for account in accounts:
+            for other in rng.sample(accounts, follows):
+                if other is not account:
+                    account.follow(other)
+            for number in range(posts):
+                account.add_post('post {} of {}'.format(number, account.username), 'en')
+        db.session.commit()
+
+
+def servers(seconds=10, concurrency=16, workers=2, threads=4,
+            paths=('/index', '/explore', '/api/v1/explore')):
+    """
+    Requests per second and latency of the seeded app served by boot.py with every
+    worker model in SERVER_MODELS, under concurrency keep-alive clients that are
+    logged in and request paths in turn. gevent is skipped if it's not installed.
+    The clients run in this process, on a small machine they can be the limit.
+    A response other than 200 or a failed connection aborts the run with a
+    RuntimeError, as the timings would not be those of the pages.
+
+    Returns
+    -------
+    dict
+        model -> {'requests/s', 'p50 ms', 'p99 ms'}
+    """
+    import http.client
+    import importlib.util
+    import socket
+    import threading
+    from config import Config
+    from app import create_app
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+
+        class BenchConfig(Config):
+            """the seeded database"""
+            SQLALCHEMY_DATABASE_URI = uri
+        app = create_app(BenchConfig)
+        seed(app)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = '1'
+            session['_fresh'] = True
+        cookie = '; '.join('{}={}'.format(item.name, item.value) for item in client.cookie_jar)
+        for model, env_vars in SERVER_MODELS.items():
+            if model == 'gevent' and importlib.util.find_spec('gevent') is None:
+                continue
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            env = dict(os.environ, DATABASE_URL=uri, SERVER_BIND='127.0.0.1:{}'.format(port),
+                       SERVER_WORKERS=str(workers), SERVER_THREADS=str(threads), **env_vars)
+            server = subprocess.Popen([sys.executable, 'boot.py', '--skip-setup'], cwd=root,
+                                      env=env, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+            try:
+                deadline = perf_counter() + 30
+                while True:
+                    try:
+                        socket.create_connection(('127.0.0.1', port), 1).close()
+                        break
+                    except OSError:
+                        if perf_counter() > deadline or server.poll() is not None:
+                            raise RuntimeError('{} server did not start'.format(model))
+                        sleep(0.2)
+                # a redirect to the login or an error page would be timed instead
+                for path in paths:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                    connection.request('GET', path, headers={'Cookie': cookie})
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                    if response.status != 200:
+                        raise RuntimeError('{} server: GET {} answered {} {}'.format(
+                            model, path, response.status, response.reason))
+                latencies, errors = [], []
+                stop = perf_counter() + seconds
+
+                def load(offset):
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                    own, failed, number = [], 0, offset
+                    while perf_counter() < stop:
+                        start = perf_counter()
+                        try:
+                            connection.request('GET', paths[number % len(paths)],
+                                               headers={'Cookie': cookie})
+                            response = connection.getresponse()
+                            response.read()
+                            if response.status != 200:
+                                failed += 1
+                        except (OSError, http.client.HTTPException):
+                            failed += 1
+                            connection.close()
+                        own.append(perf_counter() - start)
+                        number += 1
+                    connection.close()
+                    latencies.extend(own)
+                    errors.append(failed)
+                clients = [threading.Thread(target=load, args=(n,)) for n in range(concurrency)]
+                for thread in clients:
+                    thread.start()
+                for thread in clients:
+                    thread.join()
+                if sum(errors):
+                    raise RuntimeError('{} server: {} of {} requests failed'.format(
+                        model, sum(errors), len(latencies)))
+                latencies.sort()
+                results[model] = {
+                    'requests/s': len(latencies) / seconds,
+                    'p50 ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                    'p99 ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+                }
+            finally:
+                server.terminate()
+                server.wait()
+    return results
+
+
+def views(users=100, posts=20, follows=10, per_page=25, repeat=200):
+    """
+    Home timeline pages of a seeded database, loaded as Post models with lazy
+    loaded User authors or as PostView objects (see app/post_view.py). Each page
+    reads what _post.html reads and ends the session, like a request.
+    Memory is what tracemalloc counts as allocated while the pages are held.
+
+    Returns
+    -------
+    dict
+        path -> {'rows/s', 'queries/page', 'KB/page'}
+    """
+    import tracemalloc
+    from sqlalchemy import event
+    from config import Config
+    from app import create_app, db
+    from app.post_view import views as post_views
+    from app.models import User
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+
+        class BenchConfig(Config):
+            """the seeded database"""
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app = create_app(BenchConfig)
+        seed(app, users, posts, follows)
+        statements = []
+        with app.test_request_context():
+            event.listen(db.engine, 'before_cursor_execute',
+                         lambda *args: statements.append(None))
+            page_count = max(1, User.query.get(1).followed_posts_count() // per_page)
+            for name, project in (('orm', lambda query: query), ('view', post_views)):
+
+                def load(number):
+                    user = User.query.get(1)
+                    page = project(user.followed_posts()).limit(per_page).offset(
+                        number % page_count * per_page).all()
+                    for post in page:
+                        post.author.avatar(70)
+                        post.author.username  # pylint: disable=W0104
+                    db.session.remove()
+                    return page
+                load(0)
+                del statements[:]
+                rows = 0
+                start = perf_counter()
+                for number in range(repeat):
+                    rows += len(load(number))
+                elapsed = perf_counter() - start
+                queries = len(statements) / repeat
+                sizes = []
+                # the pages kept minus the pages dropped, without what the loading caches
+                for keep in (True, False):
+                    tracemalloc.start()
+                    before = tracemalloc.get_traced_memory()[0]
+                    held = [load(number) if keep else load(number) and None
+                            for number in range(page_count)]
+                    sizes.append(tracemalloc.get_traced_memory()[0] - before)
+                    tracemalloc.stop()
+                    del held
+                results[name] = {'rows/s': rows / elapsed, 'queries/page': queries,
+                                 'KB/page': (sizes[0] - sizes[1]) / 1024 / page_count}
+    return results
+
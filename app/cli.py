@@ -13,13 +13,51 @@ Usage:
 (venv) $ flask translate init <language-code>
 (venv) $ flask translate update
 (venv) $ flask translate compile
+(venv) $ flask translate serve
+(venv) $ flask bench translate
+(venv) $ flask bench tokens
+(venv) $ flask bench sessions
+(venv) $ flask bench sqlite
+(venv) $ flask templates compile
+(venv) $ flask assets build
+(venv) $ flask errors build
+(venv) $ flask sessions gc
+(venv) $ flask cache invalidate <namespace>
+(venv) $ flask counters reconcile
+(venv) $ flask backfill run post-language
+(venv) $ flask posts archive --older-than <days>
+(venv) $ flask graph rebuild
+(venv) $ flask bench graph
+(venv) $ flask bench pages <username>
+(venv) $ flask bench views
+(venv) $ flask bench servers
+(venv) $ flask bench startup
+(venv) $ flask bench i18n
 """
 import os
+import subprocess
+import sys
 import click
+from app import lazy, online_migrations
+
+TRANSLATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translations')
+
+
+def compile_translations(directory=TRANSLATIONS):
+    """
+    compile the catalogs of all languages, also used by boot.py. Runs pybabel
+    through the current interpreter, so it works without an activated virtualenv.
+    """
+    if subprocess.call([sys.executable, '-m', 'babel.messages.frontend',
+                        'compile', '-d', directory]):
+        raise RuntimeError('compile command failed')
 
 
 def register(app):
     """register app module"""
+    # the `flask db` commands need Flask-Migrate, which lazy mode defers
+    lazy.ensure(app, 'migrate')
+
     @app.cli.group()
     def translate():
         """Translation and localization commands."""
@@ -48,5 +86,266 @@ def register(app):
     @translate.command()
     def compile():
         """Compile all languages."""
-        if os.system('pybabel compile -d app/translations'):
-            raise RuntimeError('compile command failed')
+        compile_translations()
+
+    @translate.command()
+    @click.option('--host', default='127.0.0.1')
+    @click.option('--port', default=5001)
+    def serve(host, port):
+        """Run the asynchronous translation endpoint."""
+        from aiohttp import web
+        from app.translate_service import create_service
+        web.run_app(create_service(app), host=host, port=port)
+
+    @app.cli.group()
+    def templates():
+        """Template cache commands."""
+        pass
+
+    @templates.command('compile')
+    def compile_templates():
+        """Precompile all templates into the bytecode cache."""
+        from app import template_cache
+        if not app.config['TEMPLATE_CACHE']:
+            raise click.UsageError('TEMPLATE_CACHE is not configured')
+        names = template_cache.compile_all(app)
+        click.echo('compiled {} templates'.format(len(names)))
+
+    @app.cli.group()
+    def assets():
+        """Static asset commands."""
+        pass
+
+    @assets.command()
+    @click.option('--moment-source', default=None,
+                  help='URL or file of moment-with-locales.min.js.')
+    def build(moment_source):
+        """Vendor Bootstrap, jQuery and moment.js, fingerprint and compress app/static."""
+        from app import assets as static_assets
+        manifest = static_assets.build(app, moment_source)
+        click.echo('fingerprinted {} files into {}'.format(
+            len(manifest), os.path.join(app.static_folder, static_assets.DIST)))
+
+    @app.cli.group()
+    def errors():
+        """Error page commands."""
+        pass
+
+    @errors.command('build')
+    def build_errors():
+        """Pre-render the 404, 500 and 503 pages in all languages."""
+        from app.errors import pages
+        written = pages.build(app)
+        click.echo('rendered {} error pages into {}'.format(
+            len(written), app.config['ERROR_PAGES_DIR']))
+
+    @app.cli.group()
+    def cache():
+        """Shared cache commands."""
+        pass
+
+    @cache.command()
+    @click.argument('namespace')
+    def invalidate(namespace):
+        """Make all entries of a namespace stale, e.g. translate."""
+        from app import shared_cache
+        shared_cache.get_cache(app).invalidate(namespace)
+        click.echo('invalidated {}'.format(namespace))
+
+    @app.cli.group()
+    def sessions():
+        """Server side session commands."""
+        pass
+
+    @sessions.command()
+    @click.option('--batch', default=1000, help='Sessions deleted per statement.')
+    def gc(batch):
+        """Delete all expired server side sessions."""
+        store = getattr(app.session_interface, 'store', None)
+        if store is None:
+            raise click.UsageError('SESSION_BACKEND is not a server side backend')
+        total = deleted = store.gc(batch)
+        while deleted == batch:
+            deleted = store.gc(batch)
+            total += deleted
+        click.echo('deleted {} expired sessions'.format(total))
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    @click.option('--batch', default=1000, help='Users updated per statement.')
+    def reconcile(batch):
+        """Recompute post and follower counters that drifted."""
+        from app.models import User
+        repaired = User.reconcile_counters(batch)
+        click.echo('repaired the counters of {} users'.format(repaired))
+
+    @app.cli.group()
+    def posts():
+        """Post storage commands."""
+        pass
+
+    @posts.command('archive')
+    @click.option('--older-than', type=int, default=None,
+                  help='Age in days, default POSTS_ARCHIVE_DAYS.')
+    @click.option('--batch-size', default=1000, help='Posts moved per transaction.')
+    @click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+    def archive_posts(older_than, batch_size, pause):
+        """Move old posts to the archive table or database."""
+        from app import archive
+        days = app.config['POSTS_ARCHIVE_DAYS'] if older_than is None else older_than
+        moved = archive.archive_older_than(
+            days, batch_size, pause,
+            lambda moved: click.echo('\r{} posts moved'.format(moved), nl=False))
+        click.echo('\narchived {} posts older than {} days'.format(moved, days))
+
+    @app.cli.group()
+    def backfill():
+        """Resumable data backfills (see app/online_migrations.py)."""
+        pass
+
+    @backfill.command('run')
+    @click.argument('name', type=click.Choice(sorted(online_migrations.BACKFILLS)))
+    @click.option('--batch-size', default=1000, help='Rows updated per transaction.')
+    @click.option('--pause', default=0.1, help='Seconds to sleep between batches.')
+    @click.option('--restart', is_flag=True, help='Start over instead of resuming.')
+    def backfill_run(name, batch_size, pause, restart):
+        """Run a backfill, continuing where an interrupted run stopped."""
+        from app import db
+
+        def progress(position, last, updated, rate):
+            click.echo('\rkey {} of {}, {} rows updated, {:.0f} rows/s'.format(
+                position, last, updated, rate), nl=False)
+        job = online_migrations.BACKFILLS[name](batch_size, pause)
+        with db.engine.connect() as connection:
+            updated = job.run(connection, restart, progress)
+        click.echo('\n{}: {} rows updated'.format(name, updated))
+
+    @app.cli.group()
+    def graph():
+        """Follower graph index commands."""
+        pass
+
+    @graph.command()
+    def rebuild():
+        """Build the follower graph index and write the GRAPH_SNAPSHOT file."""
+        from time import perf_counter
+        from app import graph as follower_graph
+        start = perf_counter()
+        index = follower_graph.build(app)
+        click.echo('{} users, {} edges in {:.0f} ms'.format(
+            index.size, index.edge_count, (perf_counter() - start) * 1000))
+        if app.config['GRAPH_SNAPSHOT']:
+            index.save(app.config['GRAPH_SNAPSHOT'])
+            click.echo('wrote {}'.format(app.config['GRAPH_SNAPSHOT']))
+
+    @app.cli.group()
+    def bench():
+        """Performance benchmarks."""
+        pass
+
+    @bench.command()
+    @click.option('--repeat', default=5, help='Number of cold starts to time.')
+    def startup(repeat):
+        """Time cold application startup, eager vs lazy."""
+        from app import benchmarks
+        for mode, timings in benchmarks.startup(repeat).items():
+            click.echo('{:<16} best {:7.1f} ms   median {:7.1f} ms'.format(
+                mode, min(timings) * 1000, sorted(timings)[len(timings) // 2] * 1000))
+
+    @bench.command('i18n')
+    @click.option('--iterations', default=2000, help='Requests per language and mode.')
+    def bench_i18n(iterations):
+        """Per-request i18n overhead for each configured language."""
+        from app import benchmarks
+        for (lang, mode), seconds in sorted(benchmarks.i18n(app, iterations).items()):
+            click.echo('{:<4} {:<12} {:8.1f} us/request'.format(lang, mode, seconds * 1e6))
+
+    @bench.command('translate')
+    @click.option('--texts', default=200, help='Distinct texts to translate.')
+    @click.option('--batch', default=20, help='Texts per backend call.')
+    def bench_translate(texts, batch):
+        """Throughput and cache behaviour of the configured translation backend."""
+        from app import benchmarks
+        result = benchmarks.translate(app, texts, batch)
+        for name, value in sorted(result.items()):
+            click.echo('{:<16} {}'.format(name, value))
+
+    @bench.command('tokens')
+    @click.option('--iterations', default=5000)
+    def bench_tokens(iterations):
+        """Password reset token encode/decode throughput."""
+        from app import benchmarks
+        for name, rate in benchmarks.tokens(app, iterations).items():
+            click.echo('{:<14} {:10.0f} tokens/s'.format(name, rate))
+
+    @bench.command('sessions')
+    @click.option('--iterations', default=2000)
+    def bench_sessions(iterations):
+        """Per-request session overhead, cookie vs server side."""
+        from app import benchmarks
+        for (backend, mode), seconds in sorted(benchmarks.sessions(app, iterations).items()):
+            click.echo('{:<8} {:<10} {:8.1f} us/request'.format(backend, mode, seconds * 1e6))
+
+    @bench.command('sqlite')
+    @click.option('--seconds', default=3.0)
+    @click.option('--readers', default=4)
+    @click.option('--writers', default=4)
+    def bench_sqlite(seconds, readers, writers):
+        """Concurrent SQLite reads/writes, default journal vs WAL + writer queue."""
+        from app import benchmarks
+        for (mode, name), rate in sorted(benchmarks.sqlite(seconds, readers, writers).items()):
+            click.echo('{:<10} {:10.0f} {}'.format(mode, rate, name))
+
+    @bench.command('graph')
+    @click.option('--edges', default=1000000)
+    @click.option('--users', default=100000)
+    @click.option('--queries', default=1000)
+    def bench_graph(edges, users, queries):
+        """Follower graph index build time and query latency."""
+        from app import benchmarks
+        for name, value in benchmarks.graph(edges, users, queries).items():
+            click.echo('{:<18} {:12.3f}'.format(name, value))
+
+    @bench.command('pages')
+    @click.argument('username')
+    @click.option('--path', default='/index')
+    @click.option('--repeat', default=20)
+    def bench_pages(username, path, repeat):
+        """First byte, total time and size of a page, rendered vs streamed, per encoding."""
+        from app import benchmarks
+        click.echo('{:<8} {:<9} {:>10} {:>10} {:>8}'.format(
+            'page', 'encoding', 'first ms', 'total ms', 'bytes'))
+        for (rendering, encoding), (first, total, size) in sorted(
+                benchmarks.pages(app, username, path, repeat).items()):
+            click.echo('{:<8} {:<9} {:10.2f} {:10.2f} {:8.0f}'.format(
+                rendering, encoding, first, total, size))
+
+    @bench.command('views')
+    @click.option('--users', default=100)
+    @click.option('--per-page', default=25)
+    @click.option('--repeat', default=200)
+    def bench_views(users, per_page, repeat):
+        """Timeline pages as ORM models vs PostView objects: rows/s and memory."""
+        from app import benchmarks
+        click.echo('{:<5} {:>10} {:>13} {:>8}'.format('path', 'rows/s', 'queries/page',
+                                                      'KB/page'))
+        for name, result in benchmarks.views(users, per_page=per_page, repeat=repeat).items():
+            click.echo('{:<5} {:10.0f} {:13.1f} {:8.1f}'.format(
+                name, result['rows/s'], result['queries/page'], result['KB/page']))
+
+    @bench.command('servers')
+    @click.option('--seconds', default=10.0)
+    @click.option('--concurrency', default=16)
+    @click.option('--workers', default=2)
+    @click.option('--threads', default=4)
+    def bench_servers(seconds, concurrency, workers, threads):
+        """Throughput and latency of boot.py per worker model on a seeded database."""
+        from app import benchmarks
+        click.echo('{:<8} {:>11} {:>8} {:>8}'.format('model', 'requests/s', 'p50 ms', 'p99 ms'))
+        for model, result in benchmarks.servers(seconds, concurrency, workers, threads).items():
+            click.echo('{:<8} {:11.1f} {:8.2f} {:8.2f}'.format(
+                model, result['requests/s'], result['p50 ms'], result['p99 ms']))
@@ -0,0 +1,139 @@
+"""
+Response compression.
+
+CompressionMiddleware wraps the WSGI application and compresses text
+responses with brotli (if the brotli package is installed) or gzip, whichever
+the client prefers in Accept-Encoding. Pages full of repeated post markup
+shrink to a fraction of their size.
+* responses with a body list of known length are compressed in one go and
+  get a correct Content-Length
+* streamed responses (app/streaming.py) are compressed chunk by chunk, every
+  chunk is flushed so it reaches the client right away instead of waiting in
+  the compressor's window
+* responses that are already encoded (precompressed assets), small, not text,
+  or marked no-transform are passed through unchanged
+"""
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml')
+
+
+class Compressor(object):
+    """incremental compressor with a flush per chunk, for 'gzip' or 'br'"""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            # wbits 16 + 15: gzip container instead of raw zlib
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, flush=True):
+        """compressed bytes for data, everything so far is decodable if flush"""
+        if self.encoding == 'br':
+            out = self._compressor.process(data)
+            return out + self._compressor.flush() if flush else out
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self):
+        """the end of the compressed stream"""
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header value"""
+    if not accept_encoding:
+        return None
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return parse_accept_header(accept_encoding).best_match(offered)
+
+
+def compressible(status, headers, min_size):
+    """True if a response with status and headers should be compressed"""
+    if int(status.split(None, 1)[0]) in (204, 206, 304) or 'Content-Encoding' in headers:
+        return False
+    if 'no-transform' in headers.get('Cache-Control', ''):
+        return False
+    if not headers.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+        return False
+    length = headers.get('Content-Length')
+    return length is None or int(length) >= min_size
+
+
+class CompressionMiddleware(object):
+    """
+    WSGI middleware compressing responses.
+    Parameters
+    ----------
+    app : callable
+        the WSGI application, usually flask_app.wsgi_app
+    level : int
+        compression level, 1 (fast) to 9 (small)
+    min_size : int
+        bodies shorter than this many bytes are sent as they are
+    """
+
+    def __init__(self, app, level=6, min_size=500):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return self.app(environ, start_response)
+        state = {}
+
+        def compressing_start_response(status, response_headers, exc_info=None):
+            headers = Headers(response_headers)
+            vary = headers.get('Vary')
+            if not vary:
+                headers['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower():
+                headers['Vary'] = vary + ', Accept-Encoding'
+            state['compress'] = compressible(status, headers, self.min_size)
+            state['start'] = (status, headers, exc_info)
+            if not state['compress']:
+                return start_response(status, headers.to_wsgi_list(), exc_info)
+            # the headers are sent with the first chunk, once it is known if the
+            # body has a length, see below
+            return lambda data: None
+
+        app_iter = self.app(environ, compressing_start_response)
+        if not state.get('compress'):
+            return app_iter
+        status, headers, exc_info = state['start']
+        headers['Content-Encoding'] = encoding
+        compressor = Compressor(encoding, self.level)
+        if isinstance(app_iter, (list, tuple)):
+            body = compressor.compress(b''.join(app_iter), flush=False) + compressor.finish()
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+        headers.pop('Content-Length', None)
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return self._stream(app_iter, compressor)
+
+    @staticmethod
+    def _stream(app_iter, compressor):
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            # ends stream_with_context and the request teardown
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -10,7 +10,7 @@ current_app._get_current_object()
 from threading import Thread
 from flask_mail import Message
 from flask import current_app
-from app import mail
+from app import mail, lazy
 
 def send_async_email(app, msg):
     """
@@ -24,6 +24,8 @@ def send_async_email(app, msg):
 
 def send_email(subject, sender, recipients, text_body, html_body):
     """simple mail helper function for sending out mails withou CC and BCC"""
+    # in lazy mode Flask-Mail is configured when the first email goes out
+    lazy.ensure(current_app, 'mail')
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
@@ -1,17 +1,30 @@
-"""Error handler for flask (works similar to view functions)"""
-from flask import render_template
-from app import app, db
+"""
+Error handler for flask (works similar to view functions).
+The pages are pre-rendered (see app/errors/pages.py), so handling an error
+does not touch the database.
+"""
+from flask import current_app
+from app.errors import bp, pages
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found_error(error):
     """HTTP 404 not found error"""
-    return render_template('404.html'), 404
+    return pages.response(404)
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
-    """The error handler for http 500 errors should be invoked after a database errors"""
-    # rollback in order to avoid inference of db sessions with template access
-    db.session.rollback()
-    return render_template('500.html'), 500
+    """
+    The error handler for http 500 errors should be invoked after a database errors.
+    The failed session is rolled back by Flask-SQLAlchemy when the app context ends.
+    """
+    return pages.response(500)
+
+
+@bp.app_errorhandler(503)
+def unavailable_error(error):
+    """HTTP 503, e.g. abort(503) while a dependency is down"""
+    response = pages.response(503)
+    response.headers['Retry-After'] = str(current_app.config['ADMISSION_RETRY_AFTER'])
+    return response
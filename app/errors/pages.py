@@ -0,0 +1,105 @@
+"""
+Pre-rendered error pages.
+
+The error pages extend base.html like every other page, but rendering them
+while handling an error would need current_user, which loads the user from
+the database, the very thing that is likely to be failing. So the 404, 500
+and 503 pages are rendered ahead of time for an anonymous visitor, once per
+language of LANGUAGES, and served as they are:
+* `flask errors build` (run by boot.py) writes them to ERROR_PAGES_DIR
+* each process reads a page from there on first use and keeps it in memory,
+  app.extensions['error_pages']
+* a page that was not built is rendered for an anonymous visitor in a request
+  context of its own on first use instead; PREWARM_CACHES renders all of them in
+  create_app().
+"""
+import os
+from flask import current_app, g, render_template, _app_ctx_stack
+from app import i18n
+
+CODES = (404, 500, 503)
+
+
+def path(app, code, locale):
+    """file of the page for code in locale"""
+    return os.path.join(app.config['ERROR_PAGES_DIR'], '{}.{}.html'.format(code, locale))
+
+
+def render(app, code, locale):
+    """the page for code in locale as seen by an anonymous visitor, as bytes"""
+    context = _app_ctx_stack.top
+    if context is None or context.app is not app:
+        with app.app_context():
+            return _render(app, code, locale)
+    # Popping a new app context would remove the database session of the request
+    # being handled, so render in this one, with a g of its own for the page.
+    outer_g, context.g = context.g, app.app_ctx_globals_class()
+    try:
+        return _render(app, code, locale)
+    finally:
+        context.g = outer_g
+
+
+def _render(app, code, locale):
+    # a request context of its own: current_user of a request being handled stays untouched
+    with app.test_request_context(headers={'Accept-Language': locale}):
+        i18n.activate()
+        return render_template('{}.html'.format(code)).encode('utf-8')
+
+
+def build(app):
+    """
+    render all pages in all LANGUAGES into ERROR_PAGES_DIR and into memory
+    Returns
+    -------
+    list
+        the files written
+    """
+    os.makedirs(app.config['ERROR_PAGES_DIR'], exist_ok=True)
+    pages = app.extensions.setdefault('error_pages', {})
+    written = []
+    for code in CODES:
+        for locale in app.config['LANGUAGES']:
+            filename = path(app, code, locale)
+            pages[(code, locale)] = render(app, code, locale)
+            # replaced in one step, workers may be reading the old file
+            with open(filename + '.tmp', 'wb') as page_file:
+                page_file.write(pages[(code, locale)])
+            os.replace(filename + '.tmp', filename)
+            written.append(filename)
+    return written
+
+
+def page(app, code, locale):
+    """the page for code in locale: from memory, from ERROR_PAGES_DIR or rendered"""
+    pages = app.extensions.setdefault('error_pages', {})
+    content = pages.get((code, locale))
+    if content is None:
+        try:
+            with open(path(app, code, locale), 'rb') as page_file:
+                content = page_file.read()
+        except IOError:
+            content = render(app, code, locale)
+        pages[(code, locale)] = content
+    return content
+
+
+def locale_for(app, accept_language):
+    """best language of LANGUAGES for an Accept-Language header value"""
+    return i18n.best_locale(accept_language or '', tuple(app.config['LANGUAGES'])) or \
+        app.config['BABEL_DEFAULT_LOCALE']
+
+
+def load_all(app):
+    """read or render every page into memory, returns how many there are"""
+    for code in CODES:
+        for locale in app.config['LANGUAGES']:
+            page(app, code, locale)
+    return len(app.extensions['error_pages'])
+
+
+def response(code):
+    """the page for code in the language of the current request"""
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    locale = g.get('locale') or i18n.request_locale() or app.config['BABEL_DEFAULT_LOCALE']
+    return app.response_class(page(app, code, locale), status=code, mimetype='text/html')
@@ -0,0 +1,307 @@
+"""
+In-memory index of the follower graph.
+
+The followers table is loaded into compressed sparse row (CSR) arrays: for
+every user id the ids of the users it follows are stored in one contiguous,
+sorted slice of a single integer array, found through an offsets array, and the
+same again for the followers of every user. A million edges take about 8 MB
+and a lookup is two array reads instead of a query, which makes
+friends-of-friends suggestions and reach estimates cheap enough to compute per
+request.
+
+Follows and unfollows in this process are applied incrementally as small
+per-user delta sets on top of the arrays. The graph is rebuilt (compacted) once
+the deltas grow large, and after GRAPH_MAX_AGE seconds so that changes made
+by other workers show up. `flask graph rebuild` writes a snapshot file
+(GRAPH_SNAPSHOT) that workers load instead of querying the whole table.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import os
+import struct
+from time import time
+
+_HEADER = struct.Struct('<4sII')
+_MAGIC = b'FGv1'
+_LOW = 0xffffffff
+
+
+def _csr(size, keys):
+    """
+    offsets and values for sorted keys packing (node << 32 | neighbour), which
+    sort much faster than tuples
+    """
+    counts = array('i', [0]) * (size + 1)
+    for key in keys:
+        counts[(key >> 32) + 1] += 1
+    for node in range(size):
+        counts[node + 1] += counts[node]
+    return counts, array('i', (key & _LOW for key in keys))
+
+
+class FollowerGraph(object):
+    """
+    Follower graph in CSR arrays with incremental updates.
+    Parameters
+    ----------
+    size : int
+        one more than the largest user id in the arrays
+    out_offsets, out_targets : array
+        users followed by user n: out_targets[out_offsets[n]:out_offsets[n + 1]]
+    in_offsets, in_sources : array
+        followers of user n, same layout
+    built : float
+        time the data was read from the database
+    """
+
+    def __init__(self, size, out_offsets, out_targets, in_offsets, in_sources, built=None):
+        # pylint: disable=R0913
+        self.size = size
+        self.out_offsets = out_offsets
+        self.out_targets = out_targets
+        self.in_offsets = in_offsets
+        self.in_sources = in_sources
+        self.built = time() if built is None else built
+        self.changes = 0
+        self._added = (defaultdict(set), defaultdict(set))
+        self._removed = (defaultdict(set), defaultdict(set))
+        self._popular = None
+
+    @classmethod
+    def from_edges(cls, edges, built=None):
+        """build from (follower_id, followed_id) pairs in any order"""
+        keys = sorted({follower << 32 | followed for follower, followed in edges})
+        size = max((max(key >> 32, key & _LOW) for key in keys), default=0) + 1
+        out_offsets, out_targets = _csr(size, keys)
+        keys = sorted((key & _LOW) << 32 | key >> 32 for key in keys)
+        in_offsets, in_sources = _csr(size, keys)
+        return cls(size, out_offsets, out_targets, in_offsets, in_sources, built)
+
+    @property
+    def edge_count(self):
+        """number of follow relations"""
+        added = sum(len(targets) for targets in self._added[0].values())
+        removed = sum(len(targets) for targets in self._removed[0].values())
+        return len(self.out_targets) + added - removed
+
+    @property
+    def stale(self):
+        """True once the deltas are big enough to be worth a compaction"""
+        return self.changes > max(1000, len(self.out_targets) // 10)
+
+    def _slice(self, direction, node):
+        offsets, values = ((self.out_offsets, self.out_targets),
+                           (self.in_offsets, self.in_sources))[direction]
+        if node >= self.size:
+            return values[0:0]
+        return values[offsets[node]:offsets[node + 1]]
+
+    def _neighbours(self, direction, node):
+        base = self._slice(direction, node)
+        removed = self._removed[direction].get(node)
+        added = self._added[direction].get(node)
+        if not removed and not added:
+            return base
+        result = [other for other in base if not removed or other not in removed]
+        if added:
+            result.extend(added)
+        return result
+
+    def followed(self, user_id):
+        """ids of the users user_id follows"""
+        return self._neighbours(0, user_id)
+
+    def followers(self, user_id):
+        """ids of the users following user_id"""
+        return self._neighbours(1, user_id)
+
+    def follower_count(self, user_id):
+        """number of followers of user_id"""
+        base = self._slice(1, user_id)
+        return len(base) + len(self._added[1].get(user_id, ())) - \
+            len(self._removed[1].get(user_id, ()))
+
+    def is_following(self, follower_id, followed_id):
+        """binary search in the sorted slice, then the deltas"""
+        if followed_id in self._added[0].get(follower_id, ()):
+            return True
+        if followed_id in self._removed[0].get(follower_id, ()):
+            return False
+        base = self._slice(0, follower_id)
+        pos = bisect_left(base, followed_id)
+        return pos < len(base) and base[pos] == followed_id
+
+    def _change(self, follower_id, followed_id, add):
+        edges = ((0, follower_id, followed_id), (1, followed_id, follower_id))
+        for direction, node, other in edges:
+            undo, do = (self._removed, self._added) if add else (self._added, self._removed)
+            if other in undo[direction].get(node, ()):
+                undo[direction][node].discard(other)
+            else:
+                do[direction][node].add(other)
+        self.changes += 1
+        self._popular = None
+
+    def follow(self, follower_id, followed_id):
+        """record a new follow relation"""
+        if not self.is_following(follower_id, followed_id):
+            self._change(follower_id, followed_id, True)
+
+    def unfollow(self, follower_id, followed_id):
+        """record a removed follow relation"""
+        if self.is_following(follower_id, followed_id):
+            self._change(follower_id, followed_id, False)
+
+    def edges(self):
+        """all (follower_id, followed_id) pairs, deltas applied"""
+        nodes = set(range(self.size)) | set(self._added[0])
+        for node in sorted(nodes):
+            for other in self.followed(node):
+                yield node, other
+
+    def compact(self):
+        """a new graph with the deltas merged into the arrays"""
+        return FollowerGraph.from_edges(self.edges(), self.built)
+
+    def popular(self, limit=100):
+        """the most followed users, for users without friends of friends"""
+        if self._popular is None:
+            # the whole ranking, callers skip the users they already know
+            self._popular = sorted(
+                (user_id for user_id in range(self.size) if self.follower_count(user_id)),
+                key=lambda user_id: -self.follower_count(user_id))
+        return self._popular[:limit]
+
+    def who_to_follow(self, user_id, limit=10, max_fanout=1000):
+        """
+        friends-of-friends suggestions: users followed by the users user_id follows,
+        ranked by how many of them follow the candidate, then by followers
+        Parameters
+        ----------
+        max_fanout : int
+            at most this many followed users of each friend are considered, so a
+            friend following everybody does not make the request slow
+        Returns
+        -------
+        list
+            (user_id, number of followed users following it) pairs
+        """
+        following = set(self.followed(user_id))
+        scores = Counter()
+        for friend in following:
+            for index, candidate in enumerate(self.followed(friend)):
+                if index >= max_fanout:
+                    break
+                if candidate != user_id and candidate not in following:
+                    scores[candidate] += 1
+        ranked = sorted(scores.items(), key=lambda item: (
+            -item[1], -self.follower_count(item[0]), item[0]))[:limit]
+        if len(ranked) < limit:
+            # fill up with popular users, e.g. for new users following nobody
+            known = following | {user_id} | set(scores)
+            ranked += [(candidate, 0) for candidate in self.popular(limit + len(known))
+                       if candidate not in known][:limit - len(ranked)]
+        return ranked
+
+    def reach(self, user_id, hops=2, budget=200000):
+        """
+        number of distinct users within hops follower steps of user_id, i.e. who
+        sees a post directly (1 hop) or when followers repost it (2 hops)
+        Parameters
+        ----------
+        budget : int
+            edges to look at at most. Past it the rest of the current hop is
+            extrapolated from the new users per node seen so far.
+        Returns
+        -------
+        tuple
+            (reach, exact), exact is False for an extrapolated estimate
+        """
+        seen = {user_id}
+        frontier = [user_id]
+        work = 0
+        for _ in range(hops):
+            next_frontier = []
+            for done, node in enumerate(frontier, 1):
+                for follower in self.followers(node):
+                    work += 1
+                    if follower not in seen:
+                        seen.add(follower)
+                        next_frontier.append(follower)
+                if work >= budget and done < len(frontier):
+                    per_node = len(next_frontier) / done
+                    estimate = len(seen) - 1 + per_node * (len(frontier) - done)
+                    # overlaps grow as the hop goes on, never more than everybody else
+                    return int(min(estimate, self.size - 1)), False
+            frontier = next_frontier
+        return len(seen) - 1, True
+
+    def save(self, path):
+        """write the arrays (with deltas merged) to path, atomically"""
+        graph = self.compact() if self.changes else self
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as snapshot:
+            snapshot.write(_HEADER.pack(_MAGIC, graph.size, len(graph.out_targets)))
+            for values in (graph.out_offsets, graph.out_targets,
+                           graph.in_offsets, graph.in_sources):
+                values.tofile(snapshot)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """read a snapshot written by save()"""
+        with open(path, 'rb') as snapshot:
+            magic, size, edges = _HEADER.unpack(snapshot.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError('{} is not a follower graph snapshot'.format(path))
+            values = []
+            for length in (size + 1, edges, size + 1, edges):
+                part = array('i')
+                part.fromfile(snapshot, length)
+                values.append(part)
+        return cls(size, *values, built=os.path.getmtime(path))
+
+
+def build(app):
+    """
+    the graph of the followers table of app's database. It is read on a
+    connection of its own: get_graph() runs during requests, and pushing an app
+    context here would remove the request's session when it is popped.
+    """
+    from app import db
+    from app.models import followers
+    with db.get_engine(app).connect() as connection:
+        rows = connection.execute(db.select([followers.c.follower_id,
+                                             followers.c.followed_id]))
+        return FollowerGraph.from_edges(tuple(row) for row in rows)
+
+
+def get_graph(app):
+    """
+    the graph of app: built on first use, compacted when the deltas grow and
+    reloaded after GRAPH_MAX_AGE seconds, from GRAPH_SNAPSHOT if that is recent
+    """
+    graph = app.extensions.get('follower_graph')
+    max_age = app.config['GRAPH_MAX_AGE']
+    if graph is not None and graph.stale:
+        graph = app.extensions['follower_graph'] = graph.compact()
+    if graph is None or time() - graph.built > max_age:
+        path = app.config['GRAPH_SNAPSHOT']
+        if path and os.path.exists(path) and time() - os.path.getmtime(path) < max_age:
+            graph = FollowerGraph.load(path)
+        else:
+            graph = build(app)
+        app.extensions['follower_graph'] = graph
+    return graph
+
+
+def update(app, follower_id, followed_id, following):
+    """apply a follow (following=True) or unfollow to the graph if app has one"""
+    graph = app.extensions.get('follower_graph')
+    if graph is None:
+        return
+    if following:
+        graph.follow(follower_id, followed_id)
+    else:
+        graph.unfollow(follower_id, followed_id)
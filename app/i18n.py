@@ -0,0 +1,69 @@
+"""
+Per-request i18n fast path.
+
+Flask-Babel resolves the locale once per request through the localeselector and
+then loads the .mo catalog for it from disk, again once per request, into the
+request context. Both results only depend on values that barely change:
+* the locale only depends on the Accept-Language header, so best_locale()
+  memoizes the negotiation per distinct header value.
+* the catalogs never change while the process runs, so they are loaded once
+  per process into app.extensions['babel_catalogs'] and activate() hands the
+  shared object to Flask-Babel instead of letting it read the file again.
+"""
+from functools import lru_cache
+import os
+from babel.support import Translations
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
+from flask import current_app, g, request, _request_ctx_stack
+from flask_babel import get_locale
+
+
+@lru_cache(maxsize=512)
+def best_locale(accept_language, languages):
+    """
+    negotiate the best supported language for an Accept-Language header value.
+    languages has to be a tuple, so the arguments can serve as cache key.
+    """
+    return parse_accept_header(accept_language, LanguageAccept).best_match(languages)
+
+
+def request_locale():
+    """best supported language for the current request (memoized per header)"""
+    return best_locale(request.headers.get('Accept-Language', ''),
+                       tuple(current_app.config['LANGUAGES']))
+
+
+def catalog(app, locale):
+    """the translation catalog for locale, loaded from disk at most once per process"""
+    catalogs = app.extensions.setdefault('babel_catalogs', {})
+    translations = catalogs.get(locale)
+    if translations is None:
+        dirname = os.path.join(app.root_path, 'translations')
+        translations = catalogs[locale] = Translations.load(dirname, [locale])
+    return translations
+
+
+def load_catalogs(app):
+    """load the catalogs of all configured LANGUAGES, returns how many are loaded"""
+    for lang in app.config['LANGUAGES']:
+        catalog(app, lang)
+    return len(app.extensions['babel_catalogs'])
+
+
+def activate():
+    """
+    Resolve the locale of the current request once, keep it in g.locale for the
+    templates, and give Flask-Babel the shared catalog for it.
+    """
+    locale = str(get_locale())
+    g.locale = locale
+    # Flask-Babel looks for an already loaded catalog on the request context
+    # pylint: disable=W0212
+    _request_ctx_stack.top.babel_translations = catalog(current_app._get_current_object(),
+                                                        locale)
+
+
+def init_app(app):
+    """run activate() before any other before_request handler"""
+    app.before_request_funcs.setdefault(None, []).insert(0, activate)
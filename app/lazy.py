@@ -0,0 +1,78 @@
+"""
+Deferred extension initialization and cache pre-warming.
+
+Worker boot time matters when workers are started on demand (autoscaling) or
+forked from a gunicorn master with --preload. Some extensions are only needed
+by a small part of the application: Flask-Migrate (which imports alembic) is
+only used by the `flask db` commands and Flask-Mail is only used when an email
+goes out. With LAZY_EXTENSIONS set, create_app() registers an initializer for
+those extensions instead of running it, and the initializer runs the first
+time the extension is actually needed (see ensure()).
+
+prewarm() does the opposite for things every worker needs: it loads all
+templates and translation catalogs once in the master process, so forked
+workers inherit them through copy-on-write memory.
+Connections must not be inherited that way: after_fork() runs in every
+forked worker and drops the database connections opened by the master.
+"""
+from app import i18n, template_cache
+
+DEFERRED = 'deferred_init'
+
+
+def defer(app, name, initializer):
+    """remember initializer(app) under name, it runs when ensure() is called"""
+    app.extensions.setdefault(DEFERRED, {})[name] = initializer
+
+
+def ensure(app, name):
+    """
+    run the deferred initializer registered under name, if there is one.
+    It's safe to call this any number of times, the initializer only runs once.
+    In eager mode nothing was deferred and this is a no-op.
+    """
+    initializer = app.extensions.get(DEFERRED, {}).pop(name, None)
+    if initializer is not None:
+        initializer(app)
+
+
+def is_deferred(app, name):
+    """True if the extension registered under name is not initialized yet"""
+    return name in app.extensions.get(DEFERRED, {})
+
+
+def prewarm(app):
+    """
+    Compile every template known to the Jinja loader (application and blueprint
+    template folders, including the Flask-Bootstrap ones) and load the compiled
+    translation catalogs for all configured LANGUAGES. The error pages are read
+    or rendered as well (see app/errors/pages.py).
+
+    Returns
+    -------
+    tuple
+        number of templates and number of catalogs loaded
+    """
+    from app.errors import pages
+    templates = len(template_cache.compile_all(app))
+    catalogs = i18n.load_catalogs(app)
+    pages.load_all(app)
+    return templates, catalogs
+
+
+def after_fork(app):
+    """
+    forget the connections a forked worker inherited from its master: the
+    SQLAlchemy pools of all binds, the SQLite connections of the session, rate
+    limit and shared cache stores and the SQLite writer queue (its thread did not
+    survive the fork). Each worker opens its own on first use.
+    """
+    from app import db
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or {}):
+            db.get_engine(app, bind).dispose()
+    store = getattr(app.session_interface, 'store', None)
+    for owner in (store, app.extensions.get('ratelimit'), app.extensions.get('shared_cache')):
+        if hasattr(owner, 'reset'):
+            owner.reset()
+    app.extensions.pop('sqlite_writer', None)
@@ -3,12 +3,13 @@ Core container of WTForms. Forms represent a collection of fields, which can
 be accessed on the form dictionary-style or attribute style. Every field has a
 Widget instance. The widget’s job is rendering an HTML representation of that field.
 """
-from flask import request
+from flask import request, current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Length
 from flask_babel import _, lazy_gettext as _l
 from app.models import User
+from app import user_index
 
 class EditProfileForm(FlaskForm):
     """Profile editor form"""
@@ -24,10 +25,10 @@ class EditProfileForm(FlaskForm):
 
     def validate_username(self, username):
         """avoid duplicate username: if the user name already exists leave it untouched"""
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
-                raise ValidationError(_l('Please use a different username.'))
+        if username.data != self.original_username and \
+                user_index.get_index(current_app).maybe_taken(username=username.data) and \
+                User.taken(username=username.data):
+            raise ValidationError(_l('Please use a different username.'))
 
 
 class PostForm(FlaskForm):
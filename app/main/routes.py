@@ -1,13 +1,19 @@
 """Routes definition"""
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+import math
+from flask import abort, render_template, flash, redirect, url_for, request, \
+    jsonify, current_app, stream_with_context
 from flask_login import current_user, login_required
-from flask_babel import _, get_locale
+from flask_babel import _
 from guess_language import guess_language
-from app import db
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db, graph, sqlite_tuning, streaming, timeline, user_index
+from app.pagination import paginate
+from app.post_view import views
+from app.routing import read_only
 from app.main.forms import EditProfileForm, PostForm
-from app.models import User, Post
+from app.models import User, Post, PostArchive
 from app.translate import translate
 from app.main import bp
 
@@ -21,17 +27,30 @@ def before_request():
     Note: when referencing current_user, Flask-Login will invoke the user loader callback
     function, which will run a database query that already put the target user in the database
     session.
+    With SQLite tuning the update goes through the group committing writer queue instead
+    of a commit of its own, and is not waited for.
+    Avatar images are not activity, a page loads many of them.
     """
+    if request.endpoint == 'avatar':
+        return
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
-    # add the locale to the g object so that it accessible from base template
-    g.locale = str(get_locale())
+        now = datetime.utcnow()
+        writer = sqlite_tuning.get_writer(current_app)
+        if writer is None:
+            current_user.last_seen = now
+            db.session.commit()
+        else:
+            writer.submit('UPDATE user SET last_seen = ? WHERE id = ?',
+                          (now.isoformat(' '), current_user.id))
+            # pylint: disable=W0212
+            set_committed_value(current_user._get_current_object(), 'last_seen', now)
+    # g.locale is set for the base template by app.i18n.activate(), which runs first
 
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@read_only
 def index():
     """
     Default route index.
@@ -52,40 +71,116 @@ def index():
         language = guess_language(form.post.data)
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
-        post = Post(body=form.post.data,
-                    author=current_user, language=language)
-        db.session.add(post)
+        current_user.add_post(form.post.data, language)
         db.session.commit()
         flash(_('Your post is now live!'))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
     # Pagination object: items contains the list of items in the requested page.
     # Page 1, explicit: http://localhost:5000/index?page=1
-    posts = current_user.followed_posts().paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('explore', page=posts.next_num) \
+    # read only PostView objects instead of models, see app/post_view.py
+    posts = paginate(views(current_user.followed_posts()), page,
+                     current_app.config['POSTS_PER_PAGE'], current_user.followed_posts_count(),
+                     stream_batch_size(),
+                     views(current_user.followed_posts(PostArchive), PostArchive))
+    next_url = url_for('main.index', page=posts.next_num) \
         if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
+    prev_url = url_for('main.index', page=posts.prev_num) \
         if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    return streaming.render_page('index.html', title=_('Home'), form=form,
+                                 posts=posts.items, next_url=next_url,
+                                 prev_url=prev_url,
+                                 since_url=since_url(timeline.HOME, page, posts.items))
 
 @bp.route('/explore')
 @login_required
+@read_only
 def explore():
     """
     Same as index, but show a global post stream from all users
     and does not have form obeject to write blog posts
     """
     page = request.args.get('page', 1, type=int)
-    # pagination object (see above)
-    posts = Post.query.order_by(
-        Post.timestamp.desc()).paginate(page, app.config['POSTS_PER_PAGE'], False)
-    return render_template("index.html", title=_('Explore'), posts=posts.items)
+    # pagination object (see above). The page has no pager links, so the highest
+    # post id, read from the primary key indexes, is total enough: it bounds the
+    # number of posts, archived ones keep their ids, and a short last page simply
+    # ends the list.
+    posts = paginate(views(Post.query.order_by(Post.timestamp.desc())), page,
+                     current_app.config['POSTS_PER_PAGE'],
+                     max(db.session.query(db.func.max(model.id)).scalar() or 0
+                         for model in (Post, PostArchive)),
+                     stream_batch_size(),
+                     views(PostArchive.query.order_by(PostArchive.timestamp.desc()), PostArchive))
+    return streaming.render_page("index.html", title=_('Explore'), posts=posts.items,
+                                 since_url=since_url(timeline.EXPLORE, page, posts.items))
+
+def stream_batch_size():
+    """posts fetched per query while a streamed page renders, None if pages are not streamed"""
+    return current_app.config['STREAM_BATCH_SIZE'] if streaming.enabled() else None
+
+def since_url(timeline_name, page, posts):
+    """URL polling for posts newer than the first page, None on other pages"""
+    if page != 1:
+        return None
+    if isinstance(posts, list):
+        cursor = timeline.cursor_of(posts[0]) if posts else None
+    else:
+        # streamed page, the posts are not fetched yet
+        cursor = timeline.latest_cursor(timeline_name, current_user.id)
+    if cursor is None:
+        return None
+    return url_for('main.new_posts', timeline_name=timeline_name, cursor=cursor)
+
+@bp.route('/<any(index, explore):timeline_name>/since')
+@login_required
+@read_only
+def new_posts(timeline_name):
+    """
+    Posts of the home (/index/since) or explore (/explore/since) timeline newer than
+    the cursor query argument, oldest first and at most TIMELINE_BATCH of them.
+    Without a cursor the answer has no posts, only the cursor of the newest post.
+    * default: answer at once. The ETag is the cursor of the newest post the client
+      will know afterwards, so a client sending the same cursor with If-None-Match
+      gets 304 Not Modified while nothing was posted.
+    * ?wait=<seconds>: long poll, answer as soon as there are new posts or after at
+      most TIMELINE_LONGPOLL_MAX seconds.
+    * Accept: text/event-stream or ?stream=1: server-sent events for
+      TIMELINE_STREAM_SECONDS, reconnects resume from Last-Event-ID.
+    Each waiting client holds a worker, so use the waiting modes with threaded or
+    asynchronous workers.
+    """
+    config = current_app.config
+    name = timeline.EXPLORE if timeline_name == 'explore' else timeline.HOME
+    user_id = current_user.id
+    cursor = timeline.decode_cursor(request.args.get('cursor') or
+                                    request.headers.get('Last-Event-ID'))
+    if cursor is None:
+        return jsonify({'posts': [], 'cursor': timeline.latest_cursor(name, user_id)})
+    if request.args.get('stream') or \
+            request.accept_mimetypes.best == 'text/event-stream':
+        stream = timeline.event_stream(name, user_id, cursor, config['TIMELINE_BATCH'],
+                                       config['TIMELINE_STREAM_SECONDS'],
+                                       config['TIMELINE_POLL_INTERVAL'])
+        return current_app.response_class(
+            stream_with_context(stream), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    wait = min(request.args.get('wait', 0, type=float), config['TIMELINE_LONGPOLL_MAX'])
+    if not math.isfinite(wait):
+        # nan passes min() and max(), its deadline would never be reached
+        wait = 0
+    posts = timeline.wait_for_posts(name, user_id, cursor, config['TIMELINE_BATCH'],
+                                    max(wait, 0), config['TIMELINE_POLL_INTERVAL'])
+    newest = timeline.cursor_of(posts[-1]) if posts else timeline.encode_cursor(*cursor)
+    response = jsonify({'posts': [timeline.post_dict(post) for post in posts],
+                        'cursor': newest})
+    response.set_etag(newest)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @bp.route('/user/<username>')  # indicate dynamic component
 @login_required
+@read_only
 def user(username):
     """
     user profile page, invoke the view function with the actual text as an argument.
@@ -94,16 +189,21 @@ def user(username):
     render_template: str
         Renders a login template from the template folder with the given context.
     """
-    usern = User.query.filter_by(username=username).first_or_404()
+    # username and user from the shared cache, see User.by_username()
+    usern = User.by_username(username)
+    if usern is None:
+        abort(404)
     page = request.args.get('page', 1, type=int)
-    posts = usern.posts.order_by(Post.timestamp.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('user', username=usern.username, page=posts.next_num) \
+    posts = paginate(views(usern.posts.order_by(Post.timestamp.desc())), page,
+                     current_app.config['POSTS_PER_PAGE'], usern.post_count, stream_batch_size(),
+                     views(PostArchive.query.filter_by(user_id=usern.id).order_by(
+                         PostArchive.timestamp.desc()), PostArchive))
+    next_url = url_for('main.user', username=usern.username, page=posts.next_num) \
         if posts.has_next else None
-    prev_url = url_for('user', username=usern.username, page=posts.prev_num) \
+    prev_url = url_for('main.user', username=usern.username, page=posts.prev_num) \
         if posts.has_prev else None
-    return render_template('user.html', user=usern, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    return streaming.render_page('user.html', user=usern, posts=posts.items,
+                                 next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -120,9 +220,17 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # somebody took the name after the form was validated
+            db.session.rollback()
+            form.username.errors.append(_('Please use a different username.'))
+            return render_template('edit_profile.html', title=_('Edit Profile'),
+                                   form=form)
+        user_index.get_index(current_app).add(username=form.username.data)
         flash(_('Your changes have been saved.'))
-        return redirect(url_for('edit_profile'))
+        return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -132,33 +240,53 @@ def edit_profile():
 @login_required
 def follow(username):
     """route to follow a user"""
-    user_follow = User.query.filter_by(username=username).first()
+    user_follow = User.by_username(username)
     if user_follow is None:
         flash(_('User %(username)s not found.', username=username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user_follow == current_user:
         flash(_('You cannot follow yourself!'))
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.follow(user_follow)
     db.session.commit()
+    graph.update(current_app, current_user.id, user_follow.id, following=True)
     flash(_('You are following %(username)s!', username=username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
 
 @bp.route('/unfollow/<username>')
 @login_required
 def unfollow(username):
     """route to unfollow a user"""
-    user_unfollow = User.query.filter_by(username=username).first()
+    user_unfollow = User.by_username(username)
     if user_unfollow is None:
         flash(_('User %(username)s not found.', username=username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user_unfollow == current_user:
         flash(_('You cannot unfollow yourself!'))
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.unfollow(user_unfollow)
     db.session.commit()
+    graph.update(current_app, current_user.id, user_unfollow.id, following=False)
     flash(_('You are not following %(username)s.', username=username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
+
+@bp.route('/who_to_follow')
+@login_required
+@read_only
+def who_to_follow():
+    """
+    suggestions from the follower graph index (app/graph.py): users followed by the
+    users the current user follows, and how many users the current user's posts reach
+    """
+    follower_graph = graph.get_graph(current_app)
+    ranked = follower_graph.who_to_follow(current_user.id,
+                                          current_app.config['GRAPH_SUGGESTIONS'])
+    users = {user.id: user for user in User.query.filter(
+        User.id.in_([user_id for user_id, _ in ranked]))} if ranked else {}
+    suggestions = [(users[user_id], mutual) for user_id, mutual in ranked if user_id in users]
+    reach, exact = follower_graph.reach(current_user.id)
+    return render_template('who_to_follow.html', title=_('Who to follow'),
+                           suggestions=suggestions, reach=reach, exact=exact)
 
 @bp.route('/translate', methods=['POST'])
 @login_required
@@ -5,13 +5,17 @@ To override the table name, set the __tablename__ class attribute.
 """
 from datetime import datetime
 from time import time
-from hashlib import md5
+from hashlib import sha256
 import jwt
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import ClauseElement
 from flask_login import UserMixin
-from flask_babel import lazy_gettext as _l
-from flask import current_app
-from app import db, login
+from flask import current_app, g
+from app import archive, avatars, db, login, shared_cache
+from app.routing import RoutingSession
 
 # auxiliary table that has no data other than the foreign keys withoud model Class
 followers = db.Table('followers',
@@ -19,6 +23,31 @@ followers = db.Table('followers',
                                db.ForeignKey('user.id')),
                      db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
 
+# columns of a User kept in the shared cache, see User.cached(); last_seen and the
+# counters change all the time and are loaded when they are read. The password
+# hash stays out of the cache file, the few places checking it load it.
+CACHED_USER_COLUMNS = ('id', 'username', 'email', 'about_me')
+
+def password_fingerprint(password_hash):
+    """short digest of a password hash, changes whenever the password changes"""
+    return sha256((password_hash or '').encode('utf-8')).hexdigest()[:16]
+
+def increment(obj, attr, delta=1):
+    """
+    add delta to a counter column. For stored rows the UPDATE computes the new value
+    in the database (counter = counter + delta), so concurrent transactions do not
+    overwrite each other's increments.
+    """
+    if not inspect(obj).persistent:
+        setattr(obj, attr, (getattr(obj, attr) or 0) + delta)
+        return
+    pending = obj.__dict__.get(attr)
+    if isinstance(pending, ClauseElement):
+        # not flushed yet, add to the pending expression
+        setattr(obj, attr, pending + delta)
+    else:
+        setattr(obj, attr, getattr(type(obj), attr) + delta)
+
 @login.user_loader
 def load_user(id_):
     """
@@ -38,8 +67,9 @@ def load_user(id_):
     -------
     int
         Databases that use numeric IDs need to convert the string to integer
+    The user comes from the shared cache if it is there, see User.cached().
     """
-    return User.query.get(int(id_))
+    return User.cached(int(id_))
 
 class User(UserMixin, db.Model):
     """
@@ -68,15 +98,19 @@ class User(UserMixin, db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # denormalized totals, kept up to date by add_post(), follow() and unfollow(),
+    # repaired by reconcile_counters() (flask counters reconcile)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def avatar(self, size):
         """
         Returns the URL of the user's avatar image, scaled to the requested size in pixels.
-        Gravatar doc: https://de.gravatar.com/site/implement/images
-        For users that don't have an avatar registered, an "identicon" image will be generated.
+        The image is served by the application, by the Gravatar hash of the email
+        (see app/avatars.py). For users without an avatar an "identicon" image is generated.
         """
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return avatars.url(self.email, size)
 
     def set_password(self, password):
         """store password as hash"""
@@ -89,7 +123,71 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
-    def followed_posts(self):
+    @staticmethod
+    def taken(username=None, email=None):
+        """
+        check username and email against the user table with a single query
+        Returns
+        -------
+        set
+            the names of the fields ('username', 'email') whose value is in use
+        """
+        clauses = []
+        if username:
+            clauses.append(User.username == username)
+        if email:
+            clauses.append(User.email == email)
+        if not clauses:
+            return set()
+        taken = set()
+        for used_name, used_email in User.query.with_entities(
+                User.username, User.email).filter(db.or_(*clauses)):
+            if username and used_name == username:
+                taken.add('username')
+            if email and used_email == email:
+                taken.add('email')
+        return taken
+
+    @staticmethod
+    def cached(id_):
+        """
+        the user with id id_, without a query if the session has it already or its
+        CACHED_USER_COLUMNS are in the shared cache (see app/shared_cache.py). The
+        other columns are expired and loaded by one query when one of them is read.
+        Returns
+        -------
+        User
+            attached to the session, None if there is no such user
+        """
+        user = db.session.identity_map.get(identity_key(User, id_))
+        if user is not None:
+            return user
+        row = shared_cache.get_cache(current_app).cached(
+            'user', str(id_), lambda: User.cache_row(id_))
+        if row is None:
+            return None
+        user = User(**row)
+        # as if loaded by a query, the missing columns are expired
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    @staticmethod
+    def cache_row(id_):
+        """the CACHED_USER_COLUMNS of user id_ as a dict, None if there is none"""
+        row = db.session.query(*[getattr(User, name) for name in CACHED_USER_COLUMNS]).filter(
+            User.id == id_).first()
+        return dict(zip(CACHED_USER_COLUMNS, row)) if row is not None else None
+
+    @staticmethod
+    def by_username(username):
+        """the user named username through the shared username -> id cache, or None"""
+        id_ = shared_cache.get_cache(current_app).cached(
+            'username', username,
+            lambda: db.session.query(User.id).filter_by(username=username).scalar())
+        return User.cached(id_) if id_ is not None else None
+
+    def followed_posts(self, model=None):
         """
         invoking the join operation on the posts table and put it a temporary table that
         combines data from posts and followers tables.
@@ -97,52 +195,146 @@ class User(UserMixin, db.Model):
         own posts through a union.
         Hint: The "c" is an attribute of SQLAlchemy tables that are not defined as models.
         For these tables, the table columns are all exposed as sub-attributes of this "c" attribute.
+        model is Post (default) or PostArchive for the archived part of the timeline, see
+        app/archive.py.
         """
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
+        model = model or Post
+        if model is PostArchive and archive.separate():
+            # followers are in the primary database
+            followed_ids = [id_ for id_, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id)]
+            return model.query.filter(model.user_id.in_(followed_ids + [self.id])).order_by(
+                model.timestamp.desc())
+        own = model.query.filter_by(user_id=self.id)
+        followed = model.query.join(
+            followers, (followers.c.followed_id == model.user_id)).filter(
                 followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return followed.union(own).order_by(model.timestamp.desc())
+
+    def followed_posts_count(self):
+        """number of posts in followed_posts(), from the stored counters"""
+        followed = db.session.query(db.func.coalesce(db.func.sum(User.post_count), 0)).join(
+            followers, followers.c.followed_id == User.id).filter(
+                followers.c.follower_id == self.id).scalar()
+        return followed + self.post_count
+
+    def add_post(self, body, language=''):
+        """create a post of the user and count it, committed with the session"""
+        post = Post(body=body, author=self, language=language)
+        db.session.add(post)
+        increment(self, 'post_count')
+        return post
 
     def follow(self, user):
         """append follower"""
         if not self.is_following(user):
             self.followed.append(user)
+            increment(self, 'followed_count')
+            increment(user, 'follower_count')
 
     def unfollow(self, user):
         """unfollow uswer"""
         if self.is_following(user):
             self.followed.remove(user)
+            increment(self, 'followed_count', -1)
+            increment(user, 'follower_count', -1)
 
     def is_following(self, user):
         """check is user is following"""
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
 
+    @staticmethod
+    def counter_totals():
+        """
+        correlated subqueries computing the true value of each counter column,
+        post_count includes the archived posts
+        """
+        return {
+            User.post_count: db.select([db.func.count(Post.id)]).where(
+                Post.user_id == User.id).as_scalar() + archive.archived_counts(),
+            User.follower_count: db.select([db.func.count()]).select_from(followers).where(
+                followers.c.followed_id == User.id).as_scalar(),
+            User.followed_count: db.select([db.func.count()]).select_from(followers).where(
+                followers.c.follower_id == User.id).as_scalar(),
+        }
+
+    @staticmethod
+    def reconcile_counters(batch_size=1000):
+        """
+        recompute the counters of all users whose stored values drifted, with one
+        UPDATE per batch_size users
+        Returns
+        -------
+        int
+            number of users that were repaired
+        """
+        totals = User.counter_totals()
+        drifted = [id_ for id_, in User.query.with_entities(User.id).filter(
+            db.or_(*[column != total for column, total in totals.items()]))]
+        for start in range(0, len(drifted), batch_size):
+            User.query.filter(User.id.in_(drifted[start:start + batch_size])).update(
+                totals, synchronize_session=False)
+        db.session.commit()
+        return len(drifted)
+
     def get_reset_password_token(self, expires_in=600):
         """
         Create JWT token for password reset belongin to the User. Decode('utf-8') is necessary
-        because the jwt.encode() function returns the token as a byte sequence
+        because the jwt.encode() function returns the token as a byte sequence.
+        The token carries a fingerprint of the current password hash, so it stops working
+        as soon as the password is changed: it can be used only once.
         Returns
         -------
         str
             generated JWT token as a string
         """
         return jwt.encode(
-            {'reset_password': self.id, 'exp': time() + expires_in},
+            {'reset_password': self.id, 'exp': time() + expires_in,
+             'fp': password_fingerprint(self.password_hash)},
             current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
 
     @staticmethod
-    def verify_reset_password_token(token):
+    def decode_reset_password_token(token):
         """
-        takes a token and attempts to decode it by invoking PyJWT's jwt.decode() function
+        check signature and expiry of a reset token without touching the database
+        Returns
+        -------
+        dict
+            the token payload, or None if the token is expired or invalid
         """
         try:
-            uid = jwt.decode(token, current_app.config['SECRET_KEY'],
-                             algorithms=['HS256'])['reset_password']
-        except jwt.ExpiredSignatureError:
-            return _l("Token has expired")
-        return User.query.get(uid)
+            payload = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                 algorithms=['HS256'])
+        except jwt.InvalidTokenError:
+            return None
+        if 'reset_password' not in payload or 'fp' not in payload:
+            return None
+        return payload
+
+    @staticmethod
+    def verify_reset_password_token(token):
+        """
+        takes a token and attempts to decode it by invoking PyJWT's jwt.decode() function.
+        Only tokens that decode go to the database, and only if the password hash still
+        has the fingerprint from the token the user is returned. The result is kept in
+        g for the rest of the request.
+        Returns
+        -------
+        User
+            the user the token belongs to, or None
+        """
+        verified = g.setdefault('verified_reset_tokens', {})
+        if token not in verified:
+            payload = User.decode_reset_password_token(token)
+            user = None
+            if payload is not None:
+                user = User.query.get(payload['reset_password'])
+                if user is not None and \
+                        password_fingerprint(user.password_hash) != payload['fp']:
+                    user = None
+            verified[token] = user
+        return verified[token]
 
     # declare the many-to-many relationship
     # primaryjoin indicates the condition that links the left side entity
@@ -154,13 +346,71 @@ class User(UserMixin, db.Model):
         secondaryjoin=(followers.c.followed_id == id),
         backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
 
+def _stale(target, usernames):
+    """remember the shared cache entries of target and usernames for drop_stale_users()"""
+    stale = object_session(target).info.setdefault('stale_users', set())
+    stale.add(('user', str(target.id)))
+    stale.update(('username', username) for username in usernames if username)
+
+@event.listens_for(User, 'after_update')
+def changed_user(mapper, connection, target):  # pylint: disable=W0613
+    """
+    the shared cache entries of a user whose cached columns changed are deleted
+    once the change is committed (see drop_stale_users())
+    """
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in CACHED_USER_COLUMNS):
+        _stale(target, state.attrs.username.history.sum())
+
+@event.listens_for(User, 'after_delete')
+def deleted_user(mapper, connection, target):  # pylint: disable=W0613
+    """
+    a deleted user is always stale: nothing changed in its attribute history, and
+    the state only counts as deleted after the flush
+    """
+    state = inspect(target)
+    _stale(target, list(state.attrs.username.history.sum()) + [state.dict.get('username')])
+
+@event.listens_for(RoutingSession, 'after_commit')
+def drop_stale_users(session):
+    """delete the shared cache entries of the users changed by the transaction"""
+    stale = session.info.pop('stale_users', ())
+    if stale:
+        cache = shared_cache.get_cache(session.app)
+        for namespace, key in stale:
+            cache.delete(namespace, key)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_stale_users(session):
+    """nothing changed"""
+    session.info.pop('stale_users', None)
+
 class Post(db.Model):
     """schema for storing posts"""
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     language = db.Column(db.String(5))
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+
+class PostArchive(db.Model):
+    """
+    posts moved out of the post table by `flask posts archive`, with the same
+    columns and ids. In the archive database if one is configured, see app/archive.py.
+    """
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime, index=True)
+    # no foreign key, the user table may be in another database
+    user_id = db.Column(db.Integer, index=True)
+    language = db.Column(db.String(5))
+    author = db.relationship('User', primaryjoin='foreign(PostArchive.user_id) == User.id',
+                             viewonly=True)
+
+    def __repr__(self):
+        return '<PostArchive {}>'.format(self.body)
@@ -0,0 +1,331 @@
+"""
+Schema changes and data backfills for large tables.
+
+A plain op.add_column() or op.create_index() takes a lock on the whole table
+for as long as the statement runs, and on SQLite some changes make Alembic
+rebuild the table in one go. On a table with tens of millions of posts that
+stops the site. The helpers here are called from migrations/versions instead:
+
+* add_column(): adds the column the way the database can do without touching
+  the rows, i.e. nullable or with a constant default. Postgres gives up after
+  LOCK_TIMEOUT instead of queuing every other query behind the migration.
+* create_index(), drop_index(): CONCURRENTLY on Postgres (outside of the
+  migration transaction, an invalid leftover of an interrupted build is dropped
+  first), ALGORITHM=INPLACE, LOCK=NONE on MySQL
+* rebuild_table(): SQLite only, for changes ALTER TABLE cannot do. The rows are
+  copied into a shadow table in committed batches while triggers mirror
+  concurrent writes, then the tables are swapped in one short transaction.
+
+Data is filled in afterwards by a Backfill: rows are visited in primary key
+order (keyset batches, no OFFSET), one transaction per batch, with a pause
+between batches so the database keeps serving requests. The last finished key
+is recorded in the online_migration table, so an interrupted backfill
+continues where it stopped. Large backfills are run with `flask backfill`
+after the migration (add the column, backfill, then start using it), inside a
+migration they run in the migration's transaction.
+"""
+from contextlib import contextmanager
+import logging
+from time import perf_counter, sleep, time
+import sqlalchemy as sa
+
+LOCK_TIMEOUT = '5s'
+PROGRESS_TABLE = 'online_migration'
+
+logger = logging.getLogger(__name__)
+metadata = sa.MetaData()
+progress_table = sa.Table(
+    PROGRESS_TABLE, metadata,
+    sa.Column('name', sa.String(64), primary_key=True),
+    sa.Column('position', sa.Integer, nullable=False, default=0),
+    sa.Column('done', sa.Boolean, nullable=False, default=False),
+    sa.Column('updated', sa.Float, nullable=False))
+
+
+def load_progress(connection, name):
+    """(last finished key, done) recorded under name, (0, False) if there is nothing"""
+    progress_table.create(connection, checkfirst=True)
+    row = connection.execute(sa.select([progress_table.c.position, progress_table.c.done])
+                             .where(progress_table.c.name == name)).first()
+    return (row[0], row[1]) if row else (0, False)
+
+
+def save_progress(connection, name, position, done=False):
+    """record the progress of name"""
+    values = {'position': position, 'done': done, 'updated': time()}
+    if not connection.execute(progress_table.update().where(
+            progress_table.c.name == name).values(**values)).rowcount:
+        connection.execute(progress_table.insert().values(name=name, **values))
+
+
+def dialect_name(op):
+    """'postgresql', 'mysql', 'sqlite', ... for the migration's connection"""
+    return op.get_bind().dialect.name
+
+
+@contextmanager
+def outside_transaction(op):
+    """
+    commit the migration transaction and run the block in autocommit mode, the
+    rest of the migration gets a new transaction (Alembic 0.9 has no
+    autocommit_block())
+    """
+    bind = op.get_bind()
+    raw = bind.connection.connection
+    raw.commit()
+    sqlite = bind.dialect.name == 'sqlite'
+    if sqlite:
+        isolation_level, raw.isolation_level = raw.isolation_level, None
+    else:
+        raw.autocommit = True
+    try:
+        # transactions are explicit from here on, see transaction()
+        yield bind.execution_options(autocommit=False)
+    finally:
+        if sqlite:
+            raw.isolation_level = isolation_level
+        else:
+            raw.autocommit = False
+
+
+@contextmanager
+def transaction(bind, begin='BEGIN'):
+    """an explicit transaction on a connection in autocommit mode"""
+    bind.execute(begin)
+    try:
+        yield bind
+    except BaseException:  # also Ctrl-C, the batch is repeated on the next run
+        bind.execute('ROLLBACK')
+        raise
+    bind.execute('COMMIT')
+
+
+def add_column(op, table, column):
+    """
+    add column to table without rewriting its rows
+    Raises
+    ------
+    ValueError
+        for a NOT NULL column without server default, which needs a value in every
+        row: add it nullable, backfill it and add the constraint afterwards
+    """
+    if not column.nullable and column.server_default is None:
+        raise ValueError('{}.{} is NOT NULL without a server default'.format(
+            table, column.name))
+    name = dialect_name(op)
+    if name == 'postgresql':
+        op.execute("SET LOCAL lock_timeout = '{}'".format(LOCK_TIMEOUT))
+    if name == 'mysql':
+        ddl = sa.schema.CreateColumn(column).compile(dialect=op.get_bind().dialect)
+        op.execute('ALTER TABLE {} ADD COLUMN {}, ALGORITHM=INPLACE, LOCK=NONE'.format(
+            table, ddl))
+    else:
+        # SQLite only changes the schema text, Postgres only the catalog
+        op.add_column(table, column)
+
+
+def create_index(op, index_name, table, columns, unique=False):
+    """create an index while the table stays writable (on SQLite: readable)"""
+    name = dialect_name(op)
+    if name == 'postgresql':
+        with outside_transaction(op) as bind:
+            valid = bind.execute(sa.text(
+                'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE c.relname = :name'), name=index_name).scalar()
+            if valid is False:
+                bind.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index_name))
+            if valid is not True:
+                op.create_index(index_name, table, columns, unique=unique,
+                                postgresql_concurrently=True)
+    elif name == 'mysql':
+        op.execute('CREATE {}INDEX {} ON {} ({}) ALGORITHM=INPLACE LOCK=NONE'.format(
+            'UNIQUE ' if unique else '', index_name, table, ', '.join(columns)))
+    else:
+        # SQLite builds indexes under the write lock, in WAL mode reads go on
+        op.create_index(index_name, table, columns, unique=unique)
+
+
+def drop_index(op, index_name, table):
+    """counterpart of create_index()"""
+    if dialect_name(op) == 'postgresql':
+        with outside_transaction(op) as bind:
+            bind.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index_name))
+    else:
+        op.drop_index(index_name, table_name=table)
+
+
+def rebuild_table(op, table, batch_size=10000, pause=0.01):
+    """
+    SQLite: replace the table named table.name by table (a sa.Table with the new
+    definition), copying the columns both have
+    * a shadow table with the new definition is created, triggers copy every
+      insert, update and delete on the old table to it
+    * the rows are copied in primary key batches, each in its own transaction
+    * one transaction drops the old table, renames the shadow table and creates
+      the indexes of the new definition
+    Parameters
+    ----------
+    table : sa.Table
+        new definition, with a single column integer primary key
+    """
+    if dialect_name(op) != 'sqlite':
+        raise NotImplementedError('rebuild_table() is for SQLite, use ALTER TABLE')
+    bind = op.get_bind()
+    name = table.name
+    shadow = '_{}_shadow'.format(name)
+    old_columns = {column['name'] for column in sa.inspect(bind).get_columns(name)}
+    columns = [column.name for column in table.columns if column.name in old_columns]
+    key = table.primary_key.columns.values()[0].name
+    column_list = ', '.join(columns)
+    shadow_table = table.tometadata(sa.MetaData(), name=shadow)
+    for index in list(shadow_table.indexes):
+        shadow_table.indexes.discard(index)
+    with outside_transaction(op) as bind:
+        shadow_table.create(bind, checkfirst=True)
+        new_values = ', '.join('NEW.' + column for column in columns)
+        for event, action in (
+                ('INSERT', 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'),
+                ('UPDATE', 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'),
+                ('DELETE', 'DELETE FROM {0} WHERE {3} = OLD.{3}')):
+            bind.execute('CREATE TRIGGER IF NOT EXISTS {0}_{1} AFTER {1} ON {2} '
+                         'BEGIN {3}; END'.format(shadow, event.lower(), name, action.format(
+                             shadow, column_list, new_values, key)))
+        # resumes after the rows copied by an interrupted run
+        position = load_progress(bind, shadow)[0]
+        last = bind.execute('SELECT max({}) FROM {}'.format(key, name)).scalar() or 0
+        while position < last:
+            with transaction(bind):
+                # rows written by the triggers meanwhile are newer, keep them
+                bind.execute(sa.text(
+                    'INSERT OR IGNORE INTO {0} ({1}) SELECT {1} FROM {2} '
+                    'WHERE {3} > :position AND {3} <= :end'.format(
+                        shadow, column_list, name, key)),
+                             position=position, end=position + batch_size)
+                position += batch_size
+                save_progress(bind, shadow, position)
+            logger.info('%s: copied up to %s %d of %d', name, key, min(position, last), last)
+            sleep(pause)
+        # keep references from other tables pointing at the name, not the old table
+        bind.execute('PRAGMA legacy_alter_table=ON')
+        with transaction(bind, 'BEGIN IMMEDIATE'):
+            for event in ('insert', 'update', 'delete'):
+                bind.execute('DROP TRIGGER {}_{}'.format(shadow, event))
+            bind.execute('DROP TABLE {}'.format(name))
+            bind.execute('ALTER TABLE {} RENAME TO {}'.format(shadow, name))
+            for index in table.indexes:
+                index.create(bind)
+            bind.execute(progress_table.delete().where(progress_table.c.name == shadow))
+        bind.execute('PRAGMA legacy_alter_table=OFF')
+
+
+class Backfill(object):
+    """
+    Resumable, throttled update of a table in primary key order.
+    Parameters
+    ----------
+    name : str
+        key of the progress record in the online_migration table
+    table : sa.Table
+        the table to update, with a single column integer primary key
+    columns : list
+        columns compute() gets to see, the primary key is always the first
+    compute : callable
+        rows -> list of dicts with the primary key and the new values, under
+        the column names
+    where : ClauseElement
+        only rows matching this are visited, e.g. the column is NULL
+    batch_size : int
+        rows per transaction
+    pause : float
+        seconds to sleep after each batch
+    """
+
+    def __init__(self, name, table, columns, compute, where=None, batch_size=1000, pause=0.1):
+        # pylint: disable=R0913
+        self.name = name
+        self.table = table
+        self.key = table.primary_key.columns.values()[0]
+        self.columns = [self.key] + [column for column in columns if column is not self.key]
+        self.compute = compute
+        self.where = where
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def batch(self, connection, position):
+        """
+        update the next batch after position
+        Returns
+        -------
+        tuple
+            (last key of the batch or None at the end, rows updated)
+        """
+        query = sa.select(self.columns).where(self.key > position)
+        if self.where is not None:
+            query = query.where(self.where)
+        rows = connection.execute(query.order_by(self.key).limit(self.batch_size)).fetchall()
+        if not rows:
+            return None, 0
+        updates = self.compute(rows)
+        if updates:
+            names = [name for name in updates[0] if name != self.key.name]
+            connection.execute(
+                self.table.update().where(self.key == sa.bindparam('_key')).values(
+                    {name: sa.bindparam(name) for name in names}),
+                [dict(values, _key=values[self.key.name]) for values in updates])
+        return rows[-1][0], len(updates)
+
+    def run(self, connection, restart=False, progress=None):
+        """
+        update all remaining batches, each in its own transaction
+        Parameters
+        ----------
+        restart : bool
+            start from the beginning instead of the recorded position
+        progress : callable
+            called after every batch with (position, last key, rows updated so far,
+            rows per second)
+        Returns
+        -------
+        int
+            rows updated by this run
+        """
+        position, done = load_progress(connection, self.name)
+        if restart:
+            position, done = 0, False
+        if done:
+            return 0
+        last = connection.execute(sa.select([sa.func.max(self.key)])).scalar() or 0
+        updated, start = 0, perf_counter()
+        while True:
+            with connection.begin():
+                end, count = self.batch(connection, position)
+                save_progress(connection, self.name, end or position, done=end is None)
+            if end is None:
+                return updated
+            position, updated = end, updated + count
+            if progress is not None:
+                progress(position, last, updated, updated / (perf_counter() - start))
+            sleep(self.pause)
+
+
+def post_language_backfill(batch_size=1000, pause=0.1):
+    """Backfill detecting the language of posts without one ('' if unknown)"""
+    from guess_language import guess_language
+    from app.models import Post
+    table = Post.__table__
+
+    def compute(rows):
+        updates = []
+        for id_, body in rows:
+            language = guess_language(body or '')
+            if language == 'UNKNOWN' or len(language) > 5:
+                language = ''
+            updates.append({'id': id_, 'language': language})
+        return updates
+    return Backfill('post_language', table, [table.c.body], compute,
+                    where=table.c.language.is_(None), batch_size=batch_size, pause=pause)
+
+
+BACKFILLS = {
+    'post-language': post_language_backfill,
+}
@@ -0,0 +1,92 @@
+"""
+Pagination with a known total.
+
+Flask-SQLAlchemy's paginate() runs a COUNT(*) over the whole query on every
+page to find out whether there is a next page. The views know the total from
+the stored counters on User (post_count and friends), so they pass it in and
+only the page itself is queried.
+
+For streamed pages (app/streaming.py) the items of a page can be fetched
+lazily in batches while the template renders, see BatchedItems.
+
+With an archive query (app/archive.py) the items continue with the archived
+posts once the query runs out: the total counts both, the archive query is
+only run for pages past the last row of the query.
+"""
+from flask_sqlalchemy import Pagination
+
+
+class BatchedItems(object):
+    """
+    Items of a page fetched batch_size rows at a time when iterated; fetched rows are
+    kept, so iterating again does not query again. Past the end of query the rows
+    come from archive, if given.
+    """
+
+    def __init__(self, query, offset, count, batch_size, archive=None):
+        # pylint: disable=R0913
+        self.query = query
+        self.archive = archive
+        self.offset = offset
+        self.count = count
+        self.batch_size = batch_size
+        self.fetched = []
+        self.done = count <= 0
+        # rows of query, known once a page reaches past them
+        self.hot_count = None
+
+    def _fetch(self, position, size):
+        if self.hot_count is not None:
+            return self.archive.limit(size).offset(position - self.hot_count).all()
+        batch = self.query.limit(size).offset(position).all()
+        if len(batch) == size or self.archive is None:
+            return batch
+        self.hot_count = position + len(batch) if batch else \
+            self.query.order_by(None).count()
+        return batch + self._fetch(max(position + len(batch), self.hot_count),
+                                   size - len(batch))
+
+    def __iter__(self):
+        for item in self.fetched:
+            yield item
+        while not self.done:
+            size = min(self.batch_size, self.count - len(self.fetched))
+            batch = self._fetch(self.offset + len(self.fetched), size)
+            self.fetched.extend(batch)
+            self.done = len(batch) < size or len(self.fetched) >= self.count
+            for item in batch:
+                yield item
+
+
+def paginate(query, page, per_page, total=None, batch_size=None, archive=None):
+    """
+    Parameters
+    ----------
+    query : BaseQuery
+        ordered query of the items
+    page : int
+        1-based page number
+    per_page : int
+        items per page
+    total : int
+        number of items the query returns, None to count them with a query
+    batch_size : int
+        with a total, fetch the items lazily in batches of this size (BatchedItems)
+    archive : BaseQuery
+        ordered query of the items following those of query, see app/archive.py
+    Returns
+    -------
+    Pagination
+        same object query.paginate() returns
+    """
+    if total is None:
+        if archive is None:
+            return query.paginate(page, per_page, False)
+        total = query.order_by(None).count() + archive.order_by(None).count()
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    items = BatchedItems(query, offset, min(per_page, total - offset), batch_size or per_page,
+                         archive)
+    if not batch_size:
+        items = list(items)
+    return Pagination(query, page, per_page, total, items)
@@ -0,0 +1,86 @@
+"""
+Read-only posts for rendered pages.
+
+The timelines render a page of posts and forget them. Loaded as Post models,
+every post goes into the session's identity map with instrumented attributes
+and change tracking, and its author is lazy loaded as a User model, again with
+all columns. views() turns a query of posts into one that selects just the
+columns _post.html and the polling endpoints use, joined with the author's
+username and email, and returns them as PostView objects: plain __slots__
+objects without a session. Within one query execution every author is a single
+AuthorView, which computes the email digest of the avatar URL once.
+
+Queries of archived posts in a separate database (see app/archive.py) cannot
+join the user table, they stay ORM queries whose authors are loaded lazily.
+
+`flask bench views` compares both paths.
+"""
+from sqlalchemy.orm import Bundle
+from app import archive, avatars
+
+
+class AuthorView(object):
+    """the author of a PostView: username and the avatar, by email digest"""
+    __slots__ = ('username', 'digest')
+
+    def __init__(self, username, email):
+        self.username = username
+        self.digest = avatars.email_digest(email)
+
+    def avatar(self, size):
+        """same URL as User.avatar()"""
+        return avatars.digest_url(self.digest, size)
+
+
+class PostView(object):
+    """a post as the pages show it, read only"""
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'author')
+
+    def __init__(self, id_, body, timestamp, language, author):
+        # pylint: disable=R0913
+        self.id = id_  # pylint: disable=C0103
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = author
+
+    def __repr__(self):
+        return '<PostView {}>'.format(self.body)
+
+
+class PostViewBundle(Bundle):
+    """columns of a post and its author, loaded as PostView objects"""
+    # rows of a query of only this bundle are the PostViews themselves
+    single_entity = True
+
+    def create_row_processor(self, query, procs, labels):
+        # one processor per execution, it shares the AuthorViews of that result
+        authors = {}
+
+        def process(row):
+            id_, body, timestamp, language, username, email = [proc(row) for proc in procs]
+            author = authors.get(username)
+            if author is None:
+                author = authors[username] = AuthorView(username, email)
+            return PostView(id_, body, timestamp, language, author)
+        return process
+
+
+def views(query, model=None):
+    """
+    query of Post (or PostArchive) models as a query of PostView objects
+    Parameters
+    ----------
+    query : BaseQuery
+        ordered query of posts, possibly a union
+    model : Model
+        Post (default) or PostArchive
+    """
+    from app.models import Post, PostArchive, User
+    model = model or Post
+    if model is PostArchive and archive.separate():
+        return query
+    return query.join(User, User.id == model.user_id).with_entities(PostViewBundle(
+        'post', model.id, model.body, model.timestamp, model.language, User.username,
+        User.email))
+
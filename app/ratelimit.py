@@ -0,0 +1,197 @@
+"""
+Rate limiting for expensive anonymous endpoints.
+
+Every login attempt costs a PBKDF2 password check and every reset request an
+email, so both are limited with sliding window counters, keyed by client IP
+and by the submitted username/email. The sliding window is approximated with
+two fixed windows: the count of the previous window is weighted by how much of
+it still overlaps the sliding window, which needs two counters per key only.
+
+Counters live in a store selected by RATELIMIT_STORAGE:
+* 'memory': per process dict, every worker counts on its own
+* 'sqlite:///<path>': SQLite file shared by all workers on the host
+The limits are configured per endpoint in RATELIMITS as "<count>/<seconds>".
+Behind reverse proxies the client IP is only the real one with PROXY_COUNT set,
+see init_proxy_fix() in app/__init__.py.
+"""
+from functools import wraps
+import sqlite3
+import threading
+from time import time
+from flask import current_app, request, make_response
+from flask_babel import _
+
+
+def parse_limit(spec):
+    """'10/60' -> (10, 60), a count or period below 1 is rejected"""
+    count, seconds = spec.split('/')
+    count, seconds = int(count), int(seconds)
+    if count < 1 or seconds < 1:
+        raise ValueError('rate limit {!r} must allow at least 1 hit in 1 second'.format(spec))
+    return count, seconds
+
+
+def sliding_count(previous, current, elapsed, period):
+    """estimated number of hits in the last `period` seconds"""
+    return previous * (period - elapsed) / period + current
+
+
+def retry_after(previous, current, elapsed, period, limit):
+    """seconds until one more hit fits under limit again"""
+    room = limit - 1 - current
+    if room >= 0:
+        # the previous window fades out before the current one ends
+        return max(0.0, period - elapsed - room * period / previous)
+    # wait for the rollover, then for the current window to fade enough
+    return period - elapsed + period * (1 - (limit - 1) / current)
+
+
+class MemoryStore(object):
+    """counters in a dict of the current process"""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, period, now=None):
+        """
+        count a hit for key unless it is over limit
+        Returns
+        -------
+        int
+            0 if the hit is allowed, otherwise the seconds to wait
+        """
+        now = time() if now is None else now
+        window = int(now // period)
+        elapsed = now - window * period
+        with self._lock:
+            current = self._counts.get((key, period, window), 0)
+            previous = self._counts.get((key, period, window - 1), 0)
+            if sliding_count(previous, current, elapsed, period) + 1 > limit:
+                return int(retry_after(previous, current, elapsed, period, limit)) + 1
+            self._counts[(key, period, window)] = current + 1
+            if len(self._counts) > self.max_keys:
+                self._prune(now)
+        return 0
+
+    def _prune(self, now):
+        """forget windows that can no longer be the current or previous one"""
+        self._counts = {(key, period, window): count
+                        for (key, period, window), count in self._counts.items()
+                        if window >= int(now // period) - 1}
+
+
+class SQLiteStore(object):
+    """counters in a SQLite file, shared by all processes using the same path"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS ratelimit (key TEXT NOT NULL, period INTEGER NOT NULL, '
+            'window INTEGER NOT NULL, count INTEGER NOT NULL, '
+            'PRIMARY KEY (key, period, window))')
+
+    def connection(self):
+        """one connection per thread, in autocommit mode"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5,
+                                                      isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def reset(self):
+        """drop the connections, e.g. the ones a forked process inherited"""
+        self._local = threading.local()
+
+    def hit(self, key, limit, period, now=None):
+        """same as MemoryStore.hit(), atomic across processes"""
+        now = time() if now is None else now
+        window = int(now // period)
+        elapsed = now - window * period
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = dict(conn.execute(
+                'SELECT window, count FROM ratelimit WHERE key = ? AND period = ? '
+                'AND window >= ?', (key, period, window - 1)))
+            current, previous = counts.get(window, 0), counts.get(window - 1, 0)
+            if sliding_count(previous, current, elapsed, period) + 1 > limit:
+                conn.execute('COMMIT')
+                return int(retry_after(previous, current, elapsed, period, limit)) + 1
+            conn.execute('INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?, ?)',
+                         (key, period, window, current + 1))
+            if not current:
+                # first hit of the key in a new window: windows before the previous
+                # one are useless, for all keys of the period
+                conn.execute('DELETE FROM ratelimit WHERE period = ? AND window < ?',
+                             (period, window - 1))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return 0
+
+
+def create_store(uri):
+    """store for a RATELIMIT_STORAGE value"""
+    if uri == 'memory':
+        return MemoryStore()
+    if uri.startswith('sqlite:///'):
+        return SQLiteStore(uri[len('sqlite:///'):])
+    raise ValueError('unknown RATELIMIT_STORAGE {!r}'.format(uri))
+
+
+def get_store(app):
+    """the store of app, created on first use after checking RATELIMITS"""
+    store = app.extensions.get('ratelimit')
+    if store is None:
+        for limits in app.config['RATELIMITS'].values():
+            for spec in limits.values():
+                parse_limit(spec)
+        store = app.extensions['ratelimit'] = create_store(app.config['RATELIMIT_STORAGE'])
+    return store
+
+
+def limit(endpoint, field=None):
+    """
+    Decorator limiting POST requests to a view by client IP and, if field is
+    given, by the value of that form field. Both limits are checked before the
+    view runs, so a rejected request never reaches the form, the session user or
+    the database.
+    Parameters
+    ----------
+    endpoint : str
+        name of the entry in RATELIMITS
+    field : str
+        form field to limit on as well, e.g. 'username'
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method == 'POST':
+                limits = current_app.config['RATELIMITS'].get(endpoint, {})
+                keys = [('ip', request.remote_addr)]
+                if field:
+                    keys.append((field, (request.form.get(field) or '').strip().lower()))
+                store = get_store(current_app)
+                for kind, value in keys:
+                    if kind not in limits or not value:
+                        continue
+                    count, period = parse_limit(limits[kind])
+                    wait = store.hit('{}:{}:{}'.format(endpoint, kind, value), count, period)
+                    if wait:
+                        return too_many_requests(wait)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def too_many_requests(wait):
+    """plain 429 response, rendering a page could hit the database"""
+    response = make_response(_('Too many attempts, please try again later.'), 429)
+    response.headers['Retry-After'] = str(wait)
+    response.mimetype = 'text/plain'
+    return response
@@ -0,0 +1,120 @@
+"""
+Read replica routing for SQLAlchemy.
+
+With a 'replica' entry in SQLALCHEMY_BINDS, GET requests to views marked with
+@read_only run their queries against the replica, everything else uses the
+primary database (SQLALCHEMY_DATABASE_URI):
+* flushes always go to the primary, and once a request has written something,
+  its remaining queries stay on the primary as well.
+* after a commit that changed data the client reads from the primary for the
+  next REPLICA_STICKY_SECONDS (read-your-writes), so a redirect after posting
+  shows the new post even if the replica lags behind.
+Bookkeeping writes such as User.last_seen (NON_STICKY_ATTRIBUTES) do not
+make a client sticky, otherwise every logged in user would always be.
+
+Models with __bind_key__ = 'archive' (OPTIONAL_BINDS) use their own database
+if SQLALCHEMY_BINDS has an 'archive' entry and the primary database otherwise.
+"""
+from time import time
+from flask import g, has_request_context, request, session, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import inspect, orm
+
+REPLICA = 'replica'
+ARCHIVE = 'archive'
+# binds that fall back to the primary database when they are not configured
+OPTIONAL_BINDS = (ARCHIVE,)
+NON_STICKY_ATTRIBUTES = {'last_seen'}
+
+
+def read_only(view):
+    """mark a view whose GET requests may be served from the replica"""
+    view.read_only = True
+    return view
+
+
+def select_database():
+    """before_request hook: decide if this request may use the replica"""
+    view = current_app.view_functions.get(request.endpoint)
+    g.read_only = request.method in ('GET', 'HEAD') and \
+        getattr(view, 'read_only', False) and \
+        session.get('_primary_until', 0) < time()
+
+
+def significant_changes(db_session):
+    """True if pending changes go beyond NON_STICKY_ATTRIBUTES"""
+    if db_session.new or db_session.deleted:
+        return True
+    for obj in db_session.dirty:
+        for attr in inspect(obj).attrs:
+            if attr.key not in NON_STICKY_ATTRIBUTES and attr.history.has_changes():
+                return True
+    return False
+
+
+class RoutingSession(SignallingSession):
+    """Flask-SQLAlchemy session sending reads of read only requests to the replica"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.wrote = False
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.wrote and self._use_replica(mapper):
+            return self.db.get_engine(self.app, bind=REPLICA)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _use_replica(self, mapper):
+        if REPLICA not in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+            return False
+        if mapper is not None and getattr(mapper.local_table, 'info', {}).get('bind_key'):
+            # models with their own __bind_key__ keep their database
+            return False
+        return has_request_context() and g.get('read_only', False)
+
+    def flush(self, objects=None):
+        if not self.wrote and significant_changes(self):
+            self.wrote = True
+        super(RoutingSession, self).flush(objects)
+
+    def commit(self):
+        super(RoutingSession, self).commit()
+        if self.wrote:
+            self.wrote = False
+            if has_request_context():
+                session['_primary_until'] = time() + self.app.config['REPLICA_STICKY_SECONDS']
+                g.read_only = False
+
+    def rollback(self):
+        super(RoutingSession, self).rollback()
+        self.wrote = False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension using RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        if bind in OPTIONAL_BINDS and bind not in (
+                self.get_app(app).config['SQLALCHEMY_BINDS'] or {}):
+            bind = None
+        return super(RoutingSQLAlchemy, self).get_engine(app, bind)
+
+    def get_tables_for_bind(self, bind=None):
+        tables = super(RoutingSQLAlchemy, self).get_tables_for_bind(bind)
+        if bind is None:
+            # the tables of unconfigured optional binds live in the primary database
+            configured = self.get_app().config['SQLALCHEMY_BINDS'] or {}
+            tables += [table for table in self.Model.metadata.tables.values()
+                       if table.info.get('bind_key') in OPTIONAL_BINDS and
+                       table.info['bind_key'] not in configured]
+        return tables
+
+
+def init_app(app):
+    """register the database selection, which has to run before the user is loaded"""
+    app.before_request_funcs.setdefault(None, []).insert(0, select_database)
+
@@ -0,0 +1,315 @@
+"""
+Server-side session store.
+
+Flask keeps the session in a signed cookie: every request verifies the
+signature and decodes the JSON payload, every modified session is encoded and
+signed again, and the cookie travels with each request and grows with the
+flashed messages. With SESSION_BACKEND = 'sqlite' the cookie only holds a
+random session id and the data lives in a SQLite file (SESSION_SQLITE_PATH)
+shared by all workers on the host:
+* the data is stored in a compact binary encoding (dumps()/loads())
+* it is only read and decoded when the session is actually touched
+* it is only written back when it was modified
+* expired rows are deleted in batches, every SESSION_GC_EVERY saves on average
+  and with `flask sessions gc`
+"""
+import random
+import secrets
+import sqlite3
+import struct
+import threading
+from collections.abc import MutableMapping
+from time import time
+from flask.sessions import SessionInterface, SessionMixin
+from markupsafe import Markup
+
+# type tags of the binary encoding
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES, _LIST, _TUPLE, _DICT, _MARKUP = \
+    b'NTFifsbltdm'
+_DOUBLE = struct.Struct('>d')
+
+
+def _write_varint(out, number):
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data, pos):
+    number = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+def _encode(value, out):
+    # pylint: disable=R0912
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        # zigzag, so small negative numbers stay short as well
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, bytes):
+        out.append(_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(_TUPLE if isinstance(value, tuple) else _LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    elif hasattr(value, '__html__'):
+        # Markup, kept as Markup like Flask's cookie serializer does
+        out.append(_MARKUP)
+        raw = str(value.__html__()).encode('utf-8')
+        _write_varint(out, len(raw))
+        out += raw
+    else:
+        # str and lazy strings (e.g. flashed _l() messages)
+        out.append(_STR)
+        raw = str(value).encode('utf-8')
+        _write_varint(out, len(raw))
+        out += raw
+
+
+def _decode(data, pos):
+    # pylint: disable=R0911
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT:
+        number, pos = _read_varint(data, pos)
+        return (number >> 1) if not number & 1 else -((number + 1) >> 1), pos
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    if tag in (_STR, _MARKUP, _BYTES):
+        length, pos = _read_varint(data, pos)
+        raw = bytes(data[pos:pos + length])
+        pos += length
+        if tag == _BYTES:
+            return raw, pos
+        text = raw.decode('utf-8')
+        return (Markup(text) if tag == _MARKUP else text), pos
+    if tag in (_LIST, _TUPLE):
+        length, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(length):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return (tuple(items) if tag == _TUPLE else items), pos
+    if tag == _DICT:
+        length, pos = _read_varint(data, pos)
+        result = {}
+        for _ in range(length):
+            key, pos = _decode(data, pos)
+            result[key], pos = _decode(data, pos)
+        return result, pos
+    raise ValueError('unknown session data tag {!r}'.format(chr(tag)))
+
+
+def dumps(data):
+    """encode session data (dict of plain values) to bytes"""
+    out = bytearray()
+    _encode(data, out)
+    return bytes(out)
+
+
+def loads(raw):
+    """decode bytes produced by dumps()"""
+    return _decode(raw, 0)[0]
+
+
+class SQLiteSessionStore(object):
+    """session rows in a SQLite file, one connection per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS session (sid TEXT PRIMARY KEY, data BLOB NOT NULL, '
+            'expires REAL NOT NULL)')
+        self._conn().execute(
+            'CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5,
+                                                      isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def reset(self):
+        """drop the connections, e.g. the ones a forked process inherited"""
+        self._local = threading.local()
+
+    def load(self, sid):
+        """(data, expires) of an unexpired session, or None"""
+        return self._conn().execute(
+            'SELECT data, expires FROM session WHERE sid = ? AND expires > ?',
+            (sid, time())).fetchone()
+
+    def save(self, sid, data, expires):
+        """insert or replace a session"""
+        self._conn().execute('INSERT OR REPLACE INTO session VALUES (?, ?, ?)',
+                             (sid, data, expires))
+
+    def touch(self, sid, expires):
+        """move the expiry of a session"""
+        self._conn().execute('UPDATE session SET expires = ? WHERE sid = ?', (expires, sid))
+
+    def delete(self, sid):
+        """remove a session"""
+        self._conn().execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+    def gc(self, batch_size=1000):
+        """delete at most batch_size expired sessions, returns how many were deleted"""
+        return self._conn().execute(
+            'DELETE FROM session WHERE sid IN (SELECT sid FROM session WHERE expires <= ? '
+            'LIMIT ?)', (time(), batch_size)).rowcount
+
+
+class ServerSideSession(SessionMixin, MutableMapping):
+    """
+    Session dict that reads its data from the store on first access only.
+    Parameters
+    ----------
+    store : SQLiteSessionStore
+        where the data lives
+    sid : str
+        session id from the cookie, None for a new session
+    """
+
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.expires = None
+        self.modified = False
+        self.accessed = False
+        self._data = None if sid else {}
+
+    @property
+    def data(self):
+        """the decoded session data, loaded on first use"""
+        self.accessed = True
+        if self._data is None:
+            row = self.store.load(self.sid)
+            if row is None:
+                # unknown or expired id, never reuse it
+                self.sid = None
+                self._data = {}
+            else:
+                self._data = loads(row[0])
+                self.expires = row[1]
+        return self._data
+
+    @property
+    def loaded(self):
+        """True once the data was read from the store"""
+        return self._data is not None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def setdefault(self, key, default=None):
+        # flash() appends to the list returned here, so assume a modification
+        if key not in self.data:
+            self.data[key] = default
+        self.modified = True
+        return self.data[key]
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface keeping only the session id in the cookie"""
+
+    def __init__(self, store, gc_every=1000, gc_batch=1000):
+        self.store = store
+        self.gc_every = gc_every
+        self.gc_batch = gc_batch
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid is not None and len(sid) != 43:
+            sid = None
+        return ServerSideSession(self.store, sid)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session.loaded:
+            # nobody looked at the session during this request
+            return
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time()
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            session.modified = True
+        if session.modified:
+            self.store.save(session.sid, dumps(dict(session.data)), now + lifetime)
+            if self.gc_every and random.randrange(self.gc_every) == 0:
+                self.store.gc(self.gc_batch)
+        elif session.expires - now < lifetime / 2:
+            # refresh the expiry now and then, not on every request
+            self.store.touch(session.sid, now + lifetime)
+        else:
+            return
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
+
+
+def init_app(app):
+    """install the server side sessions if SESSION_BACKEND asks for them"""
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return
+    if backend != 'sqlite':
+        raise ValueError('unknown SESSION_BACKEND {!r}'.format(backend))
+    app.session_interface = ServerSideSessionInterface(
+        SQLiteSessionStore(app.config['SESSION_SQLITE_PATH']),
+        gc_every=app.config['SESSION_GC_EVERY'])
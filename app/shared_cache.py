@@ -0,0 +1,254 @@
+"""
+Shared cache for hot lookups.
+
+Every gunicorn worker would otherwise keep its own cache of users, username
+lookups and translations: the same entries once per worker, and a cold miss in
+every worker. SHARED_CACHE selects where the entries live:
+* 'memory': a dict of the process, for development and tests
+* 'sqlite:///<path>': a SQLite file in WAL mode shared by all workers on the
+  host. Readers never take a lock, a write does not wait for readers.
+Entries belong to a namespace ('user', 'username', 'translate', ...) and
+expire after a time to live. Both stores hold at most SHARED_CACHE_SIZE
+entries, the oldest written go first.
+
+Invalidation is versioned: invalidate(namespace) increments the version of the
+namespace, which makes all of its entries stale at once without deleting them
+(`flask cache invalidate <namespace>`, e.g. after changing the translation
+dictionary). cached() only stores a loaded value if the version did not change
+while it was loaded, so a value read before an invalidation is not cached
+after it. Single entries are dropped with delete(), after the change was
+committed; the time to live bounds how long a missed invalidation can last.
+
+Values are stored with the binary encoding of the session store
+(app/sessions.py), so they have to be plain values: None, bool, int, float,
+str, bytes, lists, tuples and dicts of those.
+"""
+import random
+import sqlite3
+import threading
+from time import time
+from app.sessions import dumps, loads
+
+# stands for "not cached", None is a value that can be cached
+MISSING = object()
+
+
+class Cache(object):
+    """
+    the cache API, over a store implementing _lookup(), _store(), delete() and
+    invalidate()
+    Parameters
+    ----------
+    ttl : float
+        seconds an entry lives, if set() or cached() do not say otherwise
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def get(self, namespace, key, default=None):
+        """the cached value of key, default if there is none"""
+        value = self._lookup(namespace, key)[1]
+        return default if value is MISSING else value
+
+    def set(self, namespace, key, value, ttl=None):
+        """cache value for key"""
+        self._store(namespace, key, value, None, ttl or self.ttl)
+
+    def cached(self, namespace, key, load, ttl=None):
+        """
+        the cached value of key, or the one returned by load(), which is cached
+        unless it is None or the namespace was invalidated meanwhile
+        """
+        version, value = self._lookup(namespace, key)
+        if value is MISSING:
+            value = load()
+            if value is not None:
+                self._store(namespace, key, value, version, ttl or self.ttl)
+        return value
+
+    def namespace(self, name, ttl=None):
+        """the get(key)/set(key, value) mapping of one namespace, see Namespace"""
+        return Namespace(self, name, ttl)
+
+    def _lookup(self, namespace, key):
+        """(current version of namespace, value or MISSING)"""
+        raise NotImplementedError
+
+    def _store(self, namespace, key, value, version, ttl):
+        """store value if version is None or still the current version of namespace"""
+        raise NotImplementedError
+
+
+class Namespace(object):
+    """
+    one namespace of a cache with tuple keys, for code that takes a cache object
+    with get() and set(), like the Translator backends
+    """
+
+    def __init__(self, cache, name, ttl=None):
+        self.cache = cache
+        self.name = name
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key):
+        return '\x1f'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+    def get(self, key):
+        """cached value or None"""
+        return self.cache.get(self.name, self._key(key))
+
+    def set(self, key, value):
+        """cache value for key"""
+        self.cache.set(self.name, self._key(key), value, self.ttl)
+
+
+class MemoryCache(Cache):
+    """entries in a dict of the current process"""
+
+    def __init__(self, size, ttl):
+        super(MemoryCache, self).__init__(ttl)
+        self.size = size
+        # (namespace, key) -> (version, value, expires), in the order they were written
+        self._entries = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, namespace, key):
+        # no lock: a single dict lookup is atomic
+        version = self._versions.get(namespace, 0)
+        entry = self._entries.get((namespace, key))
+        if entry is None or entry[0] != version or entry[2] <= time():
+            return version, MISSING
+        return version, entry[1]
+
+    def _store(self, namespace, key, value, version, ttl):
+        with self._lock:
+            current = self._versions.get(namespace, 0)
+            if version is not None and version != current:
+                return
+            self._entries.pop((namespace, key), None)
+            self._entries[(namespace, key)] = (current, value, time() + ttl)
+            while len(self._entries) > self.size:
+                del self._entries[next(iter(self._entries))]
+
+    def delete(self, namespace, key):
+        """drop the entry of key"""
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+    def invalidate(self, namespace):
+        """make all entries of namespace stale"""
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            for entry_key in [entry_key for entry_key in self._entries
+                              if entry_key[0] == namespace]:
+                del self._entries[entry_key]
+
+
+class SQLiteCache(Cache):
+    """
+    entries in a SQLite file, shared by all processes using the same path.
+    The order of rowids is the order of writes, eviction deletes the lowest ones
+    on average every evict_every writes.
+    """
+
+    def __init__(self, path, size, ttl, evict_every=100):
+        super(SQLiteCache, self).__init__(ttl)
+        self.path = path
+        self.size = size
+        self.evict_every = evict_every
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_namespace (name TEXT PRIMARY KEY, '
+                     'version INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_entry (namespace TEXT NOT NULL, '
+                     'key TEXT NOT NULL, version INTEGER NOT NULL, value BLOB NOT NULL, '
+                     'expires REAL NOT NULL, PRIMARY KEY (namespace, key))')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5,
+                                                      isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # losing the last writes in a power failure only costs cache misses
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def reset(self):
+        """drop the connections, e.g. the ones a forked process inherited"""
+        self._local = threading.local()
+
+    def _lookup(self, namespace, key):
+        row = self._conn().execute(
+            'SELECT n.version, e.value FROM cache_namespace n LEFT JOIN cache_entry e '
+            'ON e.namespace = n.name AND e.key = ? AND e.version = n.version '
+            'AND e.expires > ? WHERE n.name = ?', (key, time(), namespace)).fetchone()
+        if row is None:
+            return 0, MISSING
+        return row[0], MISSING if row[1] is None else loads(row[1])
+
+    def _store(self, namespace, key, value, version, ttl):
+        conn = self._conn()
+        conn.execute('INSERT OR IGNORE INTO cache_namespace VALUES (?, 0)', (namespace,))
+        # the version check and the write are one statement
+        condition, parameters = ('', ()) if version is None else (' AND version = ?',
+                                                                  (version,))
+        conn.execute(
+            'INSERT OR REPLACE INTO cache_entry SELECT name, ?, version, ?, ? '
+            'FROM cache_namespace WHERE name = ?' + condition,
+            (key, dumps(value), time() + ttl, namespace) + parameters)
+        if random.randrange(self.evict_every) == 0:
+            self.evict()
+
+    def delete(self, namespace, key):
+        """drop the entry of key"""
+        self._conn().execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?',
+                             (namespace, key))
+
+    def invalidate(self, namespace):
+        """make all entries of namespace stale, evict() deletes them"""
+        conn = self._conn()
+        conn.execute('INSERT OR IGNORE INTO cache_namespace VALUES (?, 0)', (namespace,))
+        conn.execute('UPDATE cache_namespace SET version = version + 1 WHERE name = ?',
+                     (namespace,))
+
+    def evict(self):
+        """
+        delete expired and stale entries, then the oldest ones beyond size
+        Returns
+        -------
+        int
+            number of entries left
+        """
+        conn = self._conn()
+        conn.execute('DELETE FROM cache_entry WHERE expires <= ? OR version < ('
+                     'SELECT version FROM cache_namespace WHERE name = cache_entry.namespace)',
+                     (time(),))
+        count = conn.execute('SELECT count(*) FROM cache_entry').fetchone()[0]
+        if count > self.size:
+            conn.execute('DELETE FROM cache_entry WHERE rowid IN (SELECT rowid FROM '
+                         'cache_entry ORDER BY rowid LIMIT ?)', (count - self.size,))
+            count = self.size
+        return count
+
+
+def create_cache(uri, size, ttl):
+    """cache for a SHARED_CACHE value"""
+    if uri == 'memory':
+        return MemoryCache(size, ttl)
+    if uri.startswith('sqlite:///'):
+        return SQLiteCache(uri[len('sqlite:///'):], size, ttl)
+    raise ValueError('unknown SHARED_CACHE {!r}'.format(uri))
+
+
+def get_cache(app):
+    """the cache of app, created on first use"""
+    cache = app.extensions.get('shared_cache')
+    if cache is None:
+        cache = app.extensions['shared_cache'] = create_cache(
+            app.config['SHARED_CACHE'], app.config['SHARED_CACHE_SIZE'],
+            app.config['SHARED_CACHE_TTL'])
+    return cache
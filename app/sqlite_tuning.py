@@ -0,0 +1,177 @@
+"""
+SQLite production mode.
+
+Many small deployments keep the default SQLite database. With SQLITE_TUNING
+set, every SQLite connection of the application gets these pragmas on connect:
+* journal_mode=WAL: readers no longer block the writer and vice versa
+* synchronous=NORMAL: in WAL mode a commit no longer waits for an fsync,
+  durability is only lost on power failure, not on a crash of the process
+* mmap_size: reads go through the page cache instead of read() calls
+* busy_timeout: a connection waits for the write lock instead of failing
+  with "database is locked"
+
+SQLite allows one writer at a time, so many small write transactions mostly
+wait for each other. WriterQueue funnels fire-and-forget writes, like the
+last_seen update of every request, through a single thread that commits
+whatever has queued up in one transaction (group commit).
+"""
+from concurrent.futures import Future
+import os
+import queue
+import sqlite3
+import threading
+from sqlalchemy import event
+
+
+def pragmas(config):
+    """the pragma statements for the configured values"""
+    return ['PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA mmap_size={:d}'.format(config['SQLITE_MMAP_SIZE']),
+            'PRAGMA busy_timeout={:d}'.format(config['SQLITE_BUSY_TIMEOUT'])]
+
+
+def apply_pragmas(connection, statements):
+    """run the pragmas on a DB-API connection"""
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    cursor.close()
+
+
+class WriterQueue(object):
+    """
+    Single writer thread with group commit.
+    Parameters
+    ----------
+    path : str
+        SQLite database file
+    statements : list
+        pragmas for the writer connection
+    max_batch : int
+        most statements committed in one transaction
+    """
+    _STOP = object()
+
+    def __init__(self, path, statements=(), max_batch=500):
+        self.path = path
+        self.statements = statements
+        self.max_batch = max_batch
+        self.commits = 0
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, params=()):
+        """queue a write statement, the returned Future resolves after its commit"""
+        future = Future()
+        self._queue.put((sql, params, future))
+        return future
+
+    def close(self):
+        """commit what is queued and stop the thread"""
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        apply_pragmas(conn, self.statements)
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            # everything that arrived while the last transaction was committing
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._STOP in batch:
+                stop = True
+                batch = [item for item in batch if item is not self._STOP]
+            if batch:
+                self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        """
+        run batch in one transaction. Results are per statement: a failing
+        statement gets its exception and the others are still committed. The
+        future of a statement resolves with its rowcount only once the statement
+        is committed; if the transaction fails, every statement not committed yet
+        gets the exception. Nothing raised here ends the writer thread.
+        """
+        results = {}
+        done = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for sql, params, future in batch:
+                try:
+                    results[future] = (conn.execute(sql, params).rowcount, None)
+                except sqlite3.Error as exc:
+                    results[future] = (None, exc)
+                    if not conn.in_transaction:
+                        # the error rolled back the whole transaction (e.g. ON
+                        # CONFLICT ROLLBACK), the statements before it are lost
+                        for earlier in done:
+                            results[earlier] = (None, exc)
+                        done = []
+                        conn.execute('BEGIN IMMEDIATE')
+                        continue
+                done.append(future)
+            conn.execute('COMMIT')
+        except Exception as exc:  # pylint: disable=W0703
+            for _, _, future in batch:
+                if future not in results or future in done:
+                    results[future] = (None, exc)
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+        self.commits += 1
+        self.written += len(batch)
+        for _, _, future in batch:
+            rowcount, exc = results[future]
+            if exc is None:
+                future.set_result(rowcount)
+            else:
+                future.set_exception(exc)
+
+
+def database_path(uri):
+    """file name of a sqlite:/// URI, None for other databases and in-memory SQLite"""
+    if uri and uri.startswith('sqlite:///') and len(uri) > len('sqlite:///'):
+        return uri[len('sqlite:///'):]
+    return None
+
+
+def get_writer(app):
+    """
+    the writer queue of the primary database, None if SQLite tuning is off.
+    The thread is started per process on first use, so it also works in
+    workers forked from a preloaded master.
+    """
+    path = database_path(app.config['SQLALCHEMY_DATABASE_URI'])
+    if not app.config['SQLITE_TUNING'] or path is None:
+        return None
+    writers = app.extensions.setdefault('sqlite_writer', {})
+    writer = writers.get(os.getpid())
+    if writer is None:
+        writer = writers[os.getpid()] = WriterQueue(path, pragmas(app.config))
+    return writer
+
+
+def init_app(app, db):
+    """install the pragmas on every SQLite engine of the app"""
+    if not app.config['SQLITE_TUNING']:
+        return
+    statements = pragmas(app.config)
+    binds = [None] + list(app.config['SQLALCHEMY_BINDS'] or {})
+    with app.app_context():
+        for bind in binds:
+            engine = db.get_engine(app, bind)
+            if engine.dialect.name != 'sqlite':
+                continue
+            event.listen(engine, 'connect',
+                         lambda conn, record: apply_pragmas(conn, statements))
@@ -0,0 +1,75 @@
+"""
+Streamed page rendering.
+
+render_template() renders the whole page into one string before the first
+byte is sent. With STREAM_TEMPLATES set, render_page() renders with Jinja's
+generate() instead and sends the output while the template runs: everything up
+to a {{ stream_flush() }} marker (the navigation bar, placed before the post
+list) goes out at once, then the posts follow in chunks of about
+STREAM_CHUNK_SIZE bytes while they are fetched in batches (BatchedItems in
+app/pagination.py).
+
+Whatever touches the session has to happen before the response starts, as
+the session cookie is written with the headers: flashed messages are read from
+the session up front.
+"""
+from flask import current_app, g, get_flashed_messages, render_template, \
+    stream_with_context
+
+# never produced by a template on its own
+FLUSH = '\x00flush\x00'
+
+
+def enabled():
+    """True if pages are streamed"""
+    return current_app.config['STREAM_TEMPLATES']
+
+
+def stream_flush():
+    """template global marking where the output so far should be sent"""
+    return FLUSH if g.get('streaming') else ''
+
+
+def chunked(fragments, size):
+    """join template output fragments into chunks of about size characters"""
+    buffer, length = [], 0
+    for fragment in fragments:
+        while FLUSH in fragment:
+            head, fragment = fragment.split(FLUSH, 1)
+            buffer.append(head)
+            if any(buffer):
+                yield ''.join(buffer)
+            buffer, length = [], 0
+        buffer.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if any(buffer):
+        yield ''.join(buffer)
+
+
+def stream_template(template_name, **context):
+    """like render_template(), but returns a response streaming the output"""
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    g.streaming = True
+    # pops the messages from the session now, the template gets them from the request
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    fragments = template.generate(context)
+    return app.response_class(
+        stream_with_context(chunked(fragments, app.config['STREAM_CHUNK_SIZE'])),
+        mimetype='text/html')
+
+
+def render_page(template_name, **context):
+    """stream_template() with STREAM_TEMPLATES, otherwise render_template()"""
+    if enabled():
+        return stream_template(template_name, **context)
+    return render_template(template_name, **context)
+
+
+def init_app(app):
+    """make stream_flush() available to the templates"""
+    app.add_template_global(stream_flush)
@@ -0,0 +1,69 @@
+"""
+Jinja bytecode cache for the application templates.
+
+Jinja compiles a template into Python source and then into a code object the
+first time it is loaded. With a bytecode cache the code object is stored and
+re-used, so a cold worker only unmarshals it instead of compiling again.
+TEMPLATE_CACHE selects the cache:
+* 'filesystem': code objects are written to TEMPLATE_CACHE_DIR and shared by
+  all workers and restarts. Fill it once with `flask templates compile`.
+* 'memory': code objects are kept in a process-wide dict, which survives
+  app re-creation and is inherited by workers forked from a preloaded master.
+"""
+import os
+from jinja2 import BytecodeCache, FileSystemBytecodeCache
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """bytecode cache backed by a plain dict"""
+
+    def __init__(self, store=None):
+        self.store = {} if store is None else store
+
+    def load_bytecode(self, bucket):
+        code = self.store.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self.store[bucket.key] = bucket.bytecode_to_string()
+
+    def clear(self):
+        self.store.clear()
+
+
+# shared by every app instance in the process
+_memory_store = {}
+
+
+def init_app(app):
+    """install the bytecode cache configured by TEMPLATE_CACHE"""
+    kind = app.config['TEMPLATE_CACHE']
+    if not kind:
+        return
+    if kind == 'memory':
+        cache = MemoryBytecodeCache(_memory_store)
+    elif kind == 'filesystem':
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        cache = FileSystemBytecodeCache(directory)
+    else:
+        raise ValueError('unknown TEMPLATE_CACHE {!r}'.format(kind))
+    app.jinja_env.bytecode_cache = cache
+
+
+def compile_all(app):
+    """
+    load every template found in app/templates, the blueprint template folders
+    and the extension templates, which stores them in the bytecode cache
+
+    Returns
+    -------
+    list
+        names of the compiled templates
+    """
+    names = app.jinja_env.list_templates(extensions=('html', 'txt'))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
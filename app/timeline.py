@@ -0,0 +1,144 @@
+"""
+Timelines and cursors.
+
+A cursor marks a position in a timeline by the (timestamp, id) of a post.
+Posts are ordered by timestamp and id, so "newer than the cursor" and "older
+than the cursor" are range conditions on the timestamp index and stay cheap
+however far a client is into the timeline, unlike OFFSET.
+Cursors travel as "<ISO timestamp>_<post id>", e.g. 2018-04-21T10:42:17.316204_42.
+
+/index/since and /explore/since (new_posts() in app/main/routes.py) return the
+posts after a cursor, so an open page only fetches what is new instead of
+reloading and re-rendering the whole first page.
+"""
+from datetime import datetime
+from time import monotonic, sleep
+from flask import json, url_for
+from app import db
+from app.models import Post, followers
+
+# named after the pages showing them, /index/since and /explore/since use the same names
+HOME = 'index'
+EXPLORE = 'explore'
+
+
+def encode_cursor(timestamp, id_):
+    """cursor string of a (timestamp, id) position"""
+    return '{}_{}'.format(timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'), id_)
+
+
+def decode_cursor(value):
+    """
+    (timestamp, id) of a cursor string
+    Returns
+    -------
+    tuple
+        (datetime, int), or None if value is empty or not a cursor
+    """
+    try:
+        timestamp, id_ = value.rsplit('_', 1)
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f'), int(id_)
+    except (AttributeError, ValueError):
+        return None
+
+
+def cursor_of(post):
+    """cursor pointing at post"""
+    return encode_cursor(post.timestamp, post.id)
+
+
+def timeline_filter(timeline, user_id):
+    """
+    criterion selecting the posts of a timeline: HOME is the same set as
+    User.followed_posts() but without the UNION, so it can be combined with
+    cursor conditions, EXPLORE is all posts
+    """
+    if timeline == EXPLORE:
+        return db.true()
+    followed = db.select([followers.c.followed_id]).where(followers.c.follower_id == user_id)
+    return db.or_(Post.user_id == user_id, Post.user_id.in_(followed))
+
+
+def newer_than(cursor):
+    """criterion for posts after cursor"""
+    timestamp, id_ = cursor
+    return db.or_(Post.timestamp > timestamp,
+                  db.and_(Post.timestamp == timestamp, Post.id > id_))
+
+
+def older_than(cursor):
+    """criterion for posts before cursor"""
+    timestamp, id_ = cursor
+    return db.or_(Post.timestamp < timestamp,
+                  db.and_(Post.timestamp == timestamp, Post.id < id_))
+
+
+def posts_since(timeline, user_id, cursor, limit):
+    """
+    the oldest `limit` posts of the timeline after cursor, oldest first, so a
+    client that got a full batch continues from the cursor of the last one
+    """
+    return Post.query.filter(timeline_filter(timeline, user_id), newer_than(cursor)).order_by(
+        Post.timestamp.asc(), Post.id.asc()).limit(limit).all()
+
+
+def latest_cursor(timeline, user_id):
+    """cursor of the newest post of the timeline, None for an empty timeline"""
+    row = db.session.query(Post.timestamp, Post.id).filter(
+        timeline_filter(timeline, user_id)).order_by(
+            Post.timestamp.desc(), Post.id.desc()).first()
+    return encode_cursor(*row) if row else None
+
+
+def post_dict(post):
+    """JSON representation of a post for the polling endpoints"""
+    return {
+        'id': post.id,
+        'body': post.body,
+        'timestamp': post.timestamp.isoformat() + 'Z',
+        'language': post.language or None,
+        'cursor': cursor_of(post),
+        'author': {
+            'username': post.author.username,
+            'avatar': post.author.avatar(70),
+            'url': url_for('main.user', username=post.author.username),
+        },
+    }
+
+
+def wait_for_posts(timeline, user_id, cursor, limit, timeout, interval):
+    """
+    long poll: posts_since(), repeated every interval seconds until there are
+    posts or timeout seconds have passed
+    """
+    deadline = monotonic() + timeout
+    while True:
+        posts = posts_since(timeline, user_id, cursor, limit)
+        if posts or monotonic() >= deadline:
+            return posts
+        # end the read transaction, the next poll has to see new commits
+        db.session.rollback()
+        sleep(max(0, min(interval, deadline - monotonic())))
+
+
+def event_stream(timeline, user_id, cursor, limit, duration, interval):
+    """
+    server-sent events: one 'id: <cursor>' event with a JSON list of posts for
+    every batch of new posts, a comment line while nothing happens. The stream
+    ends after duration seconds, the browser reconnects with Last-Event-ID.
+    Needs the request context (stream_with_context) for url_for.
+    """
+    yield 'retry: {:d}\n\n'.format(int(interval * 1000))
+    deadline = monotonic() + duration
+    while monotonic() < deadline:
+        posts = posts_since(timeline, user_id, cursor, limit)
+        if posts:
+            cursor = (posts[-1].timestamp, posts[-1].id)
+            yield 'id: {}\ndata: {}\n\n'.format(
+                encode_cursor(*cursor), json.dumps([post_dict(post) for post in posts]))
+            if len(posts) == limit:
+                continue
+        else:
+            yield ': keep-alive\n\n'
+        db.session.rollback()
+        sleep(interval)
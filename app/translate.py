@@ -1,17 +1,250 @@
 """
 Translation module.
-Actually it supports MS transaltion API only.
+The actual translation is done by a backend, selected by TRANSLATOR_BACKEND:
+* 'microsoft': Microsoft Translator v2 Ajax API (needs MS_TRANSLATOR_KEY)
+* 'local': dictionary based offline translator, for tests and air-gapped
+  deployments (LOCAL_TRANSLATOR_DICTIONARY)
+All backends share the same plumbing in Translator: a result cache shared by
+the backends (and the workers, see app/shared_cache.py), a per-backend rate
+limit, timeouts and metrics. New backends subclass Translator, implement
+_translate_batch() and get an entry in BACKENDS.
 """
 import json
+import threading
+from time import monotonic, sleep
 import requests # HTTP client for python
 from flask_babel import _
 from flask import current_app
+from app import shared_cache
+
+
+class TranslationError(Exception):
+    """the backend could not translate the text"""
+
+
+class NotConfigured(TranslationError):
+    """the backend is missing its configuration, e.g. an API key"""
+
+
+class RateLimited(TranslationError):
+    """the backend's rate limit did not allow a call within the timeout"""
+
+
+class TokenBucket(object):
+    """rate limiter allowing `rate` calls per second with bursts up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._stamp = monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        take a token if there is one
+        Returns
+        -------
+        float
+            0 if a token was taken, otherwise the seconds until there is one
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """take a token, waiting at most timeout seconds for one"""
+        deadline = monotonic() + timeout
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            if monotonic() + wait > deadline:
+                raise RateLimited('rate limit exceeded')
+            sleep(wait)
+
+
+class Translator(object):
+    """
+    Base class of all translation backends.
+    Parameters
+    ----------
+    config : dict
+        application config, backends must not need an app context
+    cache : Namespace
+        result cache with get() and set(), shared by all backends of the application
+        and, with a SQLite SHARED_CACHE, by all workers (see app/shared_cache.py)
+    """
+    name = None
+
+    def __init__(self, config, cache):
+        self.config = config
+        self.cache = cache
+        self.timeout = config['TRANSLATE_TIMEOUT']
+        rate = config['TRANSLATE_RATE_LIMIT']
+        self.bucket = TokenBucket(rate) if rate else None
+        self.metrics = {'requests': 0, 'cache_hits': 0, 'backend_calls': 0,
+                        'errors': 0, 'backend_seconds': 0.0}
+
+    def translate(self, text, source_language, dest_language):
+        """translate a single text"""
+        return self.translate_batch([text], source_language, dest_language)[0]
+
+    def translate_batch(self, texts, source_language, dest_language):
+        """
+        translate a list of texts, only the ones that are not cached yet go to the backend
+        Returns
+        -------
+        list
+            translations in the order of texts
+        """
+        results = [None] * len(texts)
+        missing = []
+        for i, text in enumerate(texts):
+            results[i] = self.cache.get((self.name, source_language, dest_language, text))
+            if results[i] is None:
+                missing.append(i)
+        self.metrics['requests'] += len(texts)
+        self.metrics['cache_hits'] += len(texts) - len(missing)
+        if missing:
+            if self.bucket is not None:
+                self.bucket.acquire(self.timeout)
+            start = monotonic()
+            self.metrics['backend_calls'] += 1
+            try:
+                translated = self._translate_batch([texts[i] for i in missing],
+                                                   source_language, dest_language)
+            except TranslationError:
+                self.metrics['errors'] += 1
+                raise
+            finally:
+                self.metrics['backend_seconds'] += monotonic() - start
+            for i, translation in zip(missing, translated):
+                results[i] = translation
+                self.cache.set((self.name, source_language, dest_language, texts[i]),
+                               translation)
+        return results
+
+    def _translate_batch(self, texts, source_language, dest_language):
+        raise NotImplementedError
+
+
+class MicrosoftTranslator(Translator):
+    """
+    Microsoft Translator v2 Ajax API, one keep-alive connection per backend.
+    A single text goes to Translate (MS_TRANSLATOR_URL), a batch to TranslateArray
+    (MS_TRANSLATOR_ARRAY_URL), one call per ARRAY_MAX_CHARS characters of text.
+    """
+    name = 'microsoft'
+    # limit of the service for the texts of one TranslateArray call
+    ARRAY_MAX_CHARS = 10000
+
+    def __init__(self, config, cache):
+        super(MicrosoftTranslator, self).__init__(config, cache)
+        self.url = config['MS_TRANSLATOR_URL']
+        self.array_url = config['MS_TRANSLATOR_ARRAY_URL']
+        self.session = requests.Session()
+        self.session.headers['Ocp-Apim-Subscription-Key'] = config['MS_TRANSLATOR_KEY'] or ''
+
+    def _get(self, url, params):
+        """decoded JSON answer of the API, params are URL encoded by requests"""
+        try:
+            req = self.session.get(url, timeout=self.timeout, params=params)
+        except requests.RequestException as exc:
+            raise TranslationError(str(exc))
+        if req.status_code != 200:
+            raise TranslationError('status {}'.format(req.status_code))
+        try:
+            # the Ajax endpoints answer with JSON behind a BOM
+            return json.loads(req.content.decode('utf-8-sig'))
+        except ValueError as exc:
+            raise TranslationError('invalid answer: {}'.format(exc))
+
+    def _translate_batch(self, texts, source_language, dest_language):
+        if not self.config['MS_TRANSLATOR_KEY']:
+            raise NotConfigured('MS_TRANSLATOR_KEY is not set')
+        if len(texts) == 1:
+            return [self._get(self.url, {'text': texts[0], 'from': source_language,
+                                         'to': dest_language})]
+        translations = []
+        for chunk in self._chunks(texts):
+            answer = self._get(self.array_url, {'texts': json.dumps(chunk),
+                                                'from': source_language,
+                                                'to': dest_language})
+            try:
+                translations += [item['TranslatedText'] for item in answer]
+            except (KeyError, TypeError) as exc:
+                raise TranslationError('invalid answer: {!r}'.format(exc))
+        return translations
+
+    def _chunks(self, texts):
+        """texts in lists of at most ARRAY_MAX_CHARS characters, or one longer text"""
+        chunk, size = [], 0
+        for text in texts:
+            if chunk and size + len(text) > self.ARRAY_MAX_CHARS:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(text)
+            size += len(text)
+        if chunk:
+            yield chunk
+
+
+class LocalTranslator(Translator):
+    """
+    Offline translator working from a JSON dictionary file of the form
+    {"de:en": {"guten morgen": "good morning", "welt": "world"}}.
+    A text is looked up as a whole first, otherwise word by word, and words
+    without an entry are kept as they are.
+    """
+    name = 'local'
+
+    def __init__(self, config, cache):
+        super(LocalTranslator, self).__init__(config, cache)
+        self.dictionary = {}
+        path = config['LOCAL_TRANSLATOR_DICTIONARY']
+        if path:
+            with open(path, encoding='utf-8') as dict_file:
+                self.dictionary = json.load(dict_file)
+
+    def _translate_batch(self, texts, source_language, dest_language):
+        table = self.dictionary.get('{}:{}'.format(source_language, dest_language), {})
+        translations = []
+        for text in texts:
+            phrase = table.get(text.lower())
+            if phrase is None:
+                phrase = ' '.join(table.get(word.lower(), word) for word in text.split())
+            translations.append(phrase)
+        return translations
+
+
+BACKENDS = {
+    'microsoft': MicrosoftTranslator,
+    'local': LocalTranslator,
+}
+
+
+def get_translator(app):
+    """the configured backend of app, created once per application"""
+    translator = app.extensions.get('translator')
+    if translator is None:
+        name = app.config['TRANSLATOR_BACKEND']
+        if name not in BACKENDS:
+            raise ValueError('unknown TRANSLATOR_BACKEND {!r}'.format(name))
+        cache = shared_cache.get_cache(app).namespace('translate',
+                                                      app.config['TRANSLATE_CACHE_SECONDS'])
+        translator = app.extensions['translator'] = BACKENDS[name](app.config, cache)
+    return translator
 
 
 def translate(text, source_language, dest_language):
     """
-    This function translate submitted text via Microsoft Translator API.
-    Take care that  MS_TRANSLATOR_KEY is set inyour environment.
+    This function translate submitted text with the configured backend.
     ----------
     text : str
         text to be translated
@@ -24,18 +257,11 @@ def translate(text, source_language, dest_language):
     str
         translated text
     """
-    # check if access key is set in your env
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
+    # pylint: disable=W0212
+    translator = get_translator(current_app._get_current_object())
+    try:
+        return translator.translate(text, source_language, dest_language)
+    except NotConfigured:
         return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    # send HTTP GET request
-    req = requests.get('https://api.microsofttranslator.com/v2/Ajax.svc'
-                       '/Translate?text={}&from={}&to={}'.format(
-                           text, source_language, dest_language),
-                       headers=auth)
-    if req.status_code != 200:
+    except TranslationError:
         return _('Error: the translation service failed.')
-    # decode via json.loads() into a Python string and return it
-    return json.loads(req.content.decode('utf-8-sig'))
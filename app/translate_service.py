@@ -0,0 +1,190 @@
+"""
+Asynchronous translation service.
+
+translate_text() in app/main/routes.py occupies a sync worker for the whole
+round trip to the translation provider. This module runs the same endpoint on
+an asyncio event loop (aiohttp), where a waiting request costs a coroutine
+instead of a worker:
+* identical concurrent (text, source, dest) requests are coalesced, only the
+  first one goes upstream and all of them get its result (single-flight).
+* at most TRANSLATE_MAX_CONCURRENCY upstream requests are in flight at a time.
+* the caller has to be logged in, which is checked by opening the Flask
+  session from the request cookies with the application's session interface.
+
+Results go through the cache of the configured backend (app/translate.py).
+The Microsoft backend is called with aiohttp, after taking a token of the
+backend's rate limit (TRANSLATE_RATE_LIMIT) without blocking the event loop.
+Other backends, which are blocking, run in the default thread pool executor
+and take their tokens there.
+
+Start it with `flask translate serve` and route POST /translate (TRANSLATE_URL)
+to it in the reverse proxy, everything else keeps going to the WSGI app.
+"""
+import asyncio
+from time import monotonic
+import aiohttp
+from aiohttp import web
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from app.translate import get_translator, TranslationError
+
+
+class SingleFlight(object):
+    """
+    Collapse concurrent calls with the same key into one execution.
+    Only calls that overlap in time are coalesced, nothing is cached.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """await factory() unless a call for key is already running, then await that one"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: a client that goes away must not cancel the call for the others
+        return await asyncio.shield(future)
+
+
+class UpstreamError(Exception):
+    """the translation provider failed or is not configured"""
+
+
+async def acquire(bucket, timeout):
+    """TokenBucket.acquire() for coroutines, sleeping on the event loop"""
+    deadline = monotonic() + timeout
+    while True:
+        wait = bucket.take()
+        if not wait:
+            return
+        if monotonic() + wait > deadline:
+            raise UpstreamError('rate limit exceeded')
+        await asyncio.sleep(wait)
+
+
+class TranslateService(object):
+    """
+    Translation client with request coalescing and a concurrency bound
+    Parameters
+    ----------
+    config : dict
+        application config
+    translator : app.translate.Translator
+        the configured backend, supplies the shared cache and metrics
+    """
+
+    def __init__(self, config, translator):
+        self.translator = translator
+        self.url = config['MS_TRANSLATOR_URL']
+        self.key = config['MS_TRANSLATOR_KEY']
+        self.timeout = config['TRANSLATE_TIMEOUT']
+        self.max_concurrency = config['TRANSLATE_MAX_CONCURRENCY']
+        self.limit = None
+        self.flights = SingleFlight()
+        self.upstream_calls = 0
+        self.session = None
+
+    async def start(self):
+        """open the shared HTTP connection pool, must run on the serving event loop"""
+        self.limit = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        """close the HTTP connection pool"""
+        if self.session is not None:
+            await self.session.close()
+
+    async def translate(self, text, source_language, dest_language):
+        """translate text, sharing the upstream call with identical concurrent requests"""
+        cache_key = (self.translator.name, source_language, dest_language, text)
+        self.translator.metrics['requests'] += 1
+        translation = self.translator.cache.get(cache_key)
+        if translation is not None:
+            self.translator.metrics['cache_hits'] += 1
+            return translation
+        key = (text, source_language, dest_language)
+        return await self.flights.do(key, lambda: self._fetch(*key))
+
+    async def _fetch(self, text, source_language, dest_language):
+        async with self.limit:
+            if self.translator.name != 'microsoft':
+                try:
+                    return await asyncio.get_event_loop().run_in_executor(
+                        None, self.translator.translate, text, source_language,
+                        dest_language)
+                except TranslationError as exc:
+                    raise UpstreamError(str(exc))
+            translation = await self._fetch_microsoft(text, source_language, dest_language)
+            self.translator.cache.set(
+                (self.translator.name, source_language, dest_language, text), translation)
+            return translation
+
+    async def _fetch_microsoft(self, text, source_language, dest_language):
+        if not self.key:
+            raise UpstreamError('the translation service is not configured')
+        if self.translator.bucket is not None:
+            await acquire(self.translator.bucket, self.timeout)
+        self.translator.metrics['backend_calls'] += 1
+        self.upstream_calls += 1
+        try:
+            async with self.session.get(
+                    self.url,
+                    params={'text': text, 'from': source_language,
+                            'to': dest_language},
+                    headers={'Ocp-Apim-Subscription-Key': self.key}) as resp:
+                if resp.status != 200:
+                    raise UpstreamError('upstream status {}'.format(resp.status))
+                # the Ajax endpoint answers with a JSON string behind a BOM
+                return await resp.json(encoding='utf-8-sig', content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+            # ValueError: the answer is not JSON
+            raise UpstreamError(str(exc))
+
+
+def is_logged_in(flask_app, cookie_header):
+    """True if the cookies belong to a Flask session with a logged in user"""
+    environ = EnvironBuilder(headers={'Cookie': cookie_header or ''}).get_environ()
+    session = flask_app.session_interface.open_session(flask_app, Request(environ))
+    return session is not None and 'user_id' in session
+
+
+def create_service(flask_app):
+    """
+    Build the aiohttp application serving POST /translate with the same form
+    fields and JSON answer as translate_text()
+    """
+    service = TranslateService(flask_app.config, get_translator(flask_app))
+
+    async def translate_text(request):
+        if not is_logged_in(flask_app, request.headers.get('Cookie')):
+            raise web.HTTPUnauthorized()
+        form = await request.post()
+        try:
+            translation = await service.translate(form['text'],
+                                                  form['source_language'],
+                                                  form['dest_language'])
+        except KeyError:
+            raise web.HTTPBadRequest()
+        except UpstreamError as exc:
+            return web.json_response({'error': str(exc)}, status=502)
+        return web.json_response({'text': translation})
+
+    async def on_startup(_):
+        await service.start()
+
+    async def on_cleanup(_):
+        await service.close()
+
+    aio_app = web.Application()
+    aio_app['service'] = service
+    aio_app.router.add_post('/translate', translate_text)
+    aio_app.on_startup.append(on_startup)
+    aio_app.on_cleanup.append(on_cleanup)
+    return aio_app
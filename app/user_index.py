@@ -0,0 +1,103 @@
+"""
+Existence index for usernames and email addresses.
+
+Registration and profile edits have to check that a username or email is
+still free. Most names people try are free, so a Bloom filter of all names in
+the user table can answer "definitely free" without a query. A Bloom filter
+has no false negatives for the values it was built from, only false positives,
+which fall back to the database query.
+The index of one worker does not see users registered through another worker,
+so it is only ever used to skip the query, never to reject a name. The unique
+indexes on user.username and user.email stay the final authority, see
+register() in app/auth/routes.py.
+"""
+from hashlib import blake2b
+import math
+import threading
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over strings.
+    Parameters
+    ----------
+    capacity : int
+        number of values the filter is sized for
+    error_rate : float
+        false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # double hashing: k positions from two 64 bit halves of one digest
+        digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        """add value to the set"""
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(value))
+
+
+class UserIndex(object):
+    """Bloom filters of the usernames and emails in the user table"""
+
+    def __init__(self, usernames, emails, capacity):
+        self.usernames = BloomFilter(capacity)
+        self.emails = BloomFilter(capacity)
+        for username in usernames:
+            self.usernames.add(username)
+        for email in emails:
+            self.emails.add(email)
+        self._lock = threading.Lock()
+
+    @property
+    def full(self):
+        """True once the filters hold more values than they were sized for"""
+        return self.usernames.count > self.usernames.capacity
+
+    def add(self, username=None, email=None):
+        """record a new or renamed user"""
+        with self._lock:
+            if username:
+                self.usernames.add(username)
+            if email:
+                self.emails.add(email)
+
+    def maybe_taken(self, username=None, email=None):
+        """False if neither value can be in the user table, True if it might be"""
+        return bool((username and username in self.usernames) or
+                    (email and email in self.emails))
+
+
+def build(users):
+    """
+    build an index from (username, email) rows, sized for twice their number so
+    that it does not need a rebuild for a while
+    """
+    users = list(users)
+    return UserIndex((u for u, _ in users if u), (e for _, e in users if e),
+                     capacity=max(1000, 2 * len(users)))
+
+
+def get_index(app):
+    """the index of app, built from the user table on first use and when full"""
+    index = app.extensions.get('user_index')
+    if index is None or index.full:
+        from app.models import User
+        index = app.extensions['user_index'] = build(
+            User.query.with_entities(User.username, User.email))
+    return index
@@ -0,0 +1,124 @@
+"""
+Production entry point, the ENTRYPOINT of the Docker image:
+(venv) $ python boot.py
+1. applies the database migrations (`flask db upgrade`), retrying while the
+   database is still starting
+2. compiles the translations, the same code as `flask translate compile`
+3. renders the error pages, the same code as `flask errors build`
+4. serves the application with gunicorn, configured by the SERVER_* values of
+   Config (see config.py)
+
+The application is loaded once in the gunicorn master (preload) and the
+workers are forked from it, so they share its imported modules and warm
+caches. Every worker drops the database connections it inherited (post_fork).
+
+Worker models, SERVER_WORKER_CLASS:
+* sync: one request at a time per process, the gunicorn default
+* gthread: SERVER_THREADS requests per process, threads wait on the database
+  or the network without holding up the others
+* gevent: many requests per process on greenlets, needs the gevent package.
+  SQLite calls block the whole worker, use it with a networked database.
+
+`flask bench servers` compares them (see app/benchmarks.py).
+--skip-setup starts the server without steps 1 to 3.
+"""
+import os
+import sys
+import time
+from config import Config
+
+if Config.SERVER_WORKER_CLASS == 'gevent':
+    # before anything else imports socket, threading or ssl
+    try:
+        from gevent import monkey
+    except ImportError:
+        sys.exit('SERVER_WORKER_CLASS=gevent needs the gevent package, which is not in '
+                 'requirements.txt: pip install gevent, or use gthread')
+    monkey.patch_all()
+
+# pylint: disable=C0413
+from gunicorn.app.base import BaseApplication
+from app import cli, create_app, lazy
+from app.errors import pages
+
+
+def server_options(config):
+    """gunicorn settings for the SERVER_* values of config"""
+    worker_class = config['SERVER_WORKER_CLASS']
+    if worker_class not in ('sync', 'gthread', 'gevent'):
+        raise ValueError('unknown SERVER_WORKER_CLASS {!r}'.format(worker_class))
+    options = {
+        'bind': config['SERVER_BIND'],
+        'worker_class': worker_class,
+        'workers': config['SERVER_WORKERS'],
+        # sync workers ignore threads, more than one would turn them into gthread
+        'threads': config['SERVER_THREADS'] if worker_class == 'gthread' else 1,
+        'timeout': config['SERVER_TIMEOUT'],
+        'keepalive': config['SERVER_KEEPALIVE'],
+        'max_requests': config['SERVER_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVER_MAX_REQUESTS'] // 10,
+        'preload_app': True,
+        'accesslog': '-',
+        'errorlog': '-',
+    }
+    if worker_class == 'gevent':
+        options['worker_connections'] = 1000
+    # the heartbeat file of every worker, /tmp may be a slow disk in containers
+    if os.path.isdir('/dev/shm'):
+        options['worker_tmp_dir'] = '/dev/shm'
+    return options
+
+
+class Server(BaseApplication):
+    """gunicorn running app with options"""
+    # pylint: disable=W0223
+
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+        application = self.application
+
+        def post_fork(server, worker):  # pylint: disable=W0613
+            lazy.after_fork(application)
+        self.cfg.set('post_fork', post_fork)
+
+    def load(self):
+        return self.application
+
+
+def upgrade_database(app, attempts=10, delay=3):
+    """`flask db upgrade`, retried while the database does not accept connections"""
+    from flask_migrate import upgrade
+    from sqlalchemy.exc import OperationalError
+    lazy.ensure(app, 'migrate')
+    with app.app_context():
+        for attempt in range(1, attempts + 1):
+            try:
+                upgrade()
+                return
+            except OperationalError:
+                if attempt == attempts:
+                    raise
+                app.logger.warning('database not ready, retrying in %d seconds', delay)
+                time.sleep(delay)
+
+
+def main(argv):
+    """set up and serve"""
+    app = create_app()
+    if '--skip-setup' not in argv:
+        upgrade_database(app)
+        cli.compile_translations()
+        pages.build(app)
+    # connections opened by the setup must not be shared with the workers
+    lazy.after_fork(app)
+    Server(app, server_options(app.config)).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,15 +15,141 @@ class Config(object):
     #  cryptographic key usuful when generating signatures or tokens
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     POSTS_PER_PAGE = 25
+    # `flask posts archive` moves posts older than this many days to the archive
+    POSTS_ARCHIVE_DAYS = int(os.environ.get('POSTS_ARCHIVE_DAYS') or 365)
+    # polling for new posts, see new_posts() in app/main/routes.py
+    TIMELINE_BATCH = 50
+    TIMELINE_POLL_INTERVAL = float(os.environ.get('TIMELINE_POLL_INTERVAL') or 2)
+    TIMELINE_LONGPOLL_MAX = float(os.environ.get('TIMELINE_LONGPOLL_MAX') or 25)
+    TIMELINE_STREAM_SECONDS = float(os.environ.get('TIMELINE_STREAM_SECONDS') or 55)
+    # follower graph index (app/graph.py)
+    GRAPH_MAX_AGE = int(os.environ.get('GRAPH_MAX_AGE') or 300)
+    GRAPH_SNAPSHOT = os.environ.get('GRAPH_SNAPSHOT')
+    GRAPH_SUGGESTIONS = 10
+    # items per page of the JSON API (app/api), default and maximum of ?limit=
+    API_PAGE_SIZE = 25
+    API_MAX_PAGE_SIZE = 100
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # connection pool, unset values keep the SQLAlchemy defaults
+    # (SQLite file databases do not use a sized pool, leave them unset there)
+    SQLALCHEMY_POOL_SIZE = int(os.environ['DB_POOL_SIZE']) \
+        if os.environ.get('DB_POOL_SIZE') else None
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ['DB_MAX_OVERFLOW']) \
+        if os.environ.get('DB_MAX_OVERFLOW') else None
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ['DB_POOL_TIMEOUT']) \
+        if os.environ.get('DB_POOL_TIMEOUT') else None
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ['DB_POOL_RECYCLE']) \
+        if os.environ.get('DB_POOL_RECYCLE') else None
+    # read replica for read only views, see app/routing.py, and a separate database
+    # for archived posts (app/archive.py), without it they stay in the primary one
+    SQLALCHEMY_BINDS = {
+        name: os.environ[variable] for name, variable in (
+            ('replica', 'DATABASE_REPLICA_URL'), ('archive', 'ARCHIVE_DATABASE_URL'))
+        if os.environ.get(variable)} or None
+    # WAL, pragmas and a group committing writer for SQLite (app/sqlite_tuning.py)
+    SQLITE_TUNING = os.environ.get('SQLITE_TUNING') is not None
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # translation backend, see app/translate.py: 'microsoft' or 'local'
+    TRANSLATOR_BACKEND = os.environ.get('TRANSLATOR_BACKEND') or 'microsoft'
+    LOCAL_TRANSLATOR_DICTIONARY = os.environ.get('LOCAL_TRANSLATOR_DICTIONARY')
+    # backend calls per second, 0 means unlimited
+    TRANSLATE_RATE_LIMIT = float(os.environ.get('TRANSLATE_RATE_LIMIT') or 0)
+    # seconds a translation stays in the shared cache
+    TRANSLATE_CACHE_SECONDS = int(os.environ.get('TRANSLATE_CACHE_SECONDS') or 7 * 24 * 3600)
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.microsofttranslator.com/v2/Ajax.svc/Translate'
+    MS_TRANSLATOR_ARRAY_URL = os.environ.get('MS_TRANSLATOR_ARRAY_URL') or \
+        'https://api.microsofttranslator.com/v2/Ajax.svc/TranslateArray'
+    # where the browser posts translation requests, e.g. the async service
+    # started by `flask translate serve` (see app/translate_service.py)
+    TRANSLATE_URL = os.environ.get('TRANSLATE_URL') or '/translate'
+    TRANSLATE_TIMEOUT = float(os.environ.get('TRANSLATE_TIMEOUT') or 10)
+    TRANSLATE_MAX_CONCURRENCY = int(os.environ.get('TRANSLATE_MAX_CONCURRENCY') or 8)
     ADMINS = ['your-email@example.com']
+    # 'cookie' (Flask's signed cookie) or 'sqlite' (server side, see app/sessions.py)
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND') or 'cookie'
+    SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH') or \
+        os.path.join(basedir, 'sessions.db')
+    # on average every n-th session write deletes a batch of expired sessions
+    SESSION_GC_EVERY = int(os.environ.get('SESSION_GC_EVERY') or 1000)
+    # number of reverse proxies in front of the app, whose X-Forwarded-For and
+    # X-Forwarded-Proto headers are trusted; 0 uses the peer address as client address
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT') or 0)
+    # rate limit counters: 'memory' (per worker) or 'sqlite:///<path>' (per host)
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'memory'
+    # "<count>/<seconds>" per endpoint, keyed by client IP and by form field
+    RATELIMITS = {
+        'login': {'ip': '30/60', 'username': '5/60'},
+        'reset_password_request': {'ip': '5/300', 'email': '3/3600'},
+    }
     LANGUAGES = ['de', 'en']
+    # defer Flask-Migrate and Flask-Mail setup until first use (faster worker boot)
+    LAZY_EXTENSIONS = os.environ.get('LAZY_EXTENSIONS') is not None
+    # compile templates and load translation catalogs in create_app(), so a
+    # gunicorn master started with --preload hands them to every forked worker
+    PREWARM_CACHES = os.environ.get('PREWARM_CACHES') is not None
+    # gunicorn started by boot.py: worker model 'sync', 'gthread' or 'gevent', number of
+    # worker processes (default 2 per CPU + 1), threads per gthread worker
+    SERVER_BIND = os.environ.get('SERVER_BIND') or '0.0.0.0:{}'.format(
+        os.environ.get('PORT') or 5000)
+    SERVER_WORKER_CLASS = os.environ.get('SERVER_WORKER_CLASS') or 'sync'
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS') or 2 * (os.cpu_count() or 1) + 1)
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS') or 4)
+    SERVER_TIMEOUT = int(os.environ.get('SERVER_TIMEOUT') or 30)
+    SERVER_KEEPALIVE = int(os.environ.get('SERVER_KEEPALIVE') or 2)
+    # restart a worker after this many requests (plus up to 10% jitter), 0 never
+    SERVER_MAX_REQUESTS = int(os.environ.get('SERVER_MAX_REQUESTS') or 0)
+    # self-hosted assets, see app/assets.py and `flask assets build`
+    ASSETS_LOCAL = os.environ.get('ASSETS_LOCAL') is not None
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    ASSETS_MOMENT_SOURCE = os.environ.get('ASSETS_MOMENT_SOURCE') or \
+        'https://cdnjs.cloudflare.com/ajax/libs/moment.js/2.18.1/moment-with-locales.min.js'
+    # send pages while they render (see app/streaming.py), chunk size in characters,
+    # posts fetched per query while streaming
+    STREAM_TEMPLATES = os.environ.get('STREAM_TEMPLATES') is not None
+    STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE') or 8192)
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE') or 10)
+    # gzip/brotli compress responses in the app (see app/compression.py), for
+    # deployments without a compressing proxy in front
+    COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES') is not None
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_MIN_SIZE = 500
+    # cache shared by the workers of a host (see app/shared_cache.py): 'memory' (per
+    # worker) or 'sqlite:///<path>', at most SHARED_CACHE_SIZE entries, which live
+    # SHARED_CACHE_TTL seconds unless the caller says otherwise
+    SHARED_CACHE = os.environ.get('SHARED_CACHE') or 'memory'
+    SHARED_CACHE_SIZE = int(os.environ.get('SHARED_CACHE_SIZE') or 10000)
+    SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL') or 300)
+    # load shedding (see app/admission.py): in-flight requests per worker process,
+    # "<class>=<count>,..." with the classes total, main, auth, api and stream,
+    # answered with 503 and Retry-After seconds beyond that; unset for no limits
+    ADMISSION_LIMITS = os.environ.get('ADMISSION_LIMITS') or ''
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER') or 5)
+    # pre-rendered 404, 500 and 503 pages, see `flask errors build`
+    ERROR_PAGES_DIR = os.environ.get('ERROR_PAGES_DIR') or \
+        os.path.join(basedir, '.error_pages')
+    # avatars served by the application (see app/avatars.py): generated identicons or
+    # images of AVATAR_UPSTREAM, e.g. https://www.gravatar.com/avatar/{digest}?d=404&s={size},
+    # cached on disk up to AVATAR_CACHE_SIZE bytes
+    AVATAR_UPSTREAM = os.environ.get('AVATAR_UPSTREAM')
+    AVATAR_UPSTREAM_TIMEOUT = float(os.environ.get('AVATAR_UPSTREAM_TIMEOUT') or 2)
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, '.avatar_cache')
+    AVATAR_CACHE_SIZE = int(os.environ.get('AVATAR_CACHE_SIZE') or 64 * 1024 * 1024)
+    AVATAR_MAX_SIZE = 512
+    AVATAR_MAX_AGE = 24 * 3600
+    # Jinja bytecode cache: 'filesystem', 'memory' or unset (see app/template_cache.py)
+    TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE')
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or \
+        os.path.join(basedir, '.jinja_cache')
@@ -1,6 +1,5 @@
 """Microblog dem app"""
 from app import create_app, db, cli
-from app.models import User, Post
 
 app = create_app()
 cli.register(app)
@@ -8,4 +7,6 @@ cli.register(app)
 @app.shell_context_processor
 def make_shell_context():
     """make context of app"""
+    # only imported when a shell is actually started
+    from app.models import User, Post
     return {'db': db, 'User': User, 'Post': Post}
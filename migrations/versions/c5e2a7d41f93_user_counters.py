@@ -0,0 +1,44 @@
+"""denormalized post and follower counters on user
+
+Revision ID: c5e2a7d41f93
+Revises: 7da49ab91c44
+Create Date: 2018-04-21 10:42:17.316204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e2a7d41f93'
+down_revision = '7da49ab91c44'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('post_count', sa.Integer(), nullable=False,
+                                    server_default='0'))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), nullable=False,
+                                    server_default='0'))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), nullable=False,
+                                    server_default='0'))
+    # fill the counters of existing users; built with SQLAlchemy so that the
+    # reserved word user is quoted where the database needs it (PostgreSQL)
+    user = sa.table('user', sa.column('id'), sa.column('post_count'),
+                    sa.column('follower_count'), sa.column('followed_count'))
+    post = sa.table('post', sa.column('user_id'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+
+    def count(table, condition):
+        return sa.select([sa.func.count()]).select_from(table).where(condition).as_scalar()
+    op.execute(user.update().values(
+        post_count=count(post, post.c.user_id == user.c.id),
+        follower_count=count(followers, followers.c.followed_id == user.c.id),
+        followed_count=count(followers, followers.c.follower_id == user.c.id)))
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
@@ -0,0 +1,25 @@
+"""index posts by author, built online
+
+Revision ID: e3b8d94a1c07
+Revises: c5e2a7d41f93
+Create Date: 2018-05-02 19:08:45.120733
+
+"""
+from alembic import op
+from app import online_migrations
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8d94a1c07'
+down_revision = 'c5e2a7d41f93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # profile pages and the home timeline look posts up by user_id
+    online_migrations.create_index(op, op.f('ix_post_user_id'), 'post', ['user_id'])
+
+
+def downgrade():
+    online_migrations.drop_index(op, op.f('ix_post_user_id'), 'post')
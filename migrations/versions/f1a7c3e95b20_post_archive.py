@@ -0,0 +1,36 @@
+"""archive table for old posts
+
+Revision ID: f1a7c3e95b20
+Revises: e3b8d94a1c07
+Create Date: 2018-05-09 21:14:03.557812
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a7c3e95b20'
+down_revision = 'e3b8d94a1c07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # with ARCHIVE_DATABASE_URL set `flask posts archive` creates the table there instead
+    op.create_table('post_archive',
+                    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('body', sa.String(length=140), nullable=True),
+                    sa.Column('timestamp', sa.DateTime(), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('language', sa.String(length=5), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_post_archive_timestamp'), 'post_archive', ['timestamp'],
+                    unique=False)
+    op.create_index(op.f('ix_post_archive_user_id'), 'post_archive', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_post_archive_user_id'), table_name='post_archive')
+    op.drop_index(op.f('ix_post_archive_timestamp'), table_name='post_archive')
+    op.drop_table('post_archive')
@@ -7,9 +7,28 @@ the original one.
 Run test by: python tests.py
 """
 from datetime import datetime, timedelta
+import asyncio
+import os
+import sqlite3
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import zlib
+from time import time
+import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from flask import g, json, session
+from markupsafe import Markup
+from app import archive, assets, avatars, benchmarks, create_app, db, i18n, lazy, \
+    online_migrations, post_view, ratelimit, sessions, shared_cache, sqlite_tuning, streaming, \
+    template_cache, timeline, user_index
+from app.compression import CompressionMiddleware
+from app.errors import pages
+from app.graph import FollowerGraph
+from app.translate import get_translator, TokenBucket, TranslationError
+from app.translate_service import TranslateService
+from app.models import User, Post, PostArchive
+from app.pagination import paginate
 from config import Config
 
 class TestConfig(Config):
@@ -43,10 +62,9 @@ class UserModelCase(unittest.TestCase):
     def test_avatar(self):
         """test avatar"""
         user = User(username='mauermbq', email='mark@mauerwerk.biz')
-        self.assertEqual(user.avatar(128),
-                         ('https://www.gravatar.com/avatar/'
-                          '902f85c5068b5726f83f053b126b9514'
-                          '?d=identicon&s=128'))
+        with self.app.test_request_context():
+            self.assertEqual(user.avatar(128),
+                             '/avatar/902f85c5068b5726f83f053b126b9514/128')
 
     def test_follow(self):
         """add some users and test especially folllowers function"""
@@ -111,6 +129,1100 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f_3, [p_3, p_4])
         self.assertEqual(f_4, [p_4])
 
+        # the same timeline as read only views, slotted and without ORM state
+        views = post_view.views(u_1.followed_posts()).all()
+        self.assertEqual([view.id for view in views], [p_2.id, p_4.id, p_1.id])
+        self.assertEqual([view.author.username for view in views], ['henry', 'david', 'mark'])
+        self.assertFalse(hasattr(views[0], '__dict__'))
+        with self.app.test_request_context():
+            self.assertEqual(views[2].author.avatar(70), u_1.avatar(70))
+
+    def test_counters(self):
+        """stored counters follow posts and follows, reconcile repairs drift"""
+        u_1 = User(username='mark', email='mark@mauerwerk.biz')
+        u_2 = User(username='henry', email='henry@example.com')
+        db.session.add_all([u_1, u_2])
+        db.session.commit()
+        u_1.add_post('first')
+        u_1.add_post('second')
+        u_1.follow(u_2)
+        db.session.commit()
+        self.assertEqual((u_1.post_count, u_1.followed_count, u_2.follower_count), (2, 1, 1))
+        self.assertEqual(u_2.followed_posts_count(), 0)
+        u_2.follow(u_1)
+        db.session.commit()
+        self.assertEqual(u_2.followed_posts_count(), 2)
+        u_1.unfollow(u_2)
+        db.session.add(Post(body='not counted', author=u_2))
+        db.session.commit()
+        self.assertEqual((u_1.followed_count, u_2.follower_count, u_2.post_count), (0, 0, 0))
+        self.assertEqual(User.reconcile_counters(), 1)
+        self.assertEqual(u_2.post_count, 1)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_reset_token_single_use(self):
+        """a reset token stops working once the password has changed"""
+        user = User(username='mark', email='mark@mauerwerk.biz')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        token = user.get_reset_password_token()
+        with self.app.test_request_context():
+            self.assertEqual(User.verify_reset_password_token(token), user)
+            self.assertIsNone(User.verify_reset_password_token(token + 'x'))
+        expired = user.get_reset_password_token(expires_in=-10)
+        self.assertIsNone(User.decode_reset_password_token(expired))
+        user.set_password('dog')
+        db.session.commit()
+        # a fresh g, the first check is kept in g for the rest of its request
+        with self.app.app_context(), self.app.test_request_context():
+            self.assertIsNone(User.verify_reset_password_token(token))
+        client = self.app.test_client()
+        response = client.get('/auth/reset_password/' + token + 'x')
+        self.assertTrue(response.headers['Location'].endswith('/index'))
+        fresh = user.get_reset_password_token()
+        self.assertEqual(client.get('/auth/reset_password/' + fresh).status_code, 200)
+
+    def test_taken(self):
+        """username and email are checked with one lookup"""
+        db.session.add(User(username='mark', email='mark@mauerwerk.biz'))
+        db.session.commit()
+        self.assertEqual(User.taken('mark', 'other@example.com'), {'username'})
+        self.assertEqual(User.taken('susan', 'mark@mauerwerk.biz'), {'email'})
+        self.assertEqual(User.taken('susan', 'susan@example.com'), set())
+
+    def test_user_index(self):
+        """the index never reports an existing name as free"""
+        db.session.add(User(username='mark', email='mark@mauerwerk.biz'))
+        db.session.commit()
+        index = user_index.get_index(self.app)
+        self.assertTrue(index.maybe_taken(username='mark'))
+        self.assertTrue(index.maybe_taken(email='mark@mauerwerk.biz'))
+        self.assertFalse(index.maybe_taken(username='susan', email='susan@example.com'))
+        index.add('susan', 'susan@example.com')
+        self.assertTrue(index.maybe_taken(username='susan'))
+
+    def test_register_and_login_pages(self):
+        """the auth views redirect to blueprint endpoints"""
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        self.assertEqual(client.get('/auth/register').status_code, 200)
+        response = client.post('/auth/register', data={
+            'username': 'susan', 'email': 'susan@example.com',
+            'password': 'cat', 'password2': 'cat'})
+        self.assertTrue(response.headers['Location'].endswith('/auth/login'))
+        self.assertEqual(client.get('/auth/login').status_code, 200)
+        response = client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        self.assertTrue(response.headers['Location'].endswith('/index'))
+        self.assertTrue(client.get('/auth/login').headers['Location'].endswith('/index'))
+
+    def test_timeline_pages(self):
+        """index, explore and the profile render and page with the stored counters"""
+        self.app.config.update(WTF_CSRF_ENABLED=False, POSTS_PER_PAGE=2)
+        susan = User(username='susan', email='susan@example.com')
+        susan.set_password('cat')
+        john = User(username='john', email='john@example.com')
+        db.session.add_all([susan, john])
+        db.session.commit()
+        for i in range(3):
+            susan.add_post('post {}'.format(i))
+        susan.follow(john)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        for url in ('/index', '/explore', '/user/susan', '/user/susan?page=2'):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+        page = client.get('/index').get_data(as_text=True)
+        self.assertIn('/index?page=2', page)
+        self.assertIn('/user/susan', page)
+        self.assertIn('/unfollow/john', client.get('/user/john').get_data(as_text=True))
+        self.assertIn('post 0', client.get('/index?page=2').get_data(as_text=True))
+        self.assertEqual(client.get('/user/nobody').status_code, 404)
+
+    def test_index_renders_views(self):
+        """the home page renders PostView objects, no Post model is loaded"""
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        susan = User(username='susan', email='susan@example.com')
+        susan.set_password('cat')
+        john = User(username='john', email='john@example.com')
+        db.session.add_all([susan, john])
+        susan.follow(john)
+        db.session.commit()
+        john.add_post('hello from john')
+        susan.add_post('hello from susan')
+        db.session.commit()
+        with self.app.test_request_context():
+            avatar = john.avatar(70)
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+        db.event.listen(Post, 'load', on_load)
+        try:
+            for stream in (False, True):
+                self.app.config['STREAM_TEMPLATES'] = stream
+                response = client.get('/index')
+                self.assertEqual(response.status_code, 200)
+                page = response.get_data(as_text=True)
+                self.assertLess(page.index('hello from susan'), page.index('hello from john'))
+                self.assertIn('/user/john', page)
+                self.assertIn(avatar, page)
+        finally:
+            db.event.remove(Post, 'load', on_load)
+        self.assertEqual(loaded, [])
+
+
+class LazyConfig(TestConfig):
+    """test configuration with deferred extension initialization"""
+    LAZY_EXTENSIONS = True
+
+
+class LazyStartupCase(unittest.TestCase):
+    """test deferred extension setup"""
+    def test_deferred_until_first_use(self):
+        """migrate and mail are only initialized when ensured"""
+        app = create_app(LazyConfig)
+        self.assertNotIn('migrate', app.extensions)
+        self.assertNotIn('mail', app.extensions)
+        lazy.ensure(app, 'migrate')
+        lazy.ensure(app, 'mail')
+        self.assertIn('migrate', app.extensions)
+        self.assertIn('mail', app.extensions)
+        self.assertFalse(lazy.is_deferred(app, 'mail'))
+
+    def test_prewarm(self):
+        """prewarm compiles templates and loads a catalog per language"""
+        app = create_app(TestConfig)
+        templates, catalogs = lazy.prewarm(app)
+        self.assertGreater(templates, 0)
+        self.assertEqual(catalogs, len(app.config['LANGUAGES']))
+
+    def test_after_fork(self):
+        """a forked worker opens its own SQLite connections"""
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app(TestConfig)
+            store = sessions.SQLiteSessionStore(os.path.join(tmp, 'sessions.db'))
+            app.session_interface = sessions.ServerSideSessionInterface(store)
+            inherited = store._conn()  # pylint: disable=W0212
+            lazy.after_fork(app)
+            self.assertIsNot(store._conn(), inherited)  # pylint: disable=W0212
+
+
+class MemoryTemplateCacheConfig(TestConfig):
+    """test configuration with an in-memory template bytecode cache"""
+    TEMPLATE_CACHE = 'memory'
+
+
+class TemplateCacheCase(unittest.TestCase):
+    """test the Jinja bytecode cache"""
+    def test_compile_all_fills_cache(self):
+        """every compiled template leaves its bytecode in the cache"""
+        app = create_app(MemoryTemplateCacheConfig)
+        cache = app.jinja_env.bytecode_cache
+        self.assertIsInstance(cache, template_cache.MemoryBytecodeCache)
+        cache.clear()
+        names = template_cache.compile_all(app)
+        self.assertIn('_post.html', names)
+        self.assertEqual(len(cache.store), len(names))
+
+
+class LocaleCase(unittest.TestCase):
+    """test locale negotiation and shared catalogs"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_best_locale(self):
+        """client weights decide and unsupported languages are ignored"""
+        languages = tuple(self.app.config['LANGUAGES'])
+        self.assertEqual(i18n.best_locale('de-DE,de;q=0.9,en;q=0.5', languages), 'de')
+        self.assertEqual(i18n.best_locale('fr,en;q=0.8', languages), 'en')
+        self.assertIsNone(i18n.best_locale('fr', languages))
+
+    def test_catalog_loaded_once(self):
+        """requests share the catalog object of their locale"""
+        with self.app.test_request_context(headers={'Accept-Language': 'de'}):
+            i18n.activate()
+            self.assertEqual(g.locale, 'de')
+        self.assertIs(i18n.catalog(self.app, 'de'), self.app.extensions['babel_catalogs']['de'])
+
+
+def fake_translator(hits):
+    """local stand-in for the Microsoft Ajax endpoint, counts requests in hits"""
+    async def translate(request):
+        hits.append(request.query['text'])
+        await asyncio.sleep(0.05)
+        return web.Response(body='\ufeff"[{}] {}"'.format(
+            request.query['to'], request.query['text']).encode('utf-8'))
+    fake = web.Application()
+    fake.router.add_get('/translate', translate)
+    return fake
+
+
+class TranslateServiceCase(unittest.TestCase):
+    """test the async translation service against a local fake translator"""
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.hits = []
+        self.server = TestServer(fake_translator(self.hits), loop=self.loop)
+        self.loop.run_until_complete(self.server.start_server(loop=self.loop))
+        app = create_app(TestConfig)
+        app.config.update(MS_TRANSLATOR_KEY='test',
+                          MS_TRANSLATOR_URL=str(self.server.make_url('/translate')))
+        self.service = TranslateService(app.config, get_translator(app))
+        self.loop.run_until_complete(self.service.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.service.close())
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    def test_identical_requests_coalesced(self):
+        """ten concurrent identical requests cause one upstream call"""
+        calls = [self.service.translate('hallo welt & co', 'de', 'en') for _ in range(10)]
+        calls.append(self.service.translate('guten tag', 'de', 'en'))
+        results = self.loop.run_until_complete(asyncio.gather(*calls))
+        self.assertEqual(results[0], '[en] hallo welt & co')
+        self.assertEqual(len(set(results[:10])), 1)
+        self.assertEqual(sorted(self.hits), ['guten tag', 'hallo welt & co'])
+        self.assertEqual(self.service.flights.coalesced, 9)
+        # later requests are answered from the backend cache
+        self.loop.run_until_complete(self.service.translate('guten tag', 'de', 'en'))
+        self.assertEqual(len(self.hits), 2)
+
+    def test_rate_limit(self):
+        """upstream calls of the service take tokens of the backend's rate limit"""
+        self.service.translator.bucket = TokenBucket(4, burst=1)
+        start = time()
+        self.loop.run_until_complete(asyncio.gather(*[
+            self.service.translate(text, 'de', 'en') for text in ('eins', 'zwei', 'drei')]))
+        self.assertEqual(len(self.hits), 3)
+        self.assertGreater(time() - start, 0.4)
+
+
+class LocalTranslatorConfig(TestConfig):
+    """test configuration using the offline translation backend"""
+    TRANSLATOR_BACKEND = 'local'
+
+
+class TranslatorBackendCase(unittest.TestCase):
+    """test the pluggable translation backends"""
+    def test_local_backend(self):
+        """phrases win over words, unknown words are kept, results are cached"""
+        translator = get_translator(create_app(LocalTranslatorConfig))
+        translator.dictionary = {'de:en': {'guten morgen': 'good morning',
+                                           'hallo': 'hello', 'welt': 'world'}}
+        self.assertEqual(translator.translate_batch(['Guten Morgen', 'hallo schöne Welt'],
+                                                    'de', 'en'),
+                         ['good morning', 'hello schöne world'])
+        self.assertEqual(translator.translate('Guten Morgen', 'de', 'en'), 'good morning')
+        self.assertEqual(translator.metrics['backend_calls'], 1)
+        self.assertEqual(translator.metrics['cache_hits'], 1)
+
+    def test_microsoft_batch(self):
+        """a batch goes to TranslateArray in ARRAY_MAX_CHARS chunks, one text to Translate"""
+        class Session(object):
+            """records the calls instead of sending them"""
+            def __init__(self):
+                self.calls = []
+                self.body = None
+
+            def get(self, url, params, timeout):  # pylint: disable=W0613
+                """answer like the Ajax endpoints"""
+                self.calls.append(url)
+                if 'texts' in params:
+                    answer = [{'TranslatedText': text.upper()}
+                              for text in json.loads(params['texts'])]
+                else:
+                    answer = params['text'].upper()
+                response = requests.Response()
+                response.status_code = 200
+                response._content = self.body or ('\ufeff' + json.dumps(answer)).encode('utf-8')
+                return response
+        app = create_app(TestConfig)
+        app.config['MS_TRANSLATOR_KEY'] = 'test'
+        translator = get_translator(app)
+        translator.session = Session()
+        translator.ARRAY_MAX_CHARS = 10
+        self.assertEqual(translator.translate_batch(['eins', 'zwei', 'drei', 'vier'], 'de', 'en'),
+                         ['EINS', 'ZWEI', 'DREI', 'VIER'])
+        self.assertEqual(translator.translate('fünf', 'de', 'en'), 'FÜNF')
+        self.assertEqual(translator.session.calls, [app.config['MS_TRANSLATOR_ARRAY_URL']] * 2 +
+                         [app.config['MS_TRANSLATOR_URL']])
+        # an answer that is not JSON is a translation error like any other failure
+        translator.session.body = b'<html>Service Unavailable</html>'
+        self.assertRaises(TranslationError, translator.translate, 'sechs', 'de', 'en')
+
+
+class RateLimitCase(unittest.TestCase):
+    """test the sliding window rate limiter"""
+    def check_store(self, store):
+        """three hits per minute per key, the previous minute still counts"""
+        now = 6000.0
+        self.assertEqual([store.hit('a', 3, 60, now + i) for i in range(3)], [0, 0, 0])
+        self.assertGreater(store.hit('a', 3, 60, now + 3), 0)
+        self.assertEqual(store.hit('b', 3, 60, now + 3), 0)
+        # half of the previous window overlaps: 1.5 estimated hits
+        self.assertEqual(store.hit('a', 3, 60, now + 90), 0)
+        self.assertGreater(store.hit('a', 3, 60, now + 91), 0)
+
+    def test_memory_store(self):
+        """in-process counters"""
+        self.check_store(ratelimit.MemoryStore())
+
+    def test_sqlite_store(self):
+        """counters shared through a SQLite file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_store(ratelimit.SQLiteStore(os.path.join(tmp, 'ratelimit.db')))
+
+    def test_invalid_limit(self):
+        """a zero limit is a configuration error, not a division by zero per request"""
+        self.assertEqual(ratelimit.parse_limit('5/60'), (5, 60))
+        for spec in ('0/60', '5/0'):
+            self.assertRaises(ValueError, ratelimit.parse_limit, spec)
+
+    def test_client_behind_proxy(self):
+        """with PROXY_COUNT the limit counts the forwarded client address"""
+        class ProxyConfig(TestConfig):
+            """one trusted proxy"""
+            PROXY_COUNT = 1
+            RATELIMITS = {'login': {'ip': '1/60'}}
+        app = create_app(ProxyConfig)
+        app.add_url_rule('/limited', 'limited', ratelimit.limit('login')(lambda: 'ok'),
+                         methods=['POST'])
+        client = app.test_client()
+        statuses = [client.post('/limited', headers={
+            'X-Forwarded-For': address}).status_code
+                    for address in ('10.0.0.1', '10.0.0.2', '10.0.0.1')]
+        self.assertEqual(statuses[:2], [200, 200])
+        self.assertEqual(statuses[2], 429)
+
+
+class ServerSideSessionCase(unittest.TestCase):
+    """test the server side session store"""
+    def test_serializer_roundtrip(self):
+        """the binary encoding keeps types, including tuples and Markup"""
+        data = {'user_id': '42', '_fresh': True, 'n': -3, 'big': 2 ** 70, 'f': 0.5,
+                '_flashes': [('message', Markup('<b>hi</b>'))], 'none': None}
+        decoded = sessions.loads(sessions.dumps(data))
+        self.assertEqual(decoded, data)
+        self.assertIsInstance(decoded['_flashes'][0], tuple)
+        self.assertIsInstance(decoded['_flashes'][0][1], Markup)
+
+    def test_lazy_load_and_gc(self):
+        """data is only read on access, expired sessions are collected"""
+        with tempfile.TemporaryDirectory() as tmp:
+            store = sessions.SQLiteSessionStore(os.path.join(tmp, 'sessions.db'))
+            store.save('a' * 43, sessions.dumps({'user_id': '1'}), time() + 60)
+            store.save('b' * 43, sessions.dumps({'user_id': '2'}), time() - 60)
+            session = sessions.ServerSideSession(store, 'a' * 43)
+            self.assertFalse(session.loaded)
+            self.assertEqual(session['user_id'], '1')
+            self.assertTrue(session.loaded)
+            self.assertFalse(session.modified)
+            self.assertEqual(store.gc(), 1)
+            self.assertIsNone(store.load('b' * 43))
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    """test read replica routing with two SQLite files"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        primary = os.path.join(self.tmp.name, 'primary.db')
+        replica = os.path.join(self.tmp.name, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            """primary and replica are separate files, nothing replicates"""
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_BINDS = {'replica': 'sqlite:///' + replica}
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.Model.metadata.create_all(db.get_engine(self.app, 'replica'))
+        db.session.add(User(username='mark', email='mark@mauerwerk.biz'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_reads_use_replica_until_write(self):
+        """read only requests see the replica, after a write the primary"""
+        with self.app.test_request_context():
+            g.read_only = True
+            self.assertEqual(User.query.count(), 0)
+            db.session.add(User(username='susan', email='susan@example.com'))
+            db.session.commit()
+            self.assertGreater(session['_primary_until'], time())
+            self.assertEqual(User.query.count(), 2)
+
+    def test_last_seen_is_not_sticky(self):
+        """bookkeeping updates do not pin the client to the primary"""
+        with self.app.test_request_context():
+            g.read_only = False
+            user = User.query.first()
+            g.read_only = True
+            user.last_seen = datetime.utcnow()
+            db.session.commit()
+            self.assertNotIn('_primary_until', session)
+            self.assertEqual(User.query.count(), 0)
+
+class SQLiteTuningCase(unittest.TestCase):
+    """test the SQLite writer queue"""
+    def test_group_commit(self):
+        """queued writes are committed together and resolve their futures"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'app.db')
+            conn = sqlite3.connect(path, isolation_level=None)
+            conn.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, last_seen TEXT)')
+            conn.executemany('INSERT INTO user VALUES (?, ?)', ((i, '') for i in range(100)))
+            writer = sqlite_tuning.WriterQueue(path, sqlite_tuning.pragmas(
+                {'SQLITE_MMAP_SIZE': 0, 'SQLITE_BUSY_TIMEOUT': 1000}))
+            futures = [writer.submit('UPDATE user SET last_seen = ? WHERE id = ?', ('now', i))
+                       for i in range(100)]
+            failed = writer.submit('UPDATE nothing SET x = 1')
+            writer.close()
+            self.assertEqual([f.result() for f in futures], [1] * 100)
+            self.assertIsInstance(failed.exception(), sqlite3.Error)
+            self.assertLess(writer.commits, 101)
+            self.assertEqual(conn.execute(
+                "SELECT count(*) FROM user WHERE last_seen = 'now'").fetchone()[0], 100)
+            conn.close()
+
+    def test_writer_survives_errors(self):
+        """a locked database fails the batch, the thread keeps committing later ones"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'app.db')
+            conn = sqlite3.connect(path, isolation_level=None)
+            conn.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, last_seen TEXT)')
+            conn.execute("INSERT INTO user VALUES (1, '')")
+            writer = sqlite_tuning.WriterQueue(path, sqlite_tuning.pragmas(
+                {'SQLITE_MMAP_SIZE': 0, 'SQLITE_BUSY_TIMEOUT': 0}))
+            # the writer has its connection once a first write is through
+            self.assertEqual(writer.submit("UPDATE user SET last_seen = 'ready'").result(), 1)
+            conn.execute('BEGIN IMMEDIATE')
+            locked = writer.submit("UPDATE user SET last_seen = 'locked'")
+            self.assertIsInstance(locked.exception(timeout=5), sqlite3.OperationalError)
+            conn.execute('ROLLBACK')
+            # a conflict rolling back the transaction fails the statements before it
+            before = writer.submit("UPDATE user SET last_seen = 'before'")
+            conflict = writer.submit("INSERT OR ROLLBACK INTO user VALUES (1, 'again')")
+            after = writer.submit("UPDATE user SET last_seen = 'after'")
+            writer.close()
+            self.assertIsInstance(conflict.exception(), sqlite3.IntegrityError)
+            self.assertIsInstance(before.exception(), sqlite3.IntegrityError)
+            self.assertEqual(after.result(), 1)
+            self.assertEqual(conn.execute('SELECT last_seen FROM user').fetchone()[0], 'after')
+            conn.close()
+
+
+class TimelineCase(unittest.TestCase):
+    """test the cursors of the new posts endpoints"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cursor_roundtrip(self):
+        """cursors encode timestamp and id, garbage decodes to None"""
+        now = datetime(2018, 4, 21, 10, 42, 17, 316204)
+        self.assertEqual(timeline.decode_cursor(timeline.encode_cursor(now, 42)), (now, 42))
+        self.assertEqual(timeline.decode_cursor(timeline.encode_cursor(now.replace(
+            microsecond=0), 1)), (now.replace(microsecond=0), 1))
+        self.assertIsNone(timeline.decode_cursor('nonsense'))
+        self.assertIsNone(timeline.decode_cursor(None))
+
+    def test_posts_since(self):
+        """only newer posts of followed users, ties broken by id"""
+        u_1 = User(username='mark', email='mark@mauerwerk.biz')
+        u_2 = User(username='henry', email='henry@example.com')
+        u_3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u_1, u_2, u_3])
+        u_1.follow(u_2)
+        now = datetime.utcnow()
+        old = Post(body='old', author=u_2, timestamp=now - timedelta(seconds=5))
+        same = Post(body='same second', author=u_2, timestamp=now)
+        other = Post(body='not followed', author=u_3, timestamp=now)
+        newer = Post(body='newer', author=u_1, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([old, same, other, newer])
+        db.session.commit()
+        cursor = (old.timestamp, old.id)
+        self.assertEqual(timeline.posts_since(timeline.HOME, u_1.id, cursor, 10),
+                         [same, newer])
+        self.assertEqual(timeline.posts_since(timeline.HOME, u_1.id, cursor, 1), [same])
+        self.assertEqual(len(timeline.posts_since(timeline.EXPLORE, u_1.id, cursor, 10)), 3)
+        self.assertEqual(timeline.latest_cursor(timeline.HOME, u_1.id),
+                         timeline.cursor_of(newer))
+        self.assertEqual(timeline.wait_for_posts(
+            timeline.HOME, u_1.id, (newer.timestamp, newer.id), 10, 0, 1), [])
+
+    def test_wait_not_a_number(self):
+        """?wait=nan answers at once instead of polling forever"""
+        user = User(username='mark', email='mark@mauerwerk.biz')
+        db.session.add(user)
+        db.session.add(Post(body='first', author=user))
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = str(user.id)
+            sess['_fresh'] = True
+        cursor = json.loads(client.get('/explore/since').get_data(as_text=True))['cursor']
+        start = time()
+        response = client.get('/explore/since?cursor={}&wait=nan'.format(cursor))
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(time() - start, 1)
+
+
+class ApiCase(unittest.TestCase):
+    """test the JSON API"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='mark', email='mark@mauerwerk.biz')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_json(self, url, **kwargs):
+        """GET url, return response and decoded body"""
+        response = self.client.get(url, **kwargs)
+        return response, json.loads(response.get_data(as_text=True) or 'null')
+
+    def test_requires_login(self):
+        """anonymous clients get 401, not a redirect to the login page"""
+        response = self.app.test_client().get('/api/v1/explore')
+        self.assertEqual(response.status_code, 401)
+
+    def test_sparse_fields(self):
+        """only the requested fields, unknown fields are rejected"""
+        response, user = self.get_json('/api/v1/users/mark?fields=username,post_count')
+        self.assertEqual(user, {'username': 'mark', 'post_count': 0})
+        response, _ = self.get_json('/api/v1/users/mark?fields=password_hash')
+        self.assertEqual(response.status_code, 400)
+        response, _ = self.get_json('/api/v1/users/nobody')
+        self.assertEqual(response.status_code, 404)
+
+    def test_keyset_pagination_and_etag(self):
+        """pages follow the next links, an unchanged page answers 304"""
+        now = datetime.utcnow()
+        for i in range(5):
+            self.user.add_post('post {}'.format(i)).timestamp = now + timedelta(seconds=i)
+        db.session.commit()
+        url, bodies = '/api/v1/timeline?limit=2&fields=body,author', []
+        while url:
+            response, page = self.get_json(url)
+            self.assertEqual(response.status_code, 200)
+            bodies += [item['body'] for item in page['items']]
+            self.assertEqual({item['author'] for item in page['items']}, {'mark'})
+            url = page['next']
+        self.assertEqual(bodies, ['post 4', 'post 3', 'post 2', 'post 1', 'post 0'])
+        response = self.client.get('/api/v1/explore')
+        again = self.client.get('/api/v1/explore',
+                                headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+
+class FollowerGraphCase(unittest.TestCase):
+    """test the follower graph index"""
+    def setUp(self):
+        # 1 follows 2 and 3, who both follow 4; 3 also follows 5; 4 follows 1, 6 follows 4
+        self.graph = FollowerGraph.from_edges(
+            [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (4, 1), (6, 4)])
+
+    def test_lookups(self):
+        """neighbours, counts and membership from the arrays"""
+        self.assertEqual(list(self.graph.followed(1)), [2, 3])
+        self.assertEqual(list(self.graph.followers(4)), [2, 3, 6])
+        self.assertEqual(self.graph.follower_count(4), 3)
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(1, 4))
+        self.assertEqual(len(self.graph.followed(99)), 0)
+
+    def test_suggestions_and_reach(self):
+        """friends of friends ranked by mutual follows, reach over two hops"""
+        self.assertEqual(self.graph.who_to_follow(1, limit=2), [(4, 2), (5, 1)])
+        self.assertEqual(self.graph.reach(4), (4, True))
+        self.assertFalse(self.graph.reach(4, budget=1)[1])
+
+    def test_incremental_updates(self):
+        """deltas apply on top of the arrays and survive compaction and snapshots"""
+        self.graph.follow(1, 4)
+        self.graph.unfollow(1, 2)
+        self.graph.follow(7, 1)
+        self.assertEqual(sorted(self.graph.followed(1)), [3, 4])
+        self.assertEqual(self.graph.follower_count(1), 2)
+        self.assertEqual(self.graph.edge_count, 8)
+        self.assertEqual(sorted(self.graph.compact().edges()), sorted(self.graph.edges()))
+        with tempfile.TemporaryDirectory() as tmp:
+            self.graph.save(os.path.join(tmp, 'graph'))
+            loaded = FollowerGraph.load(os.path.join(tmp, 'graph'))
+        self.assertEqual(sorted(loaded.edges()), sorted(self.graph.edges()))
+
+    def test_popular_fill_up(self):
+        """users following many others still get popular suggestions"""
+        graph = FollowerGraph.from_edges([(1, followed) for followed in range(2, 200)] +
+                                         [(2, 300), (3, 300), (500, 501)])
+        self.assertEqual(graph.who_to_follow(1, limit=2), [(300, 2), (501, 0)])
+
+    def test_who_to_follow_page(self):
+        """building the graph during a request keeps the logged in user attached"""
+        app = create_app(TestConfig)
+        with app.app_context():
+            db.create_all()
+            u_1 = User(username='mark', email='mark@mauerwerk.biz')
+            u_2 = User(username='henry', email='henry@example.com')
+            u_3 = User(username='mary', email='mary@example.com')
+            db.session.add_all([u_1, u_2, u_3])
+            u_1.follow(u_2)
+            u_2.follow(u_3)
+            db.session.commit()
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = str(u_1.id)
+                sess['_fresh'] = True
+            for _ in range(2):
+                response = client.get('/who_to_follow')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('mary', response.get_data(as_text=True))
+                # the next request rebuilds the graph again
+                app.extensions['follower_graph'].built = 0
+            db.session.remove()
+            db.drop_all()
+
+
+class AssetsCase(unittest.TestCase):
+    """test fingerprinting and serving of static assets"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'css'))
+        os.makedirs(os.path.join(self.tmp.name, 'fonts'))
+        with open(os.path.join(self.tmp.name, 'fonts', 'icons.woff'), 'wb') as font:
+            font.write(b'font')
+        with open(os.path.join(self.tmp.name, 'css', 'site.css'), 'w') as css:
+            css.write("@font-face { src: url('../fonts/icons.woff?v=1') }\n" * 50)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_fingerprint(self):
+        """hashed copies, rewritten CSS references, gzip variants and a manifest"""
+        manifest = assets.fingerprint(self.tmp.name)
+        self.assertRegex(manifest['css/site.css'], r'^dist/css/site\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(self.tmp.name, manifest['css/site.css'])) as css:
+            self.assertIn("url('../fonts/{}?v=1')".format(
+                os.path.basename(manifest['fonts/icons.woff'])), css.read())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmp.name, manifest['css/site.css'] + '.gz')))
+        self.assertEqual(assets.load_manifest(self.tmp.name), manifest)
+
+    def test_serve_immutable_precompressed(self):
+        """fingerprinted files are cached forever and sent precompressed"""
+        app = create_app(TestConfig)
+        app.static_folder = self.tmp.name
+        app.extensions['assets'] = assets.fingerprint(self.tmp.name)
+        with app.test_request_context():
+            url = assets.asset_url('css/site.css')
+        response = app.test_client().get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.mimetype, 'text/css')
+
+
+class StreamingCase(unittest.TestCase):
+    """test streamed rendering and response compression"""
+    def test_chunked(self):
+        """output up to a flush marker is sent at once, the rest in chunks"""
+        fragments = ['<nav>', streaming.FLUSH, '<p>1</p>', '<p>2</p>', '<p>3</p>']
+        self.assertEqual(list(streaming.chunked(fragments, 16)),
+                         ['<nav>', '<p>1</p><p>2</p>', '<p>3</p>'])
+
+    def test_compress_stream(self):
+        """every chunk of a streamed response can be decompressed on arrival"""
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+            return iter([b'<p>post</p>' * 100, b'<p>last</p>'])
+        chunks = []
+        middleware = CompressionMiddleware(wsgi_app)
+        body = middleware({'HTTP_ACCEPT_ENCODING': 'gzip'},
+                          lambda status, headers, exc_info=None: chunks.append(dict(headers)))
+        headers = chunks.pop()
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual([decompressor.decompress(chunk) for chunk in body][:2],
+                         [b'<p>post</p>' * 100, b'<p>last</p>'])
+
+    def test_pages(self):
+        """the timeline pages give the same posts rendered at once and streamed"""
+        class PageConfig(TestConfig):
+            """small pages, streamed in batches smaller than a page"""
+            POSTS_PER_PAGE = 3
+            STREAM_BATCH_SIZE = 2
+        app = create_app(PageConfig)
+        with app.app_context():
+            db.create_all()
+            user = User(username='mark', email='mark@mauerwerk.biz')
+            db.session.add(user)
+            db.session.commit()
+            for i in range(5):
+                user.add_post('post {}'.format(i))
+            db.session.commit()
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = str(user.id)
+                sess['_fresh'] = True
+            for stream in (False, True):
+                app.config['STREAM_TEMPLATES'] = stream
+                for url in ('/index', '/explore', '/user/mark', '/user/mark?page=2'):
+                    response = client.get(url)
+                    self.assertEqual(response.status_code, 200, url)
+                    body = response.get_data(as_text=True)
+                    posts = [i for i in range(5) if 'post {}<'.format(i) in body]
+                    self.assertEqual(posts, [0, 1] if url.endswith('page=2') else [2, 3, 4],
+                                     url)
+            self.assertIn(('stream', 'gzip'), benchmarks.pages(app, 'mark', '/explore', 1))
+            self.assertRaises(ValueError, benchmarks.pages, app, 'mark', '/user/nobody', 1)
+            db.session.remove()
+            db.drop_all()
+
+
+class ArchiveCase(unittest.TestCase):
+    """test moving old posts to the archive"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='mark', email='mark@mauerwerk.biz')
+        db.session.add(self.user)
+        now = datetime.utcnow()
+        for days in range(10):
+            self.user.add_post('post {}'.format(days)).timestamp = now - timedelta(days=days)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_archive_and_fallback(self):
+        """old posts move to the archive, pages past the hot posts read it"""
+        self.assertEqual(archive.archive_older_than(4, batch_size=2), 6)
+        self.assertEqual((Post.query.count(), PostArchive.query.count()), (4, 6))
+        self.assertEqual(User.reconcile_counters(), 0)
+        query = self.user.posts.order_by(Post.timestamp.desc())
+        cold = PostArchive.query.filter_by(user_id=self.user.id).order_by(
+            PostArchive.timestamp.desc())
+        for batch_size in (None, 2):
+            pages = [[post.body for post in paginate(
+                query, page, 3, self.user.post_count, batch_size, cold).items]
+                     for page in (1, 2, 3, 4)]
+            self.assertEqual(pages, [['post 0', 'post 1', 'post 2'],
+                                     ['post 3', 'post 4', 'post 5'],
+                                     ['post 6', 'post 7', 'post 8'], ['post 9']])
+        self.assertEqual(len(self.user.followed_posts(PostArchive).all()), 6)
+
+    def test_archived_post_api(self):
+        """a single archived post is found in the archive, also in a database of its own"""
+        oldest = self.user.posts.order_by(Post.timestamp).first().id
+        with tempfile.TemporaryDirectory() as tmp:
+            for binds in (None, {'archive': 'sqlite:///' + os.path.join(tmp, 'archive.db')}):
+                self.app.config['SQLALCHEMY_BINDS'] = binds
+                archive.archive_older_than(4)
+                client = self.app.test_client()
+                with client.session_transaction() as sess:
+                    sess['user_id'] = str(self.user.id)
+                    sess['_fresh'] = True
+                response = client.get('/api/v1/posts/{}?fields=body,author'.format(oldest))
+                self.assertEqual(json.loads(response.get_data(as_text=True)),
+                                 {'body': 'post 9', 'author': 'mark'})
+                self.assertEqual(client.get('/api/v1/posts/999').status_code, 404)
+                # back to the post table for the next round
+                PostArchive.query.delete()
+                db.session.commit()
+                for days in range(4, 10):
+                    self.user.add_post('post {}'.format(days)).timestamp = \
+                        datetime.utcnow() - timedelta(days=days)
+                db.session.commit()
+                oldest = self.user.posts.order_by(Post.timestamp).first().id
+            self.app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_pages_past_hot_posts(self):
+        """the timeline pages continue with the archive, also in a database of its own"""
+        self.app.config['POSTS_PER_PAGE'] = 3
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+        expected = [['post 0', 'post 1', 'post 2'], ['post 3', 'post 4', 'post 5'],
+                    ['post 6', 'post 7', 'post 8'], ['post 9']]
+        with tempfile.TemporaryDirectory() as tmp:
+            for binds in (None, {'archive': 'sqlite:///' + os.path.join(tmp, 'archive.db')}):
+                self.app.config['SQLALCHEMY_BINDS'] = binds
+                archive.archive_older_than(4)
+                for stream in (False, True):
+                    self.app.config['STREAM_TEMPLATES'] = stream
+                    for url in ('/index?page={}', '/explore?page={}', '/user/mark?page={}'):
+                        pages = []
+                        for page in (1, 2, 3, 4):
+                            response = client.get(url.format(page))
+                            self.assertEqual(response.status_code, 200)
+                            body = response.get_data(as_text=True)
+                            pages.append(['post {}'.format(i) for i in range(10)
+                                          if 'post {}<'.format(i) in body])
+                        self.assertEqual(pages, expected, (binds, stream, url))
+                PostArchive.query.delete()
+                db.session.commit()
+                for days in range(4, 10):
+                    self.user.add_post('post {}'.format(days)).timestamp = \
+                        datetime.utcnow() - timedelta(days=days)
+                db.session.commit()
+            self.app.config['SQLALCHEMY_BINDS'] = None
+
+
+class OnlineMigrationCase(unittest.TestCase):
+    """test resumable backfills"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_language_backfill(self):
+        """posts without a language get one, a finished backfill does nothing"""
+        user = User(username='susan', email='susan@example.com')
+        db.session.add(user)
+        db.session.add_all([Post(body='The quick brown fox jumps over the lazy dog '
+                                      'and runs far away into the forest', author=user)
+                            for _ in range(5)])
+        db.session.commit()
+        job = online_migrations.post_language_backfill(batch_size=2, pause=0)
+        with db.engine.connect() as connection:
+            self.assertEqual(job.run(connection), 5)
+            self.assertEqual(job.run(connection), 0)
+            self.assertEqual(online_migrations.load_progress(connection, job.name), (5, True))
+        self.assertEqual(Post.query.filter(Post.language.is_(None)).count(), 0)
+
+
+class AdmissionCase(unittest.TestCase):
+    """test load shedding and the pre-rendered error pages"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class AdmissionConfig(TestConfig):
+            """at most two requests in flight, one of them a stream"""
+            ADMISSION_LIMITS = 'total=2,stream=1'
+            ERROR_PAGES_DIR = self.tmp.name
+        self.app = create_app(AdmissionConfig)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_shed(self):
+        """over a limit the answer is 503 with Retry-After, without entering the app"""
+        admission = self.app.wsgi_app.admission
+        client = self.app.test_client()
+        self.assertTrue(admission.enter('stream'))
+        response = client.get('/index/since', buffered=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertIn(b'Microblog', response.data)
+        self.assertTrue(admission.enter('api'))
+        response = client.get('/api/v1/explore', buffered=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)['error'], 'Service Unavailable')
+        admission.leave('stream')
+        admission.leave('api')
+        self.assertEqual(client.get('/api/v1/explore', buffered=True).status_code, 401)
+        self.assertEqual(admission.in_flight, {'total': 0, 'stream': 0, 'api': 0})
+        self.assertEqual(admission.rejected, 2)
+
+    def test_error_pages(self):
+        """errors are answered with the built pages"""
+        self.assertEqual(len(pages.build(self.app)), len(pages.CODES) * 2)
+        with open(pages.path(self.app, 404, 'en'), 'wb') as page_file:
+            page_file.write(b'<p>built</p>')
+        self.app.extensions.pop('error_pages')
+        response = self.app.test_client().get('/nothing/here',
+                                               headers={'Accept-Language': 'en'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data, b'<p>built</p>')
+
+    def test_render_during_request(self):
+        """a page rendered on first use leaves the request's session and g alone"""
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(User(username='mark', email='mark@mauerwerk.biz'))
+            db.session.commit()
+
+        def view():
+            user = User.query.first()
+            g.marker = 'outer'
+            self.assertIn(b'Microblog', pages.page(self.app, 404, 'de'))
+            return '{} {} {}'.format(user in db.session, g.marker, g.locale)
+        self.app.add_url_rule('/render', 'render', view)
+        response = self.app.test_client().get('/render', headers={'Accept-Language': 'en'})
+        self.assertEqual(response.get_data(as_text=True), 'True outer en')
+        with self.app.app_context():
+            db.drop_all()
+
+
+class AvatarCase(unittest.TestCase):
+    """test the local avatar service"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class AvatarConfig(TestConfig):
+            """avatars cached in a temporary directory"""
+            AVATAR_CACHE_DIR = self.tmp.name
+        self.app = create_app(AvatarConfig)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_identicon(self):
+        """identicons are cached PNGs of the requested size with a strong ETag"""
+        client = self.app.test_client()
+        response = client.get('/avatar/902f85c5068b5726f83f053b126b9514/70')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertEqual(response.data[16:24], b'\x00\x00\x00F\x00\x00\x00F')
+        self.assertEqual(avatars.identicon('902f85c5068b5726f83f053b126b9514', 70),
+                         response.data)
+        self.assertNotEqual(avatars.identicon('0' * 32, 70), response.data)
+        self.assertEqual(len(avatars.cache(self.app).files()), 1)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        response = client.get('/avatar/902f85c5068b5726f83f053b126b9514/70',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get('/avatar/nothex/70').status_code, 404)
+        self.assertEqual(client.get('/avatar/{}/4096'.format('0' * 32)).status_code, 404)
+
+    def test_lru_eviction(self):
+        """beyond the size cap the least recently used files go first"""
+        cache = avatars.DiskCache(self.tmp.name, 250)
+        for name in ('aa', 'bb'):
+            cache.put(name, b'x' * 100)
+        os.utime(cache.path('aa'), (1, 1))
+        os.utime(cache.path('bb'), (2, 2))
+        self.assertEqual(cache.get('aa'), b'x' * 100)
+        cache.put('cc', b'x' * 100)
+        self.assertIsNone(cache.get('bb'))
+        self.assertIsNotNone(cache.get('aa'))
+        self.assertEqual(cache.size, 200)
+
+
+class SharedCacheCase(unittest.TestCase):
+    """test the shared cache and the users cached in it"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def check_cache(self, cache, other):
+        """other is a second handle of the same cache, e.g. of another worker"""
+        loads = []
+        self.assertEqual(cache.cached('n', 'a', lambda: loads.append(1) or (1, 'x')), (1, 'x'))
+        self.assertEqual(other.cached('n', 'a', lambda: loads.append(1)), (1, 'x'))
+        self.assertIsNone(cache.cached('n', 'b', lambda: None))
+        self.assertEqual(cache.get('n', 'b', 'missing'), 'missing')
+        self.assertEqual(len(loads), 1)
+        other.invalidate('n')
+        self.assertIsNone(cache.get('n', 'a'))
+        # invalidated while loading: the loaded value is not cached
+        self.assertEqual(cache.cached('n', 'a', lambda: other.invalidate('n') or 2), 2)
+        self.assertIsNone(cache.get('n', 'a'))
+        cache.set('n', 'a', 3, ttl=-1)
+        self.assertIsNone(cache.get('n', 'a'))
+        for key in 'cdef':
+            cache.set('m', key, key)
+        other.delete('m', 'f')
+        self.assertIsNone(cache.get('m', 'f'))
+
+    def test_memory(self):
+        """entries, versions and the size bound of the per process cache"""
+        cache = shared_cache.MemoryCache(3, 60)
+        self.check_cache(cache, cache)
+        self.assertEqual([cache.get('m', key) for key in 'cde'], [None, 'd', 'e'])
+
+    def test_sqlite(self):
+        """two handles of a SQLite file see each other's entries"""
+        path = os.path.join(self.tmp.name, 'cache.db')
+        cache = shared_cache.SQLiteCache(path, 3, 60, evict_every=1)
+        self.check_cache(cache, shared_cache.SQLiteCache(path, 3, 60))
+        self.assertEqual(cache.evict(), 2)
+        self.assertEqual([cache.get('m', key) for key in 'cde'], [None, 'd', 'e'])
+
+    def test_cached_user(self):
+        """users load without a query once cached, changes drop the entries"""
+        user = User(username='susan', email='susan@example.com')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        for _ in range(2):
+            # the first lookup finds the user in the session, the second caches it
+            self.assertEqual(User.by_username('susan').id, user_id)
+            db.session.remove()
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+        user = User.by_username('susan')
+        self.assertEqual((user.id, user.email), (user_id, 'susan@example.com'))
+        self.assertEqual(statements, [])
+        self.assertEqual(user.post_count, 0)
+        self.assertEqual(len(statements), 1)
+        user.username = 'sue'
+        db.session.commit()
+        db.session.remove()
+        self.assertIsNone(User.by_username('susan'))
+        self.assertEqual(User.by_username('sue').id, user_id)
+        self.assertIs(User.cached(user_id), User.by_username('sue'))
+        cache = shared_cache.get_cache(self.app)
+        self.assertNotIn('password_hash', cache.get('user', str(user_id)))
+        db.session.remove()
+        db.session.delete(User.by_username('sue'))
+        db.session.commit()
+        self.assertIsNone(cache.get('user', str(user_id)))
+        self.assertIsNone(cache.get('username', 'sue'))
+        db.session.remove()
+        self.assertIsNone(User.cached(user_id))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,8 @@
+"""
+Entry point for WSGI servers, e.g. `gunicorn --preload wsgi:app`.
+Unlike microblog.py it does not register the CLI commands, so with
+LAZY_EXTENSIONS set Flask-Migrate is never loaded in the workers.
+"""
+from app import create_app
+
+app = create_app()